@@ -5,6 +5,9 @@ from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
 from flask_mail import Mail
 from spendingtracker.config import Config
+from spendingtracker.cards.cache import classification_cache
+from spendingtracker.common.jobs import job_queue
+from spendingtracker.common.breaker import mail_breaker
 
 
 
@@ -28,6 +31,9 @@ def create_app(config_class=Config):
     bcrypt.init_app(app)
     login_manager.init_app(app)
     mail.init_app(app)
+    classification_cache.configure(app.config['CLASSIFICATION_CACHE_PATH'], app.config['CLASSIFICATION_CACHE_SIZE'])
+    job_queue.init_app(app)
+    mail_breaker.configure(app.config['MAIL_BREAKER_FAILURES'], app.config['MAIL_BREAKER_COOLDOWN'])
 
     # import the instance of blueprints
     from spendingtracker.users.routes import users
@@ -37,4 +43,31 @@ def create_app(config_class=Config):
     app.register_blueprint(cards)
     app.register_blueprint(main)
 
+    # Caches and queues that need the models
+    from spendingtracker.main.reports import report_cache
+    report_cache.configure(app.config['REPORT_CACHE_SIZE'])
+    from spendingtracker.common.outbox import outbox_sender
+    outbox_sender.init_app(app)
+    from spendingtracker.common.utils import message_buffer
+    message_buffer.init_app(app)
+
+    # Register 'flask' commands
+    from spendingtracker.commands import reclassify_command, upgrade_db_command, reconcile_spending_command, export_command, \
+        rebuild_rollups_command, drain_outbox_command, prune_command, import_transactions_command, seed_command
+    app.cli.add_command(reclassify_command)
+    app.cli.add_command(upgrade_db_command)
+    app.cli.add_command(reconcile_spending_command)
+    app.cli.add_command(export_command)
+    app.cli.add_command(rebuild_rollups_command)
+    app.cli.add_command(drain_outbox_command)
+    app.cli.add_command(prune_command)
+    app.cli.add_command(import_transactions_command)
+    app.cli.add_command(seed_command)
+
+    # Upgrade existing databases in place
+    if app.config['DATABASE_AUTO_UPGRADE']:
+        from spendingtracker.migrations import upgrade_database
+        with app.app_context():
+            upgrade_database()
+
     return app
\ No newline at end of file
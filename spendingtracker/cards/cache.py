@@ -0,0 +1,151 @@
+import sqlite3, threading
+from collections import OrderedDict
+
+
+class ClassificationCache:
+    """
+    Two level cache of description -> category results.
+        1. A bounded LRU in the current process
+        2. A SQLite table shared by every process (e.g. gunicorn workers) that survives restarts
+    Every result is stored with the version (sha1) of the matching table it was computed with,
+    results of an older version are never returned and are dropped when the table changes.
+    """
+
+    def __init__(self, path='spendingtracker/cards/classification_cache.db', size=10000):
+        """
+        :param path: path to the SQLite file, None to only use the in-process LRU
+        :param size: maximum number of results kept in the in-process LRU
+        """
+        self.path = path
+        self.size = size
+        self.version = None
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        # sqlite3 connections can't be shared between threads
+        self._local = threading.local()
+
+    def configure(self, path, size):
+        with self._lock:
+            self.path = path
+            self.size = size
+            self.version = None
+            self._lru.clear()
+            self._local = threading.local()
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=1)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS classification ('
+                               'version TEXT NOT NULL, description TEXT NOT NULL, category TEXT NOT NULL, '
+                               'PRIMARY KEY (version, description))')
+            self._local.connection = connection
+        return connection
+
+    def _check_version(self, version):
+        # The matching table changed: forget results of the old version
+        if version == self.version:
+            return
+        with self._lock:
+            self._lru.clear()
+            self.version = version
+        if self.path is not None:
+            try:
+                with self._connect() as connection:
+                    connection.execute('DELETE FROM classification WHERE version != ?', (version,))
+            except sqlite3.Error:
+                pass
+
+    def get(self, description, version):
+        """
+        Look up a result
+        :param description: normalized description
+        :param version: version of the matching table
+        :return: category, or None if the description hasn't been classified with this version
+        """
+        return self.get_many([description], version).get(description)
+
+    def get_many(self, descriptions, version):
+        """
+        Look up many results at once
+        :param descriptions: list of normalized descriptions
+        :param version: version of the matching table
+        :return: dict of description -> category for the descriptions that were found
+        """
+        self._check_version(version)
+        results = {}
+        missing = []
+        with self._lock:
+            for description in descriptions:
+                if description in self._lru:
+                    self._lru.move_to_end(description)
+                    results[description] = self._lru[description]
+                else:
+                    missing.append(description)
+            self.l1_hits += len(results)
+        if missing and self.path is not None:
+            found = {}
+            try:
+                connection = self._connect()
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i + 500]
+                    rows = connection.execute(f"SELECT description, category FROM classification WHERE version = ? "
+                                              f"AND description IN ({','.join('?' * len(chunk))})", [version] + chunk)
+                    found.update(rows)
+            except sqlite3.Error:
+                pass
+            self._remember(found)
+            self.l2_hits += len(found)
+            results.update(found)
+        self.misses += len(descriptions) - len(results)
+        return results
+
+    def set(self, description, category, version):
+        self.set_many({description: category}, version)
+
+    def set_many(self, results, version):
+        """
+        Store results in both levels
+        :param results: dict of normalized description -> category
+        :param version: version of the matching table
+        :return: None
+        """
+        self._check_version(version)
+        self._remember(results)
+        if results and self.path is not None:
+            try:
+                with self._connect() as connection:
+                    connection.executemany('INSERT OR REPLACE INTO classification (version, description, category) VALUES (?, ?, ?)',
+                                           [(version, description, category) for description, category in results.items()])
+            except sqlite3.Error:
+                pass
+
+    def _remember(self, results):
+        with self._lock:
+            for description, category in results.items():
+                self._lru[description] = category
+                self._lru.move_to_end(description)
+            while len(self._lru) > self.size:
+                self._lru.popitem(last=False)
+
+    def get_stats(self):
+        """
+        Get hit and miss counters of the current process
+        :return: dict, e.g. "{'l1_hits': 90, 'l2_hits': 5, 'misses': 5, 'hit_rate': 0.95, 'size': 40}"
+        """
+        lookups = self.l1_hits + self.l2_hits + self.misses
+        return {
+            'l1_hits': self.l1_hits,
+            'l2_hits': self.l2_hits,
+            'misses': self.misses,
+            'hit_rate': round((self.l1_hits + self.l2_hits) / lookups, 4) if lookups else 0,
+            'size': len(self._lru),
+            'version': self.version,
+        }
+
+
+classification_cache = ClassificationCache()
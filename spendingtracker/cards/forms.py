@@ -1,4 +1,5 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired, FileAllowed
 from wtforms import StringField, SubmitField
 from wtforms.validators import DataRequired, ValidationError, Length, Regexp
 from spendingtracker.models import Card
@@ -51,3 +52,15 @@ class AddCardForm(FlaskForm):
             flash(f'Please ensure you insert valid card details.', 'danger')
             return False
         return True
+
+
+class ImportTransactionsForm(FlaskForm):
+    """
+    Used in 'accounts' page for users to import a statement into the card.
+    It has:
+        1. CSV or NDJSON file, in the format of '/export'
+        2. Submit Button
+    """
+
+    file = FileField('Import statement (CSV or NDJSON):', validators=[FileRequired(), FileAllowed(['csv', 'ndjson', 'jsonl', 'json'], 'Please upload a CSV or NDJSON file')])
+    submit = SubmitField('Import')
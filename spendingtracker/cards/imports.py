@@ -0,0 +1,195 @@
+import csv, json, os
+from collections import Counter
+from datetime import datetime, timezone
+from sqlalchemy import bindparam
+from spendingtracker import db
+from spendingtracker.models import Transaction, Card, CategoryOverride, ROLLUPS, bump_data_version
+from spendingtracker.cards.utils import get_UUID, classify_transactions, normalize_description
+
+
+# Import formats and the file extensions they are recognized by
+IMPORT_FORMATS = {
+    'csv': ('.csv',),
+    'ndjson': ('.ndjson', '.jsonl', '.json'),
+}
+# Invalid rows reported by line number, the rest are only counted
+MAX_ERRORS = 20
+
+
+def get_import_format(filename):
+    """
+    :param filename: name of the uploaded or imported file, e.g. 'statement.csv'
+    :return: 'csv' or 'ndjson', None if the extension is unknown
+    """
+    extension = os.path.splitext(filename or '')[1].lower()
+    for format, extensions in IMPORT_FORMATS.items():
+        if extension in extensions:
+            return format
+    return None
+
+
+def read_records(file, format):
+    """
+    Read a statement one record at a time, the file is never loaded into memory as a whole
+    :param file: text file, opened with newline='' for CSV
+    :param format: 'csv' (with a header row) or 'ndjson' (one JSON object per line)
+    :return: generator of (line number, record), a record is a dict or the text of an NDJSON line
+    """
+    if format == 'csv':
+        reader = csv.DictReader(file)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for number, line in enumerate(file, start=1):
+            if line.strip():
+                yield number, line
+
+
+def parse_record(record, card_ids, card_id=None):
+    """
+    Validate a record and turn it into the columns of a transaction.
+    The fields are the ones of '/export': amount, timestamp (ISO format, UTC unless it has an offset) and description are required; currency (default GBP),
+    category (classified if it's empty), transactionUUID (generated if it's empty) and card (default 'card_id') are optional.
+    :param record: dict, or the text of an NDJSON line
+    :param card_ids: ids of the user's cards
+    :param card_id: card of records without 'card'
+    :return: dict of 'transaction' columns, 'category' is None if it must be classified
+    :raise ValueError: if the record is invalid
+    """
+    if isinstance(record, str):
+        try:
+            record = json.loads(record)
+        except RecursionError:
+            raise ValueError("too deeply nested")
+    if not isinstance(record, dict):
+        raise ValueError("not an object")
+    for field in ('amount', 'timestamp', 'description'):
+        if record.get(field) in (None, ''):
+            raise ValueError(f"'{field}' is missing")
+    amount = round(float(record['amount']), 2)
+    # Also false for nan and inf
+    if not 0 < amount < float('inf'):
+        raise ValueError("'amount' must be a positive number")
+    timestamp = datetime.fromisoformat(str(record['timestamp']))
+    # Timestamps are saved as naive UTC, an offset like '+01:00' would otherwise be dropped
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    description = normalize_description(str(record['description']))
+    if len(description) > 50:
+        raise ValueError("'description' is longer than 50 characters")
+    currency = str(record.get('currency') or 'GBP').upper()
+    if len(currency) > 10:
+        raise ValueError("'currency' is longer than 10 characters")
+    uuid = str(record.get('transactionUUID') or get_UUID())
+    if len(uuid) > 50:
+        raise ValueError("'transactionUUID' is longer than 50 characters")
+    card = card_id
+    if record.get('card') not in (None, ''):
+        # Through str() so 1.5 isn't truncated and 1e400 isn't an OverflowError
+        try:
+            card = int(str(record['card']))
+        except ValueError:
+            raise ValueError("'card' must be an integer")
+    if card is None:
+        raise ValueError("'card' is missing")
+    if card not in card_ids:
+        raise ValueError(f"card {card} isn't one of your cards")
+    return {
+        'transactionUUID': uuid,
+        'amount': amount,
+        'currency': currency,
+        'timestamp': timestamp,
+        'description': description,
+        'category': str(record['category']) if record.get('category') else None,
+        'card_id': card,
+    }
+
+
+def import_statement(user, file, format, card_id=None, chunk_size=500):
+    """
+    Import a CSV or NDJSON statement into the user's cards.
+    Records are parsed as they are read and inserted 'chunk_size' at a time, each chunk in one database transaction:
+        1. Transactions whose transactionUUID is already in the db or earlier in the file are skipped, so a
+           statement (or an export) can be imported twice
+        2. Transactions without a category are classified in one batch per chunk, each description only once
+        3. A transaction is rejected if its card's balance isn't sufficient, like '/generate_transaction'. The
+           balances are read in the chunk's own transaction, so spending since the previous chunk is counted
+        4. The rest are inserted with one executemany, and the spending rollups, card balances, total spending
+           and 'data_version' are updated in the same transaction (bulk inserts skip the ORM events). The chunk's
+           spending is subtracted from the balances in SQL rather than overwriting them
+    :param user: user
+    :param file: text file, opened with newline='' for CSV
+    :param format: 'csv' or 'ndjson'
+    :param card_id: card of records without 'card'
+    :param chunk_size: number of records per chunk
+    A file that can't be read to the end (e.g. a byte that isn't UTF-8, or a field over the csv
+    field limit) stops the import there: the rows before it are imported and 'stopped' tells where it stopped.
+    :return: dict, e.g. "{'imported': 120, 'duplicates': 3, 'insufficient_funds': 0, 'invalid': 1, 'errors': ['Line 5: ...'], 'stopped': None}"
+    """
+    card_ids = {card.id for card in user.cards}
+    overrides = CategoryOverride.get_overrides(user.id)
+    result = {'imported': 0, 'duplicates': 0, 'insufficient_funds': 0, 'invalid': 0, 'errors': [], 'stopped': None}
+    seen = set()
+    chunk = []
+    number = 0
+    try:
+        for number, record in read_records(file, format):
+            try:
+                chunk.append(parse_record(record, card_ids, card_id))
+            except (ValueError, TypeError) as e:
+                result['invalid'] += 1
+                if len(result['errors']) < MAX_ERRORS:
+                    result['errors'].append(f"Line {number}: {e}")
+                continue
+            if len(chunk) >= chunk_size:
+                insert_chunk(user, chunk, overrides, seen, result)
+                chunk = []
+    except (csv.Error, UnicodeDecodeError) as e:
+        # Earlier chunks are already committed, the result is still returned
+        result['stopped'] = f"The file can't be read after line {number}: {e}"
+    if chunk:
+        insert_chunk(user, chunk, overrides, seen, result)
+    return result
+
+
+def insert_chunk(user, chunk, overrides, seen, result):
+    # Skip duplicates
+    uuids = [row['transactionUUID'] for row in chunk]
+    seen.update(uuid for (uuid,) in db.session.query(Transaction.transactionUUID).filter(Transaction.transactionUUID.in_(uuids)))
+    rows = []
+    for row in chunk:
+        if row['transactionUUID'] in seen:
+            result['duplicates'] += 1
+        else:
+            seen.add(row['transactionUUID'])
+            rows.append(row)
+    # Classify the transactions without a category in one batch
+    unclassified = [row for row in rows if row['category'] is None]
+    categories = classify_transactions([row['description'] for row in unclassified], overrides=overrides)
+    for row, category in zip(unclassified, categories):
+        row['category'] = category
+    # Check the balances in the order of the file
+    balances = dict(db.session.query(Card.id, Card.balance).filter(Card.id.in_({row['card_id'] for row in rows}))) if rows else {}
+    spent = Counter()
+    accepted = []
+    for row in rows:
+        if balances[row['card_id']] - spent[row['card_id']] - row['amount'] < 0:
+            result['insufficient_funds'] += 1
+        else:
+            spent[row['card_id']] = round(spent[row['card_id']] + row['amount'], 2)
+            accepted.append(row)
+    if not accepted:
+        return
+    connection = db.session.connection()
+    connection.execute(Transaction.__table__.insert(), accepted)
+    where, params = 't.transactionUUID IN :uuids', {'uuids': tuple(row['transactionUUID'] for row in accepted)}
+    for rollup in ROLLUPS:
+        rollup.add_transactions(connection, where, params)
+    connection.execute(Card.__table__.update().where(Card.id == bindparam('card'))
+                       .values(balance=db.func.round(Card.balance - bindparam('spent'), 2)),
+                       [{'card': id, 'spent': amount} for id, amount in spent.items()])
+    period = datetime.utcnow().strftime('%Y-%m')
+    user.spending.add_spending(sum(row['amount'] for row in accepted if row['timestamp'].strftime('%Y-%m') == period), datetime.utcnow())
+    bump_data_version(connection, user.id)
+    db.session.commit()
+    result['imported'] += len(accepted)
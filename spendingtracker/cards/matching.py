@@ -0,0 +1,189 @@
+from collections import Counter, defaultdict
+from functools import lru_cache
+from fuzzywuzzy import utils as fuzz_utils
+
+
+# A rule matches a description when get_similarity() returns more than this value
+SIMILARITY_THRESHOLD = 90
+
+
+def get_bigrams(text):
+    """
+    Count the character bigrams of a string
+    :param text: any string
+    :return: Counter of bigrams, e.g. "Asda" -> {'As': 1, 'sd': 1, 'da': 1}
+    """
+    return Counter(text[i:i + 2] for i in range(len(text) - 1))
+
+
+def process_tokens(text):
+    """
+    Process a string exactly the way 'fuzz.token_sort_ratio()' does before comparing
+    :param text: any string
+    :return: lower case alphanumeric tokens in sorted order, e.g. "Tesco, London" -> "london tesco"
+    """
+    return ' '.join(sorted(fuzz_utils.full_process(text, force_ascii=True).split())).strip()
+
+
+def _score(matches, length1, length2):
+    # Same rounding as fuzzywuzzy: ratio = 2M / T, partial ratios above .995 count as 100
+    ratio = 2 * matches / (length1 + length2)
+    return 100 if ratio > .995 else fuzz_utils.intr(100 * ratio)
+
+
+@lru_cache(maxsize=None)
+def _partial_ratio_bound(length):
+    """
+    Minimum number of shared bigrams two strings need for 'fuzz.partial_ratio()' to score above the threshold.
+    If 'a' and 'b' have M characters in common (in order), at least 3M - len(a) - len(b) - 1 bigrams of 'a'
+    also occur in 'b'. partial_ratio() compares the shorter string (length L) against a window (length <= L)
+    of the longer one, so the bound only depends on L.
+    :param length: length of the shorter string
+    :return: minimum shared bigrams, or None if the score can never exceed the threshold
+    """
+    bound = None
+    for window in range(1, length + 1):
+        for matches in range(window + 1):
+            if _score(matches, length, window) > SIMILARITY_THRESHOLD:
+                value = 3 * matches - length - window - 1
+                bound = value if bound is None else min(bound, value)
+    return bound
+
+
+@lru_cache(maxsize=None)
+def _token_sort_ratio_bound(length1, length2):
+    """
+    Minimum number of shared bigrams two processed strings need for 'fuzz.token_sort_ratio()' to score above
+    the threshold. Same reasoning as '_partial_ratio_bound()', but token_sort_ratio() compares the whole strings.
+    :param length1: length of the first processed string
+    :param length2: length of the second processed string
+    :return: minimum shared bigrams, or None if the score can never exceed the threshold
+    """
+    bound = None
+    for matches in range(min(length1, length2) + 1):
+        if _score(matches, length1, length2) > SIMILARITY_THRESHOLD:
+            value = 3 * matches - length1 - length2 - 1
+            bound = value if bound is None else min(bound, value)
+    return bound
+
+
+class Matcher:
+    """
+    A prebuilt index over the matching table (description.txt) used to classify transactions.
+    It gives exactly the same answer as scoring the description against every rule and keeping the
+    last rule whose similarity is above 90, but it only runs fuzzy scoring on a few rules:
+        1. Rules that are a prefix of the description are found by walking a trie
+        2. Other rules are looked up by the bigrams they share with the description, rules that don't
+           share enough bigrams can't score above 90 and are never compared
+        3. Candidates are scored from the last rule backwards, the first one above 90 is the answer
+    """
+
+    def __init__(self, table, similarity):
+        """
+        :param table: the matching table, e.g. "(('Greggs', 'Food'), ('Tesco', 'Food'))"
+        :param similarity: the scoring function, e.g. 'get_similarity'
+        """
+        self.table = tuple(table)
+        self.similarity = similarity
+        self._lengths = []
+        self._processed_lengths = []
+        # bigram -> [(rule index, count), ...]
+        self._bigrams = defaultdict(list)
+        self._processed_bigrams = defaultdict(list)
+        # processed rule -> [rule index, ...]
+        self._processed = defaultdict(list)
+        # Rules with one character can't be filtered by bigrams, they are always compared
+        self._short = []
+        # Every node is a dict of characters, the key None holds the rules ending at that node
+        self._trie = {}
+        for index, (item, category) in enumerate(self.table):
+            processed = process_tokens(item)
+            self._lengths.append(len(item))
+            self._processed_lengths.append(len(processed))
+            for bigram, count in get_bigrams(item).items():
+                self._bigrams[bigram].append((index, count))
+            for bigram, count in get_bigrams(processed).items():
+                self._processed_bigrams[bigram].append((index, count))
+            self._processed[processed].append(index)
+            if len(item) <= 1 or len(processed) <= 1:
+                self._short.append(index)
+            node = self._trie
+            for char in item:
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append(index)
+
+    def __len__(self):
+        return len(self.table)
+
+    def prefix_matches(self, description):
+        """
+        Find all rules that are a prefix of the description
+        :param description: description of a transaction
+        :return: list of rule indexes, e.g. "Tesco Metro, London" -> [2]
+        """
+        indexes = []
+        node = self._trie
+        for char in description:
+            node = node.get(char)
+            if node is None:
+                break
+            indexes += node.get(None, [])
+        return indexes
+
+    def candidates(self, description):
+        """
+        Find the rules that could score above 90 against the description
+        :param description: description of a transaction
+        :return: set of rule indexes
+        """
+        processed = process_tokens(description)
+        if len(description) <= 1 or len(processed) <= 1:
+            return set(range(len(self.table)))
+        candidates = set(self._short)
+        candidates.update(self._processed.get(processed, []))
+        shared = defaultdict(int)
+        for bigram, count in get_bigrams(description).items():
+            for index, rule_count in self._bigrams.get(bigram, []):
+                shared[index] += min(count, rule_count)
+        for index, count in shared.items():
+            bound = _partial_ratio_bound(min(len(description), self._lengths[index]))
+            if bound is not None and count >= bound:
+                candidates.add(index)
+        shared = defaultdict(int)
+        for bigram, count in get_bigrams(processed).items():
+            for index, rule_count in self._processed_bigrams.get(bigram, []):
+                shared[index] += min(count, rule_count)
+        for index, count in shared.items():
+            bound = _token_sort_ratio_bound(len(processed), self._processed_lengths[index])
+            if bound is not None and count >= bound:
+                candidates.add(index)
+        return candidates
+
+    def match(self, description):
+        """
+        Find the rule a description is classified by
+        :param description: description of a transaction
+        :return: rule index, or -1 if no rule scores above 90
+        """
+        floor = -1
+        # A prefix hit is nearly always above 90, so only the rules after it still need scoring
+        prefixes = self.prefix_matches(description)
+        if prefixes and self.similarity(description, self.table[max(prefixes)][0]) > SIMILARITY_THRESHOLD:
+            floor = max(prefixes)
+        for index in sorted(self.candidates(description), reverse=True):
+            if index <= floor:
+                break
+            if self.similarity(description, self.table[index][0]) > SIMILARITY_THRESHOLD:
+                return index
+        return floor
+
+    def classify(self, description):
+        """
+        Classify a transaction
+        :param description: description of a transaction
+        :return: category e.g. 'Food', 'General' if no rule matches
+        """
+        index = self.match(description)
+        if index != -1:
+            return self.table[index][1]
+        return 'General'
@@ -1,12 +1,17 @@
-from flask import render_template, url_for, redirect, Blueprint, request, abort
+from flask import render_template, url_for, redirect, Blueprint, request, abort, jsonify, current_app
 from spendingtracker import db
-from spendingtracker.cards.forms import AddCardForm
-from spendingtracker.models import Card, Transaction, TransactionSchema
+from spendingtracker.cards.forms import AddCardForm, ImportTransactionsForm
+from spendingtracker.cards.imports import import_statement, get_import_format
+from spendingtracker.models import Card, Transaction, CategoryOverride
 from flask_login import current_user, login_required
-from spendingtracker.common.utils import flash_message
+from spendingtracker.common.utils import flash_message, admin_required
 from spendingtracker.common.senders import emails_check, send_category_email
-from spendingtracker.cards.utils import category_budget, read_matching_table
-import random
+from spendingtracker.cards.utils import get_categories
+from spendingtracker.common.budgets import evaluate_budgets, OVER
+from spendingtracker.cards.cache import classification_cache
+from spendingtracker.main.utils import get_transaction_page, get_card_spending_by_category
+import random, io
+from datetime import datetime
 
 
 cards = Blueprint('cards', __name__)
@@ -55,17 +60,14 @@ def delete_card(card_id):
     """
     card = Card.query.get_or_404(card_id)
     card_account_number = card.account_number
-    # Get all transactions related to this card
-    transactions = Transaction.query.filter_by(card_id=card.id)
-    # Delete related transactions from the db
-    for transaction in transactions:
-        db.session.delete(transaction)
+    # Update total spending: this month's spending of the card doesn't count any more
+    current_user.spending.subtract_spending(card.get_total_spending(), datetime.utcnow())
+    # Delete related transactions from the db in one statement
+    # (the spending rollups of the card are removed together with the card)
+    Transaction.query.filter_by(card_id=card.id).delete(synchronize_session=False)
     # Delete the card
     db.session.delete(card)
     db.session.commit()
-    # Update total spending
-    current_user.spending.update_spending()
-    db.session.commit()
     # flash messages can be passed between pages, message tag is placed in 'layout.html'
     # flash(f'Card {card_account_number} has been removed!', 'success')
     flash_message(f'Card {card_account_number} has been removed!', 'success', current_user.id)
@@ -84,26 +86,53 @@ def card(card_id):
     :return: 'accounts.html'
     """
     card = Card.query.get_or_404(card_id)
-    # Get transactions from db
-    # These transactions will be shown in accounts.html, transactions box
-    transactions = Transaction.query.filter_by(card_id=card_id).order_by(Transaction.timestamp.desc())
-    # Transferring BaseQuery type to Python dictionary data type
-    transaction_schema = TransactionSchema()
-    # List of all transactions
-    listOfDict = []
-    # List of all transaction categories
-    categories = []
-    for transacion in transactions:
-        if transacion.category not in categories:
-            categories.append(transacion.category)
-        dict_transaction = transaction_schema.dump(transacion)
-        listOfDict += [dict_transaction]
+    # Get the first page of transactions from db, newest first
+    # These transactions will be shown in accounts.html, transactions box, the next pages are loaded from '/api/transactions'
+    transactions, next_cursor = get_transaction_page(current_user, limit=current_app.config['TRANSACTIONS_PAGE_SIZE'], card_id=card.id)
+    # Spending per category of all the card's transactions, for the donut chart
+    category_spending = get_card_spending_by_category(current_user, card.id)
+    # List of all transaction categories of the card
+    categories = [category for (category,) in db.session.query(Transaction.category).filter_by(card_id=card.id).distinct()]
     # List of all categories known by the system
-    all_categories = []
-    for item in read_matching_table():
-        if not item[1] in all_categories:
-            all_categories += [item[1],]
-    return render_template('accounts.html', title='Cards', card=card, transactions=listOfDict, categories=categories, all_categories=all_categories, transactions_db=transactions)
+    all_categories = get_categories()
+    return render_template('accounts.html', title='Cards', card=card, transactions=transactions, next_cursor=next_cursor,
+                           category_spending=category_spending, categories=categories, all_categories=all_categories, import_form=ImportTransactionsForm())
+
+
+@cards.route('/card/<int:card_id>/import', methods=['POST'])
+@login_required
+def import_transactions(card_id):
+    """
+    Import a CSV or NDJSON statement into a card, e.g. a year of history in one upload.
+    This method only accepts 'POST' method, the file is sent by the form in 'accounts.html'.
+    The file is parsed while it's read and inserted in chunks, see 'cards/imports.py'.
+    :param card_id: Card ID, the card of records without a 'card' field
+    :return: URL:'cards.card', the result is flashed; 403 if the card isn't the current user's
+    """
+    card = Card.query.get_or_404(card_id)
+    if card.owner != current_user:
+        abort(403)
+    form = ImportTransactionsForm()
+    if not form.validate_on_submit():
+        for error in form.file.errors:
+            flash_message(error, 'danger', current_user.id)
+        return redirect(url_for('cards.card', card_id=card.id))
+    upload = form.file.data
+    with io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='') as file:
+        result = import_statement(current_user, file, get_import_format(upload.filename), card_id=card.id,
+                                  chunk_size=current_app.config['IMPORT_CHUNK_SIZE'])
+    flash_message(f"{result['imported']} transactions imported, {result['duplicates']} duplicates skipped, "
+                  f"{result['insufficient_funds']} rejected for insufficient funds, {result['invalid']} invalid rows.",
+                  'success' if result['imported'] else 'info', current_user.id)
+    for error in result['errors']:
+        print(f"Import into card {card.id}: {error}")
+    if result['errors']:
+        flash_message(f"First invalid row - {result['errors'][0]}", 'danger', current_user.id)
+    # The rest of the file couldn't be read, e.g. it isn't UTF-8 text
+    if result['stopped']:
+        print(f"Import into card {card.id}: {result['stopped']}")
+        flash_message(f"Import stopped - {result['stopped']}. The file must be UTF-8 text.", 'danger', current_user.id)
+    return redirect(url_for('cards.card', card_id=card.id))
 
 
 @cards.route('/generate_transaction', methods=['POST'])
@@ -119,39 +148,38 @@ def generate_transaction():
     """
     card_id = request.form.get('card_id')
     card = Card.query.get_or_404(card_id)
-    # Generate a random transaction with given card id
-    transaction = Transaction(card.id)
+    # Generate a random transaction with given card id, merchants the user recategorized keep the user's category
+    transaction = Transaction(card.id, user_id=current_user.id)
     # Update card balance
     if card.check_update_balance(transaction) == False:
         # Not sufficient funds
         flash_message("No sufficient funds", 'danger', current_user.id)
         print('Warning: No sufficient funds')
         return "No sufficient funds"
-    # Add the transaction to the db
+    # Add the transaction to the db and update total spending
+    # The transaction, alert levels, queued emails and messages are all saved with the one commit at the end
+    version = current_user.data_version
     db.session.add(transaction)
-    db.session.commit()
-    # Update total spending
-    current_user.spending.update_spending()
+    current_user.spending.add_spending(transaction.amount, transaction.timestamp)
     flash_message(f'A new transaction is generated to card:{card.account_number}!', 'success', current_user.id)
-    # Check if the latest spending has exceeded user's budget and balance.
-    if current_user.spending.check_spending():
-        flash_message(f'Your total monthly spending has exceeded your budget!', 'danger', current_user.id)
-        print(f'Your spending has exceeded your budget!')
-    # Try to send emails to the user if user has email services
-    # emails_check() method returns False if the email didn't send out
-    if not emails_check(current_user, card):
-        flash_message('The email service is currently unavailable!', 'danger', current_user.id)
-        print('Error: The email service is currently unavailable!')
-    # Checks if the latest spending has exceeded any category budget
-    (spending_over_budget, categorybudget, spending) = category_budget(current_user, transaction)
-    if spending_over_budget:
-        print(spending_over_budget, categorybudget.category, spending)
+    # Check the overall budget and every category budget in one pass, each crossing is alerted once per month
+    budget_level = None
+    category_alerts = []
+    for categorybudget, level, spending in evaluate_budgets(current_user, transaction, version):
+        if categorybudget is None:
+            budget_level = level
+            if level == OVER:
+                flash_message(f'Your total monthly spending has exceeded your budget!', 'danger', current_user.id)
+                print(f'Your spending has exceeded your budget!')
+        else:
+            category_alerts.append((categorybudget, spending))
+    # Queue emails to the user if user has email services, the outbox sends them in the background
+    emails_check(current_user, card, budget_level)
+    # Category budgets the latest spending has exceeded
+    for categorybudget, spending in category_alerts:
         flash_message(f'Your monthly budget on {categorybudget.category} has exceeded your budget!', 'danger', current_user.id )
-        try:
-            send_category_email(current_user, categorybudget, spending)
-        except:
-            flash_message('The email service is currently unavailable!', 'danger', current_user.id)
-            print('Error: The email service is currently unavailable!')
+        send_category_email(current_user, categorybudget, spending)
+    db.session.commit()
     return "Done"
 
 
@@ -162,6 +190,7 @@ def change_category():
     This method receives a Ajax request for updating the category of a transaction.
     This method accepts 'POST' method only.
     This method flashes messages to the page that calls this method to indicate the result of this method.
+    The new category is remembered for the merchant, so the user's next transactions from it get the same category.
     :param: 'transactionID': transaction ID (not UUID)
             'newCategory': the new category of the transaction
     :return: 'Succeeded' if the category is changed successfully, 'Failed' otherwise
@@ -174,17 +203,22 @@ def change_category():
     old_category = transaction.category
     try:
         transaction.category = new_category
+        CategoryOverride.set_override(current_user.id, transaction.description, new_category)
+        db.session.commit()
         flash_message(f'Successfully changed {old_category} to {new_category}', 'success', current_user.id)
         return "Succeeded"
     except:
+        db.session.rollback()
         flash_message(f'Error: fail to change {old_category} to {new_category}', 'danger', current_user.id)
         return "Failed"
 
 
-
-
-
-
-
-
-
+@cards.route('/classification_stats')
+@login_required
+@admin_required
+def classification_stats():
+    """
+    Hit and miss counters of the classification cache in this process.
+    :return: JSON, e.g. {"l1_hits": 90, "l2_hits": 5, "misses": 5, "hit_rate": 0.95, ...}
+    """
+    return jsonify(classification_cache.get_stats())
@@ -1,9 +1,19 @@
-import random, string
+import random, string, os, atexit, difflib
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from fuzzywuzzy import fuzz
-from spendingtracker.main.utils import get_all_transactions
+from spendingtracker.cards.matching import Matcher
+from spendingtracker.common.tables import tables
+from spendingtracker.cards.cache import classification_cache
 
 
+# Batches with fewer unique descriptions than this are classified in the current process
+PARALLEL_THRESHOLD = 2000
+# Number of unique descriptions sent to a worker at a time
+CHUNK_SIZE = 500
+# Worker processes used by 'classify_transactions()', created the first time a large batch comes in
+pool = None
+
 
 def get_UUID():
     """
@@ -59,38 +69,43 @@ def get_datetime():
     return time
 
 
+def parse_matching_table(text):
+    """
+    Parse the content of the matching table
+    :param text: content of the description.txt file
+    :return: a tuple, e.g. "(('Greggs', 'food'), ('Tesco', 'food'))"
+    """
+    data = []
+    for line in text.splitlines():
+        # Drop space
+        line = line.strip()
+        # If there is empty line
+        if line == '':
+            continue
+        # Split the line by ';'
+        line = line.split(';')
+        # Store (item, category) pair, drop preceding space of the category
+        data.append((line[0], line[1].strip()))
+    return tuple(data)
+
+
 def read_matching_table(file='spendingtracker/cards/description.txt'):
     """
     Read the matching table and store them into a tuple
+    The file is only parsed again when it changes
     :param file: relative path to the description.txt file
     :return: a tuple, e.g. "(('Greggs', 'food'), ('Tesco', 'food'))"
     """
-    f = open(file, 'r')
-    # Create an empty tuple
-    data = ()
-    try:
-        # Read a line every time
-        for line in f:
-            # Drop the last '\n'
-            line = line.strip('\n')
-            # Drop space
-            line = line.strip()
-            # If there is empty line
-            if line == '':
-                continue
-            # Split the line by ';'
-            line = line.split(';')
-            # Get the item
-            item = line[0]
-            # Get the category
-            category = line[1]
-            # Drop preceding space
-            category = category.strip()
-            # Store (item, category) pair into tuple
-            data += ((item, category),)
-    finally:
-        f.close()
-    return data
+    return tables.get(file, parse_matching_table).value
+
+
+def get_categories(file='spendingtracker/cards/description.txt'):
+    """
+    Get all categories the system knows
+    :param file: relative path to the description.txt file
+    :return: a tuple of categories in the order they appear in the matching table, e.g. "('Food', 'Shopping')"
+    """
+    return tables.get(file, parse_matching_table).derive('categories', lambda table: tuple(dict.fromkeys(category for item, category in table)))
 
 
 def get_similarity(str1, str2):
@@ -107,47 +122,178 @@ def get_similarity(str1, str2):
     return max(fuzz.partial_ratio(str1, str2), fuzz.token_sort_ratio(str1, str2))
 
 
+def parse_descriptions(text):
+    """
+    Parse the content of the description file
+    :param text: content of the transactions.txt file
+    :return: a tuple of descriptions, e.g. "('Aldi, London, England', 'Asda, London, England')"
+    """
+    return tuple(line.strip() for line in text.splitlines() if line.strip() != '')
+
+
 def get_desctiption(file='spendingtracker/cards/transactions.txt'):
     """
     Get a random description
     :param file: path to the description file
     :return: a description e.g. 'Subway, Nottingham, England'
     """
-    f = open(file, 'r')
-    data = []
-    try:
-        for line in f:                  # Read one line
-            line = line.strip('\n')     # Drop the last '\n'
-            line = line.strip()         # Drop space
-            if line == '':              # If there is empty line
-                continue
-            data += [line]
-    finally:
-        f.close()
-    return data[random.randint(0, len(data) - 1)]
+    return random.choice(tables.get(file, parse_descriptions).value)
+
+
+def get_matcher(file='spendingtracker/cards/description.txt'):
+    """
+    Get the matcher of the matching table, it is built again only when the table changes
+    :param file: relative path to the description.txt file
+    :return: Matcher
+    """
+    return tables.get(file, parse_matching_table).derive('matcher', lambda table: Matcher(table, get_similarity))
+
+
+def normalize_description(description):
+    """
+    Normalize a description before it's classified and cached
+    :param description: description of a transaction, e.g. " Tesco,  London "
+    :return: description without extra spaces, e.g. "Tesco, London"
+    """
+    return ' '.join(description.split())
+
+
+def get_merchant(description):
+    """
+    Get the merchant of a description, used as the key of category overrides
+    :param description: description of a transaction, e.g. "Tesco Metro, Nottingham, England"
+    :return: merchant in lower case, e.g. "tesco metro"
+    """
+    return normalize_description(description).split(',')[0].strip().lower()
 
 
-def classify_transaction(description):
+def classify_transaction(description, file='spendingtracker/cards/description.txt', overrides=None):
     """
     Automatically classify a transaction
+    If the user has chosen a category for the merchant, that category is used.
+    Otherwise the category is the one of the last rule in the matching table whose similarity is above 90.
+    Results are cached until the matching table changes.
     :param transaction: description of a transaction
+    :param overrides: the user's {merchant: category} index, see 'CategoryOverride.get_overrides()'
     :return: category e.g. 'food'
     """
-    table = read_matching_table()
-    max_similarity = 0
-    index = -1
-    for i in range(len(table)):
-        similarity = get_similarity(description, table[i][0])
-        if similarity > 90:
-            if max_similarity < similarity:
-                max_similarity = similarity
-            index = i
-    if index != -1:
-        # Return the category with highest similarity
-        return table[index][1]
+    if overrides and get_merchant(description) in overrides:
+        return overrides[get_merchant(description)]
+    description = normalize_description(description)
+    table = tables.get(file, parse_matching_table)
+    category = classification_cache.get(description, table.version)
+    if category is None:
+        category = get_matcher(file).classify(description)
+        classification_cache.set(description, category, table.version)
+    return category
+
+
+def init_classifier_worker(file):
+    """
+    Load the matching table and build the matcher when a worker process starts,
+    so it stays loaded for every chunk the worker classifies
+    :param file: relative path to the description.txt file
+    :return: None
+    """
+    get_matcher(file)
+
+
+def classify_chunk(descriptions, file='spendingtracker/cards/description.txt'):
+    """
+    Classify a list of descriptions in the current process
+    :param descriptions: list of descriptions
+    :param file: relative path to the description.txt file
+    :return: list of categories in the same order
+    """
+    matcher = get_matcher(file)
+    return [matcher.classify(description) for description in descriptions]
+
+
+def get_classifier_pool(file='spendingtracker/cards/description.txt'):
+    """
+    Get the worker processes used for large batches, they are created only once
+    :param file: relative path to the description.txt file
+    :return: ProcessPoolExecutor
+    """
+    global pool
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_classifier_worker, initargs=(file,))
+        atexit.register(pool.shutdown)
+    return pool
+
+
+def classify_transactions(descriptions, file='spendingtracker/cards/description.txt', overrides=None):
+    """
+    Classify many transactions at once, e.g. for imports and backfills
+    Every unique description is looked up in the cache or classified only once. Large batches
+    are split into chunks and classified by worker processes.
+    :param descriptions: list of descriptions
+    :param file: relative path to the description.txt file
+    :param overrides: the user's {merchant: category} index, see 'CategoryOverride.get_overrides()'
+    :return: list of categories in the same order as the descriptions, e.g. ['Food', 'General', 'Food']
+    """
+    descriptions = [normalize_description(description) for description in descriptions]
+    overrides = overrides or {}
+    results = {description: overrides[get_merchant(description)] for description in dict.fromkeys(descriptions)
+               if get_merchant(description) in overrides}
+    version = tables.get(file, parse_matching_table).version
+    results.update(classification_cache.get_many([description for description in dict.fromkeys(descriptions) if description not in results], version))
+    unique = [description for description in dict.fromkeys(descriptions) if description not in results]
+    if len(unique) < PARALLEL_THRESHOLD or os.cpu_count() == 1:
+        categories = classify_chunk(unique, file)
     else:
-        # If there is no optimal matching category
-        return 'General'
+        chunks = [unique[i:i + CHUNK_SIZE] for i in range(0, len(unique), CHUNK_SIZE)]
+        categories = []
+        for result in get_classifier_pool(file).map(classify_chunk, chunks, [file] * len(chunks)):
+            categories += result
+    classification_cache.set_many(dict(zip(unique, categories)), version)
+    results.update(zip(unique, categories))
+    return [results[description] for description in descriptions]
+
+
+def diff_matching_tables(old_table, new_table):
+    """
+    Find the rules that were added, removed, changed or moved between two versions of the matching table.
+    Rules that are unchanged and keep their order relative to each other are not returned.
+    :param old_table: the previous matching table, e.g. "(('Greggs', 'Food'), ('Tesco', 'Food'))"
+    :param new_table: the current matching table
+    :return: (indexes of changed rules in the old table, indexes of changed rules in the new table)
+    """
+    old_changed = set()
+    new_changed = set()
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_table, new_table, autojunk=False).get_opcodes():
+        if tag != 'equal':
+            old_changed.update(range(i1, i2))
+            new_changed.update(range(j1, j2))
+    return old_changed, new_changed
+
+
+def get_affected_descriptions(descriptions, old_table, file='spendingtracker/cards/description.txt'):
+    """
+    Find the descriptions whose category is different with the current matching table.
+    A description can only change category if one of the changed rules could score above 90 against it,
+    so only those descriptions are classified again.
+    :param descriptions: list of descriptions
+    :param old_table: the previous matching table, e.g. "(('Greggs', 'Food'), ('Tesco', 'Food'))"
+    :param file: relative path to the current description.txt file
+    :return: dict of description -> (old category, new category) for descriptions whose category changes
+    """
+    old_changed, new_changed = diff_matching_tables(old_table, read_matching_table(file))
+    if not old_changed and not new_changed:
+        return {}
+    old_matcher = Matcher(old_table, get_similarity)
+    new_matcher = get_matcher(file)
+    affected = []
+    for description in descriptions:
+        normalized = normalize_description(description)
+        if old_matcher.candidates(normalized) & old_changed or new_matcher.candidates(normalized) & new_changed:
+            affected.append(description)
+    results = {}
+    for description, new_category in zip(affected, classify_transactions(affected, file)):
+        old_category = old_matcher.classify(normalize_description(description))
+        if old_category != new_category:
+            results[description] = (old_category, new_category)
+    return results
 
 
 def currency_exchange(currency, amount):
@@ -166,45 +312,5 @@ def currency_exchange(currency, amount):
     return round(amount, 2)
 
 
-# Category budget feature:
-#   1. Checks if the user has set a budget on a category, if yes then go to step 2
-#   2. Checks if the monthly category spending has exceeded the budget, if yes then go to step 3
-#   3. Flash a message to the page to tell the user the spending is over the budget
-#   4. Checks if the user has opened the budget email service, if yes then go to step 5
-#   5. Create the email and send it to the user's email
-def category_budget(user, transaction):
-    #   0. Checks if the transaction is in this month
-    if transaction.timestamp.year != datetime.utcnow().year or transaction.timestamp.month != datetime.utcnow().month:
-        return
-    #   1. Checks if the user has set a budget on a category, if yes then go to step 2
-    spending_over_budget = False
-    target_categorybudget = None
-    spending = 0
-    for categorybudget in user.categorybudgets:
-        if transaction.category == categorybudget.category:
-            #   2. Checks if the monthly category spending has exceeded the budget, if yes then go to step 3
-            spending = get_category_monthly_spending(user, categorybudget.category)
-            budget = categorybudget.budget
-            print(f"Monthly spending: {spending}")
-            print(f"Monthly budget: {budget}")
-            if budget - spending < 0:
-                spending_over_budget = True
-                target_categorybudget = categorybudget
-            break
-    return (spending_over_budget, target_categorybudget, round(spending, 2))
-
-
-# Gets the monthly spendings within a specific category for a user
-# Inputs: user and category to check
-def get_category_monthly_spending(user, category):
-    # transactions = get_all_transactions(user, get_current_month_time(), datetime.utcnow())
-    transactions = get_all_transactions(user, get_current_month_time(), datetime(datetime.utcnow().year, datetime.utcnow().month + 1, 1, 0, 00, 00))
-    category_monthly_spending = 0
-    for transaction in transactions:
-        if transaction.category == category:
-            category_monthly_spending += transaction.amount
-    return category_monthly_spending
-
-
 def get_current_month_time():
     return datetime.strptime(f"{datetime.utcnow().year}-{datetime.utcnow().month}-1 00:00:00", "%Y-%m-%d %H:%M:%S")
\ No newline at end of file
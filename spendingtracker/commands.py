@@ -0,0 +1,245 @@
+import os, shutil
+from datetime import timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from spendingtracker import db
+from spendingtracker.models import Transaction, Spending, User, Card, CategoryOverride, ROLLUPS, bump_data_version
+from spendingtracker.main.utils import export_transactions, EXPORT_FORMATS
+from spendingtracker.cards.utils import parse_matching_table, get_affected_descriptions, get_merchant
+from spendingtracker.migrations import upgrade_database
+from spendingtracker.common.outbox import outbox_sender
+from spendingtracker.common.retention import apply_retention
+from spendingtracker.cards.imports import import_statement, get_import_format, IMPORT_FORMATS
+from spendingtracker.seed import seed_database
+
+
+# Number of rows changed per UPDATE/DELETE and commit
+CHUNK_SIZE = 500
+
+
+@click.command('reclassify')
+@click.option('--table', default='spendingtracker/cards/description.txt', help='The current matching table.')
+@click.option('--old', default=None, help='The previous matching table, defaults to the snapshot saved by the last run.')
+@click.option('--snapshot', default='spendingtracker/cards/description.applied.txt', help='Where the applied matching table is saved.')
+@with_appcontext
+def reclassify_command(table, old, snapshot):
+    """
+    Reclassify the transactions affected by changes to the matching table.
+    Only descriptions that a changed rule could match are classified again, and a transaction is only
+    updated if its category is still the one the previous table gave it and its user has no override for
+    the merchant, so categories users changed via '/change_category' are kept.
+    The first run without --old only saves the current table, the next run reclassifies the changes since.
+    """
+    if old is None and not os.path.exists(snapshot):
+        shutil.copyfile(table, snapshot)
+        click.echo(f"No previous matching table, {table} is saved to {snapshot}. The next run reclassifies the changes since.")
+        return
+    old = old or snapshot
+    if not os.path.exists(old):
+        click.echo(f"No previous matching table at {old}. Pass it with --old, e.g. from git history.")
+        return
+    with open(old, 'r') as f:
+        old_table = parse_matching_table(f.read())
+    descriptions = [row[0] for row in db.session.query(Transaction.description).distinct()]
+    affected = get_affected_descriptions(descriptions, old_table, table)
+    click.echo(f"{len(affected)} of {len(descriptions)} descriptions change category.")
+    # Group descriptions by (old category, new category) so each chunk is one UPDATE
+    changes = {}
+    for description, categories in affected.items():
+        changes.setdefault(categories, []).append(description)
+    updated = 0
+    for (old_category, new_category), descriptions in changes.items():
+        for i in range(0, len(descriptions), CHUNK_SIZE):
+            chunk = descriptions[i:i + CHUNK_SIZE]
+            # Descriptions with the same cards to skip are updated together, usually all of them skip none
+            groups = {}
+            for description, card_ids in get_override_cards(chunk).items():
+                groups.setdefault(card_ids, []).append(description)
+            connection = db.session.connection()
+            for card_ids, group in groups.items():
+                # Bulk updates skip the ORM events, move the spending rollups to the new category first
+                where = 't.description IN :descriptions AND t.category = :old_category'
+                params = {'descriptions': tuple(group), 'old_category': old_category}
+                query = Transaction.query.filter(Transaction.description.in_(group), Transaction.category == old_category)
+                if card_ids:
+                    where += ' AND t.card_id NOT IN :card_ids'
+                    params['card_ids'] = card_ids
+                    query = query.filter(~Transaction.card_id.in_(card_ids))
+                for rollup in ROLLUPS:
+                    rollup.add_transactions(connection, where, params, sign=-1)
+                    rollup.add_transactions(connection, where, params, category=new_category)
+                updated += query.update({Transaction.category: new_category}, synchronize_session=False)
+            db.session.commit()
+    if updated:
+        # Cached reports may count the old categories
+        bump_data_version(db.session.connection(), None)
+        db.session.commit()
+    shutil.copyfile(table, snapshot)
+    click.echo(f"{updated} transactions reclassified. Matching table saved to {snapshot}.")
+
+
+def get_override_cards(descriptions):
+    """
+    Get the cards whose transactions keep their category because the card's user has an override for the merchant
+    :param descriptions: list of descriptions
+    :return: dict of description -> sorted tuple of card ids, an empty tuple if no user has an override
+    """
+    merchants = {description: get_merchant(description) for description in descriptions}
+    cards = {}
+    for merchant, card_id in db.session.query(CategoryOverride.merchant, Card.id).join(Card, Card.user_id == CategoryOverride.user_id)\
+            .filter(CategoryOverride.merchant.in_(set(merchants.values()))):
+        cards.setdefault(merchant, set()).add(card_id)
+    return {description: tuple(sorted(cards.get(merchant, ()))) for description, merchant in merchants.items()}
+
+
+@click.command('upgrade-db')
+@with_appcontext
+def upgrade_db_command():
+    """
+    Create missing tables and upgrade the database schema to the latest version.
+    """
+    old_version, new_version = upgrade_database()
+    if old_version == new_version:
+        click.echo(f"Database is up to date (version {new_version}).")
+    else:
+        click.echo(f"Database upgraded from version {old_version} to {new_version}.")
+
+
+@click.command('rebuild-rollups')
+@with_appcontext
+def rebuild_rollups_command():
+    """
+    Compute the monthly and daily spending rollups again from all transactions.
+    They are normally kept up to date incrementally, run this to repair them.
+    """
+    with db.engine.begin() as connection:
+        for rollup in ROLLUPS:
+            rollup.rebuild(connection)
+            count = connection.execute(f'SELECT COUNT(*) FROM {rollup.__tablename__}').scalar()
+            click.echo(f"{rollup.__tablename__}: {count} rows.")
+
+
+@click.command('reconcile-spending')
+@click.option('--email', default=None, help='Only reconcile this user.')
+@with_appcontext
+def reconcile_spending_command(email):
+    """
+    Compute every user's total spending of this month again from their transactions.
+    The totals are normally kept up to date incrementally, run this on demand or on a schedule to repair them.
+    """
+    query = Spending.query.order_by(Spending.id)
+    if email is not None:
+        query = query.join(User).filter(User.email == email)
+    last_id = 0
+    count = 0
+    while True:
+        spendings = query.filter(Spending.id > last_id).limit(CHUNK_SIZE).all()
+        if not spendings:
+            break
+        for spending in spendings:
+            spending.reconcile()
+        db.session.commit()
+        last_id = spendings[-1].id
+        count += len(spendings)
+    click.echo(f"{count} spending totals reconciled.")
+
+
+@click.command('export')
+@click.argument('email')
+@click.option('--format', 'format', type=click.Choice(list(EXPORT_FORMATS)), default='ndjson', help='Output format.')
+@click.option('--start', type=click.DateTime(['%Y-%m-%d']), default=None, help='Only transactions on or after this date.')
+@click.option('--end', type=click.DateTime(['%Y-%m-%d']), default=None, help='Only transactions on or before this date.')
+@click.option('--card', 'card_id', type=int, default=None, help='Only transactions of this card id.')
+@click.option('--output', type=click.File('w'), default='-', help='Output file, defaults to stdout.')
+@with_appcontext
+def export_command(email, format, start, end, card_id, output):
+    """
+    Export a user's transactions as NDJSON or CSV, streamed chunk by chunk.
+    """
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        raise click.ClickException(f"No user with email {email}.")
+    # Up to the end of the last day, timestamps have microseconds
+    end_date = end + timedelta(days=1) if end is not None else None
+    for chunk in export_transactions(user, format, start_date=start, end_date=end_date, card_id=card_id, chunk_size=CHUNK_SIZE):
+        output.write(chunk)
+
+
+@click.command('drain-outbox')
+@with_appcontext
+def drain_outbox_command():
+    """
+    Send every due email in the outbox now, e.g. from cron or against a local SMTP server:
+        python -m smtpd -n -c DebuggingServer localhost:1025
+    with MAIL_SERVER = 'localhost', MAIL_PORT = 1025, MAIL_USE_TLS = False and MAIL_USERNAME = None.
+    """
+    sent, failed = outbox_sender.drain()
+    click.echo(f"{sent} emails sent, {failed} failed. {outbox_sender.get_stats()['pending']} emails waiting.")
+
+
+@click.command('prune')
+@click.option('--archive', 'archive_dir', type=click.Path(file_okay=False, writable=True), default=None,
+              help='Append the deleted rows to <table>.ndjson in this directory.')
+@click.option('--no-vacuum', is_flag=True, help="Don't run VACUUM and ANALYZE afterwards.")
+@with_appcontext
+def prune_command(archive_dir, no_vacuum):
+    """
+    Delete inbox messages and login logs older than the retention limits in the config, or beyond the number
+    kept per user, in small chunks. Then VACUUM and ANALYZE the database. Run it from cron, e.g. once a night.
+    """
+    if archive_dir is not None:
+        os.makedirs(archive_dir, exist_ok=True)
+    result = apply_retention(archive_dir, compact=not no_vacuum)
+    for table, count in result.items():
+        click.echo(f"{table}: {count} rows deleted.")
+
+
+@click.command('import-transactions')
+@click.argument('email')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--card', 'card_id', type=int, default=None, help='Card id of records without a card field.')
+@click.option('--format', 'format', type=click.Choice(list(IMPORT_FORMATS)), default=None, help='Input format, defaults to the file extension.')
+@with_appcontext
+def import_transactions_command(email, path, card_id, format):
+    """
+    Import a CSV or NDJSON statement (e.g. the output of 'flask export') into a user's cards.
+    The file is parsed while it's read and inserted in chunks, transactions already in the db are skipped.
+    """
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        raise click.ClickException(f"No user with email {email}.")
+    format = format or get_import_format(path)
+    if format is None:
+        raise click.ClickException("Unknown file extension, pass --format.")
+    with open(path, 'r', encoding='utf-8-sig', newline='') as file:
+        result = import_statement(user, file, format, card_id=card_id, chunk_size=current_app.config['IMPORT_CHUNK_SIZE'])
+    for error in result['errors']:
+        click.echo(error)
+    if result['stopped']:
+        click.echo(f"Import stopped: {result['stopped']}")
+    click.echo(f"{result['imported']} transactions imported, {result['duplicates']} duplicates skipped, "
+               f"{result['insufficient_funds']} rejected for insufficient funds, {result['invalid']} invalid rows.")
+
+
+@click.command('seed')
+@click.option('--users', type=click.IntRange(1), default=100, help='Number of users.')
+@click.option('--cards', type=click.IntRange(1), default=3, help='Number of cards per user.')
+@click.option('--transactions', type=click.IntRange(1), default=100, help='Number of transactions per card.')
+@click.option('--months', type=click.IntRange(1), default=12, help='Spread the transactions over this many months.')
+@click.option('--seed', type=int, default=0, help='Seed of the random generator, the same seed gives the same data.')
+@click.option('--password', default='password', help='Password of the new users.')
+@click.option('--end-date', type=click.DateTime(['%Y-%m-%d']), default=None,
+              help='Transactions are before this date, defaults to today. Pass it to get the same data on another day.')
+@with_appcontext
+def seed_command(users, cards, transactions, months, seed, password, end_date):
+    """
+    Add synthetic users, cards and transactions for load and scale testing, e.g. 10M transactions:
+        flask seed --users 20000 --cards 5 --transactions 100
+    Existing data is kept. The same options give the same data, but emails, account numbers and UUIDs contain
+    the row ids, which only match on the same (e.g. an empty) database.
+    Don't run it against a production database, the file isn't synced to disk while it runs.
+    """
+    users, cards, transactions = seed_database(users, cards, transactions, months=months, seed=seed, password=password,
+                                               end_date=end_date)
+    click.echo(f"{users} users, {cards} cards and {transactions} transactions added.")
@@ -0,0 +1,113 @@
+import threading, time
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a service whose circuit breaker is open
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service (e.g. the SMTP server) for a while, so callers fail fast instead of waiting for timeouts.
+        1. closed: calls go through, 'failures' consecutive failures open the circuit
+        2. open: calls fail at once with CircuitOpenError for 'cooldown' seconds
+        3. half-open: after the cooldown one call is let through as a probe, it closes the circuit if it
+           succeeds and opens it again if it fails
+    Use it as a context manager around a call: "with mail_breaker: ..."
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failures=5, cooldown=60):
+        """
+        :param name: name of the service, e.g. 'mail'
+        :param failures: consecutive failures that open the circuit
+        :param cooldown: seconds the circuit stays open before a probe
+        """
+        self.name = name
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.calls = 0
+        self.rejected = 0
+        self.total_failures = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def configure(self, failures, cooldown):
+        with self._lock:
+            self.failures = failures
+            self.cooldown = cooldown
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def is_available(self):
+        """
+        :return: False if calls would be rejected right now
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.monotonic() - self.opened_at >= self.cooldown
+            return not (self.state == self.HALF_OPEN and self._probing)
+
+    def __enter__(self):
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                print(f"Circuit breaker '{self.name}' is half-open, probing the service...")
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self._probing):
+                self.rejected += 1
+                raise CircuitOpenError(f"The {self.name} service is unavailable, try again later.")
+            if self.state == self.HALF_OPEN:
+                self._probing = True
+            self.calls += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        with self._lock:
+            self._probing = False
+            if exc_type is None:
+                if self.state != self.CLOSED:
+                    print(f"Circuit breaker '{self.name}' is closed, the service is back.")
+                self.state = self.CLOSED
+                self.consecutive_failures = 0
+                return False
+            self.total_failures += 1
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failures:
+                if self.state != self.OPEN:
+                    print(f"Circuit breaker '{self.name}' is open after {self.consecutive_failures} failures: {exc_value}")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+        # Never swallow the exception
+        return False
+
+    def get_stats(self):
+        """
+        Get the state of the breaker in this process
+        :return: dict, e.g. "{'state': 'open', 'consecutive_failures': 5, 'retry_in': 42.0, ...}"
+        """
+        with self._lock:
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = round(max(0, self.cooldown - (time.monotonic() - self.opened_at)), 1)
+            return {
+                'name': self.name,
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'total_failures': self.total_failures,
+                'calls': self.calls,
+                'rejected': self.rejected,
+                'retry_in': retry_in,
+            }
+
+
+mail_breaker = CircuitBreaker('mail')
@@ -0,0 +1,90 @@
+from datetime import datetime
+from flask import current_app
+from spendingtracker import db
+from spendingtracker.models import User, MonthlySpending
+
+
+# Alert levels of a budget
+SAFE = 0
+CLOSE = 1
+OVER = 2
+
+
+def get_alert_level(spending, budget, alerted, close_margin=None, rearm_margin=0):
+    """
+    Get the alert level of a budget, with hysteresis: a level that has been alerted is kept until the spending
+    falls 'rearm_margin' below its threshold, so spending around a threshold doesn't alert again and again
+    :param spending: spending of this month
+    :param budget: budget of this month
+    :param alerted: highest level already alerted this month
+    :param close_margin: spending within this much of the budget is 'CLOSE', None if the budget has no 'CLOSE' level
+    :param rearm_margin: how far the spending must fall below a threshold before it can alert again
+    :return: SAFE, CLOSE or OVER
+    """
+    thresholds = {OVER: budget}
+    if close_margin is not None:
+        thresholds[CLOSE] = budget - close_margin
+    level = SAFE
+    if spending > budget:
+        level = OVER
+    elif close_margin is not None and spending >= thresholds[CLOSE]:
+        level = CLOSE
+    while alerted > level:
+        if alerted in thresholds and spending > thresholds[alerted] - rearm_margin:
+            return alerted
+        alerted -= 1
+    return level
+
+
+def evaluate_budgets(user, transaction, version):
+    """
+    Check the overall budget and every category budget of the user after a new transaction, in one pass.
+    The spending of each category budget is a running total of this month: the new transaction is added to it,
+    unless something else changed the user's data since the last evaluation (e.g. a category was changed or a
+    card was removed), then the totals are read again from 'monthly_spending'.
+    Each level of a budget is alerted once per month, see 'get_alert_level()'.
+    Nothing is committed: the alert levels are saved with the caller's commit, together with the transaction.
+    :param user: user
+    :param transaction: the new transaction, added to the session
+    :param version: 'user.data_version' before the transaction was added
+    :return: list of new alerts (categorybudget, level, spending), categorybudget is None for the overall budget
+    """
+    config = current_app.config
+    # Inserting the transaction updates the rollups and 'data_version' in the db
+    db.session.flush()
+    state = user.spending
+    state.roll_over()
+    period = state.period
+    if state.alert_period != period:
+        # A new month, every budget can alert again
+        state.alert_period = period
+        state.alert_level = SAFE
+        state.budget_version = None
+        for categorybudget in user.categorybudgets:
+            categorybudget.alert_level = SAFE
+    if state.budget_version != version:
+        now = datetime.utcnow()
+        totals = dict(db.session.query(MonthlySpending.category, db.func.sum(MonthlySpending.amount))
+                      .filter_by(user_id=user.id, year=now.year, month=now.month).group_by(MonthlySpending.category))
+        for categorybudget in user.categorybudgets:
+            categorybudget.spending = round(totals.get(categorybudget.category) or 0, 2)
+    elif transaction.timestamp.strftime('%Y-%m') == period:
+        for categorybudget in user.categorybudgets:
+            if categorybudget.category == transaction.category:
+                categorybudget.spending = round(categorybudget.spending + transaction.amount, 2)
+    alerts = []
+    if state.budget is not None:
+        level = get_alert_level(state.totalAccountSpending, state.budget, state.alert_level,
+                                config['BUDGET_CLOSE_MARGIN'], config['BUDGET_REARM_MARGIN'])
+        if level > state.alert_level:
+            alerts.append((None, level, state.totalAccountSpending))
+        state.alert_level = level
+    for categorybudget in user.categorybudgets:
+        level = get_alert_level(categorybudget.spending, categorybudget.budget, categorybudget.alert_level,
+                                rearm_margin=config['BUDGET_REARM_MARGIN'])
+        if level > categorybudget.alert_level:
+            alerts.append((categorybudget, level, categorybudget.spending))
+        categorybudget.alert_level = level
+    # The evaluation itself doesn't change 'data_version'
+    state.budget_version = db.session.query(User.data_version).filter_by(id=user.id).scalar()
+    return alerts
@@ -1,7 +1,7 @@
 from flask import url_for
 from flask_mail import Message
 from spendingtracker.main import utils
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
 def reset_email(user):
@@ -131,18 +131,19 @@ def report_email(user, start_date, end_date):
     Create a email report for the user.
     The email contains a report.
     :param user:
+    :param start_date: datetime, the first day
+    :param end_date: datetime, the day after the last day
     :return: email message
     """
     email_address = user.email
     msg = Message('Your Report is here', sender='noreply@gmail.com', recipients=[email_address])
-    print("Trying to fetch all valid transactions...")
-    transactions = utils.get_all_transactions(user, start_date, end_date)
-    print("Transactions are fetched!")
     print("Trying to get all required data...")
-    total_balance = utils.get_all_balance(user)
-    total_spending = utils.get_total_spending(transactions)
-    weekday_list = utils.get_weekday_spending(transactions)
-    categories_list = utils.get_all_categories(transactions)
+    # Cached until the user's transactions or cards change
+    report = utils.get_report(user, start_date, end_date)
+    total_balance = report['total_balance']
+    total_spending = report['total_spending']
+    weekday_list = report['weekday_list']
+    categories_list = report['categories_list']
     print("Required data are got!")
     print("Trying to construct report content...")
     msg.html = f"""
@@ -156,7 +157,7 @@ def report_email(user, start_date, end_date):
         </header>
         <p class="lead" style="text-color:black;">
             <p style="font-weight:bold;">{user.firstname} {user.lastname}<p>
-            Date: from {start_date} to {end_date}
+            Date: from {start_date:%Y-%m-%d} to {end_date - timedelta(days=1):%Y-%m-%d}
             <br><br>
             <p style="font-weight:bold;">Overview<p>
             Total expenditures: £{round(total_spending, 2)}
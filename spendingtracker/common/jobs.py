@@ -0,0 +1,100 @@
+import queue, threading, traceback
+from flask import request, has_request_context
+
+
+class JobQueue:
+    """
+    In-process queue of background jobs, e.g. report emails, run by a pool of worker threads.
+    Jobs run inside a request context made for the URL of the request that enqueued them, so they can use the db
+    and 'url_for(_external=True)' in emails, but the user isn't waiting: results reach the user through
+    'flash_message()' (the inbox).
+    Jobs that haven't run yet are lost if the process stops.
+    """
+
+    def __init__(self, workers=2, size=100):
+        """
+        :param workers: number of worker threads, 0 runs jobs in the caller's thread (e.g. for testing)
+        :param size: maximum number of waiting jobs, 0 for no limit
+        """
+        self.app = None
+        self.workers = workers
+        self.size = size
+        self.done = 0
+        self.failed = 0
+        self.running = 0
+        self._queue = queue.Queue(size)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config['JOB_QUEUE_WORKERS']
+        self.size = app.config['JOB_QUEUE_SIZE']
+        self._queue = queue.Queue(self.size)
+        self._threads = []
+
+    def _start(self):
+        # Threads are started by the first job, so processes forked after 'create_app()' (gunicorn) start their own
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name=f'job-worker-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def enqueue(self, function, *args, **kwargs):
+        """
+        Add a job to the queue and return immediately
+        :param function: function to run, it should take ids rather than db objects, e.g. 'user_id'
+        :param args: positional arguments of the function
+        :param kwargs: keyword arguments of the function
+        :return: None
+        :raise queue.Full: if 'size' jobs are already waiting
+        """
+        base_url = request.host_url if has_request_context() else None
+        if self.workers == 0:
+            self._run(function, args, kwargs, base_url)
+            return
+        self._queue.put_nowait((function, args, kwargs, base_url))
+        self._start()
+
+    def _work(self):
+        while True:
+            function, args, kwargs, base_url = self._queue.get()
+            try:
+                self._run(function, args, kwargs, base_url)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, function, args, kwargs, base_url):
+        with self._lock:
+            self.running += 1
+        try:
+            context = self.app.test_request_context(base_url=base_url) if base_url else self.app.app_context()
+            with context:
+                function(*args, **kwargs)
+            with self._lock:
+                self.done += 1
+        except Exception:
+            traceback.print_exc()
+            with self._lock:
+                self.failed += 1
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def get_stats(self):
+        """
+        Get the state of the queue in this process
+        :return: dict, e.g. "{'workers': 2, 'depth': 3, 'running': 2, 'done': 10, 'failed': 0}"
+        """
+        return {
+            'workers': self.workers,
+            'depth': self._queue.qsize(),
+            'running': self.running,
+            'done': self.done,
+            'failed': self.failed,
+        }
+
+
+job_queue = JobQueue()
@@ -0,0 +1,47 @@
+import smtplib
+from flask import current_app
+from flask_mail import Connection
+from spendingtracker.common.breaker import mail_breaker
+
+
+class TimeoutConnection(Connection):
+    """
+    Flask-Mail connection with the timeouts from the config:
+        1. MAIL_CONNECT_TIMEOUT: seconds to connect, start TLS and log in
+        2. MAIL_SEND_TIMEOUT: seconds each SMTP command of a send may take
+    Flask-Mail itself waits on the socket forever.
+    """
+
+    def configure_host(self):
+        config = current_app.config
+        if self.mail.use_ssl:
+            host = smtplib.SMTP_SSL(self.mail.server, self.mail.port, timeout=config['MAIL_CONNECT_TIMEOUT'])
+        else:
+            host = smtplib.SMTP(self.mail.server, self.mail.port, timeout=config['MAIL_CONNECT_TIMEOUT'])
+        host.set_debuglevel(int(self.mail.debug))
+        if self.mail.use_tls:
+            host.starttls()
+        if self.mail.username and self.mail.password:
+            host.login(self.mail.username, self.mail.password)
+        host.sock.settimeout(config['MAIL_SEND_TIMEOUT'])
+        return host
+
+
+def connect():
+    """
+    Open a connection to the mail server configured by 'mail.init_app()', use it with "with mail_breaker: with connect() as connection: ..."
+    :return: TimeoutConnection
+    """
+    return TimeoutConnection(current_app.extensions['mail'])
+
+
+def send_email(msg):
+    """
+    Send one email now, like 'mail.send()' but with timeouts and the circuit breaker
+    :param msg: flask_mail Message
+    :return: None
+    :raise CircuitOpenError: if the mail server failed recently, without trying to connect
+    """
+    with mail_breaker:
+        with connect() as connection:
+            connection.send(msg)
@@ -0,0 +1,189 @@
+import threading, traceback
+from datetime import datetime, timedelta
+from flask_mail import Message
+from sqlalchemy import event
+from spendingtracker import db
+from spendingtracker.common.breaker import mail_breaker, CircuitOpenError
+from spendingtracker.common.mailer import connect
+from spendingtracker.models import OutboxEmail
+
+
+def queue_email(msg):
+    """
+    Save an email to the outbox instead of sending it in the request, 'outbox_sender' sends it in the background.
+    The email is only added to the session, it's saved with the caller's next commit and sent after it.
+    :param msg: flask_mail Message, e.g. from 'emails.budget_over_email()'
+    :return: OutboxEmail
+    """
+    email = OutboxEmail(subject=msg.subject, sender=msg.sender, recipients=','.join(msg.recipients), body=msg.body, html=msg.html)
+    db.session.add(email)
+    db.session.info['outbox_queued'] = True
+    return email
+
+
+class OutboxSender:
+    """
+    Sends the emails saved in the 'outbox' table.
+        1. Due emails are sent in batches, every batch over one SMTP connection ('mailer.connect()')
+        2. An email that fails is retried later, the delay doubles after every failure
+        3. Emails are only marked as sent in the db, so emails left by a stopped process are sent after a restart
+        4. Emails are reserved for 'OUTBOX_LEASE' seconds before they are sent, so processes don't send the same email
+        5. While 'mail_breaker' is open nothing is sent and the emails wait without using up their attempts
+    Each process runs it in a background thread, 'flask drain-outbox' runs it once.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.sent = 0
+        self.failed = 0
+        self.sessions = 0
+        self._event = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self._thread = None
+        # Emails queued before a restart are sent when the app gets its first request
+        app.before_first_request(self.wake)
+
+    def wake(self):
+        """
+        Tell the background thread that there are emails to send
+        :return: None
+        """
+        if not self.app.config['OUTBOX_SENDER_THREAD']:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._work, name='outbox-sender', daemon=True)
+                self._thread.start()
+        self._event.set()
+
+    def _work(self):
+        while True:
+            self._event.wait(self.app.config['OUTBOX_POLL_INTERVAL'])
+            self._event.clear()
+            try:
+                with self.app.app_context():
+                    self.drain()
+            except Exception:
+                traceback.print_exc()
+
+    def drain(self):
+        """
+        Send due emails until there are none left, must be called within an app context
+        :return: (number of emails sent, number of failed attempts)
+        """
+        sent, failed = 0, 0
+        while mail_breaker.is_available():
+            emails = self._claim()
+            if not emails:
+                break
+            batch_sent, batch_failed, connected = self._send(emails)
+            sent += batch_sent
+            failed += batch_failed
+            if not connected:
+                # The server can't be reached, the emails wait for their next attempt
+                break
+        return sent, failed
+
+    def _claim(self):
+        # Reserve a batch of due emails for this process
+        config = self.app.config
+        now = datetime.utcnow()
+        ids = [id for (id,) in db.session.query(OutboxEmail.id).filter(OutboxEmail.sent == None, OutboxEmail.next_attempt <= now)
+               .order_by(OutboxEmail.next_attempt).limit(config['OUTBOX_BATCH_SIZE'])]
+        if not ids:
+            return []
+        lease = now + timedelta(seconds=config['OUTBOX_LEASE'])
+        OutboxEmail.query.filter(OutboxEmail.id.in_(ids), OutboxEmail.sent == None, OutboxEmail.next_attempt <= now)\
+            .update({OutboxEmail.next_attempt: lease}, synchronize_session=False)
+        db.session.commit()
+        # Emails another process reserved first have a different lease
+        return OutboxEmail.query.filter(OutboxEmail.id.in_(ids), OutboxEmail.next_attempt == lease).order_by(OutboxEmail.id).all()
+
+    def _send(self, emails):
+        # Send a batch over one connection, returns (sent, failed, whether the connection was made)
+        sent = 0
+        current = None
+        try:
+            with mail_breaker, connect() as connection:
+                with self._lock:
+                    self.sessions += 1
+                for current in emails:
+                    connection.send(Message(current.subject, sender=current.sender, recipients=current.recipients.split(','),
+                                            body=current.body, html=current.html))
+                    current.sent = datetime.utcnow()
+                    current.attempts += 1
+                    current.error = None
+                    db.session.commit()
+                    sent += 1
+        except CircuitOpenError:
+            # Another thread opened the breaker, the emails are sent after the cooldown
+            for email in emails:
+                email.next_attempt = datetime.utcnow()
+            db.session.commit()
+            return 0, 0, False
+        except Exception as e:
+            traceback.print_exc()
+            if current is None:
+                # Couldn't connect: the whole batch failed
+                failed = emails
+            elif current.sent is not None:
+                # Every email was sent, only closing the connection failed
+                failed = []
+            else:
+                # The connection may be broken after an error, the rest of the batch is sent again with a new connection
+                failed = [current]
+                for email in emails:
+                    if email.sent is None and email is not current:
+                        email.next_attempt = datetime.utcnow()
+            for email in failed:
+                self._retry(email, e)
+            db.session.commit()
+            with self._lock:
+                self.sent += sent
+                self.failed += len(failed)
+            return sent, len(failed), current is not None
+        with self._lock:
+            self.sent += sent
+        return sent, 0, True
+
+    def _retry(self, email, error):
+        config = self.app.config
+        email.attempts += 1
+        email.error = str(error)[:500]
+        if email.attempts >= config['OUTBOX_MAX_ATTEMPTS']:
+            # Give up
+            email.next_attempt = None
+        else:
+            delay = min(config['OUTBOX_RETRY_DELAY'] * 2 ** (email.attempts - 1), config['OUTBOX_MAX_RETRY_DELAY'])
+            email.next_attempt = datetime.utcnow() + timedelta(seconds=delay)
+
+    def get_stats(self):
+        """
+        Get counters of this process and the number of unsent emails
+        :return: dict, e.g. "{'sent': 10, 'failed': 1, 'sessions': 2, 'pending': 0}"
+        """
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'sessions': self.sessions,
+            'pending': OutboxEmail.query.filter(OutboxEmail.sent == None, OutboxEmail.next_attempt != None).count(),
+        }
+
+
+outbox_sender = OutboxSender()
+
+
+@event.listens_for(db.session, 'after_commit')
+def wake_outbox_sender(session):
+    # The queued emails are in the db now, the sender can see them
+    if session.info.pop('outbox_queued', False):
+        outbox_sender.wake()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_queued_emails(session):
+    session.info.pop('outbox_queued', None)
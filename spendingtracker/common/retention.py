@@ -0,0 +1,139 @@
+import os
+from datetime import datetime, timedelta
+from flask import current_app
+from spendingtracker import db
+from spendingtracker.models import Message, Log
+from spendingtracker.common.serializers import message_serializer, log_serializer, dumps
+
+
+class RetentionPolicy:
+    """
+    Deletes old rows of a per-user table in small chunks, one commit per chunk so other requests can write in between.
+        1. Rows older than 'max_age' days are deleted
+        2. Only the newest 'max_per_user' rows of each user are kept
+    Deleted rows can be archived first, as NDJSON lines of the table's serializer.
+    """
+
+    def __init__(self, model, serializer, time, order, max_age_key, max_per_user_key):
+        """
+        :param model: model of the table, it must have 'id' and 'user_id'
+        :param serializer: RowSerializer of archived rows
+        :param time: column of the time a row was written
+        :param order: newest-first order of a user's rows
+        :param max_age_key: config key of the maximum age in days
+        :param max_per_user_key: config key of the maximum number of rows per user
+        """
+        self.model = model
+        self.serializer = serializer
+        self.time = time
+        self.order = order
+        self.max_age_key = max_age_key
+        self.max_per_user_key = max_per_user_key
+
+    @property
+    def name(self):
+        return self.model.__tablename__
+
+    def get_cutoff(self, max_age):
+        cutoff = datetime.utcnow() - timedelta(days=max_age)
+        # 'Log.login' is saved as a "%Y-%m-%d %H:%M:%S" string
+        if isinstance(self.time.type, db.String):
+            return cutoff.strftime("%Y-%m-%d %H:%M:%S")
+        return cutoff
+
+    def prune(self, max_age=None, max_per_user=None, chunk_size=500, archive=None):
+        """
+        Delete the rows the policy doesn't keep, must be called within an app context
+        :param max_age: maximum age in days, None for no limit
+        :param max_per_user: maximum number of rows per user, None for no limit
+        :param chunk_size: number of rows deleted per commit
+        :param archive: file the deleted rows are appended to, None to only delete them
+        :return: number of deleted rows
+        """
+        model = self.model
+        deleted = 0
+        if max_age is not None:
+            cutoff = self.get_cutoff(max_age)
+            while True:
+                # Old rows have the lowest ids, so the scan stops soon after the first chunk_size matches
+                ids = [id for (id,) in db.session.query(model.id).filter(self.time < cutoff).order_by(model.id).limit(chunk_size)]
+                if not ids:
+                    break
+                deleted += self.delete(ids, archive)
+        if max_per_user is not None:
+            user_ids = [user_id for (user_id,) in db.session.query(model.user_id).group_by(model.user_id)
+                        .having(db.func.count(model.id) > max_per_user)]
+            for user_id in user_ids:
+                while True:
+                    ids = [id for (id,) in db.session.query(model.id).filter(model.user_id == user_id).order_by(*self.order)
+                           .offset(max_per_user).limit(chunk_size)]
+                    if not ids:
+                        break
+                    deleted += self.delete(ids, archive)
+        return deleted
+
+    def delete(self, ids, archive=None):
+        """
+        Archive and delete rows in one commit
+        :param ids: ids of the rows
+        :param archive: file the rows are appended to, or None
+        :return: number of deleted rows
+        """
+        model = self.model
+        if archive is not None:
+            rows = self.serializer.dump(self.serializer.query().filter(model.id.in_(ids)).order_by(model.id))
+            archive.write(''.join(dumps(row) + '\n' for row in rows))
+            # The rows are in the archive before they leave the db
+            archive.flush()
+            os.fsync(archive.fileno())
+        if model is Message:
+            # Deleted unread messages don't count as unread any more
+            unread = db.session.query(Message.user_id, db.func.count(Message.id))\
+                .filter(Message.id.in_(ids), Message.read == False).group_by(Message.user_id).all()
+            if unread:
+                Message.add_unread(db.session.connection(), {user_id: -count for user_id, count in unread})
+        count = model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+
+POLICIES = [
+    RetentionPolicy(Message, message_serializer, Message.timestamp, (Message.timestamp.desc(), Message.id.desc()),
+                    'MESSAGE_RETENTION_DAYS', 'MESSAGE_MAX_PER_USER'),
+    RetentionPolicy(Log, log_serializer, Log.login, (Log.id.desc(),), 'LOG_RETENTION_DAYS', 'LOG_MAX_PER_USER'),
+]
+
+
+def compact_database():
+    """
+    Give the space of deleted rows back to the file system and update the query planner's statistics.
+    VACUUM rewrites the whole database file and blocks writers while it runs.
+    :return: None
+    """
+    db.session.commit()
+    db.engine.execute('VACUUM')
+    db.engine.execute('ANALYZE')
+
+
+def apply_retention(archive_dir=None, compact=True):
+    """
+    Apply every retention policy with the limits from the config, e.g. from 'flask prune' or as a background job:
+    "job_queue.enqueue(apply_retention)"
+    :param archive_dir: directory where deleted rows are appended to '<table>.ndjson', None to only delete them
+    :param compact: run VACUUM and ANALYZE afterwards if anything was deleted
+    :return: dict of table name -> number of deleted rows
+    """
+    config = current_app.config
+    result = {}
+    for policy in POLICIES:
+        archive = open(os.path.join(archive_dir, f'{policy.name}.ndjson'), 'a') if archive_dir is not None else None
+        try:
+            result[policy.name] = policy.prune(config[policy.max_age_key], config[policy.max_per_user_key],
+                                               config['RETENTION_CHUNK_SIZE'], archive)
+        finally:
+            if archive is not None:
+                archive.close()
+        print(f"Retention: {result[policy.name]} rows deleted from '{policy.name}'")
+    if compact and any(result.values()):
+        compact_database()
+    return result
@@ -1,6 +1,9 @@
-from spendingtracker import mail
-from spendingtracker.common import emails
+from spendingtracker.common import emails, budgets
+from spendingtracker.common.breaker import CircuitOpenError
+from spendingtracker.common.mailer import send_email
 from spendingtracker.common.utils import flash_message
+from spendingtracker.common.outbox import queue_email
+from spendingtracker.models import User
 import traceback
 from flask import flash
 
@@ -12,30 +15,27 @@ def send_reset_email(user):
     :return: None
     """
     msg = emails.reset_email(user)
-    try:
-        mail.send(msg)
-    except Exception as e:
-        traceback.print_exc()
+    queue_email(msg)
 
 
-def send_budget_email(user):
+def send_budget_email(user, level):
     """
     Send budget emails.
     To run this method, user' email setting should be on.
-    Check if the user spending is over budget; check if the user spending is close to budget (difference <= 50)
+    The level comes from the budget evaluator, which alerts each level once per month (see 'common/budgets.py')
     :param user: user
+    :param level: budgets.OVER if the spending is over budget, budgets.CLOSE if it is close to budget (difference <= 50)
     :return: None
     """
     msg = None
-    # total_spending = utils.get_total_spending(utils.get_all_transactions(user))
     print(f"Total spending: {user.spending.totalAccountSpending}; budget: {user.spending.budget}")
-    if user.spending.budget - user.spending.totalAccountSpending < 0:
+    if level == budgets.OVER:
         print(f"Total spending is over budget")
         print("Constructing the email...")
         msg = emails.budget_over_email(user)
         print("Email is constructed!")
-    elif user.spending.budget - user.spending.totalAccountSpending <= 50:
-        print(f"Total spending is close to budget (difference: {user.spending.budget - user.spending.totalAccountSpending} is <= 50)")
+    elif level == budgets.CLOSE:
+        print(f"Total spending is close to budget (difference: {user.spending.budget - user.spending.totalAccountSpending})")
         print("Constructing the 'budget_close_email'...")
         msg = emails.budget_close_email(user)
         print("'budget_close_email' is constructed!")
@@ -43,8 +43,8 @@ def send_budget_email(user):
         print("User's spending is safe, no email will be sent!")
     if msg != None:
         print("Trying to send 'budget_close_email'...")
-        mail.send(msg)
-        print("'budget_close_email' is sent successfully!")
+        queue_email(msg)
+        print("'budget_close_email' is queued successfully!")
 
 
 
@@ -65,51 +65,30 @@ def send_balance_email(user, card):
         print("User has sufficient balance, no email will be sent!")
     if msg != None:
         print("Trying to send 'balance_close_email'...")
-        mail.send(msg)
-        print("'balance_close_email' is sent successfully!")
+        queue_email(msg)
+        print("'balance_close_email' is queued successfully!")
 
 
 # printing messages in terminal for debugging purposes
-def emails_check(user, card):
+# 'budget_level' is the new alert level of the overall budget, or None if there is nothing new to alert
+# The emails are only queued in the session, they are saved with the caller's commit
+def emails_check(user, card, budget_level=None):
     print("************************** emails_check() starts **************************")
-    success = True
-    balance_status = True
-    budget_status = True
     print("Checking if the user has set balance preference...")
     if user.preference.balance:
         print("User balance preference 'ON'")
-        try:
-            print("Trying to execute 'send_balance_email' function...")
-            send_balance_email(user, card)
-            print("'send_balance_email' function is executed successfully!")
-        except:
-            print("'send_balance_email' function is failed!")
-            # traceback.print_exc()
-            success = False
-            balance_status = False
+        send_balance_email(user, card)
     print("---------------------------------------------------------------------------")
     print("Checking if the user has set budget preference...")
     if user.preference.budget:
         print("User budget preference 'ON'")
-        if user.spending.budget != None:
+        if user.spending.budget != None and budget_level != None:
             print("Budget is set")
-            try:
-                print("Trying to execute 'send_budget_email' function...")
-                send_budget_email(user)
-                print("'send_budget_email' function is executed successfully!")
-            except:
-                print("'send_budget_email' function is failed!")
-                # traceback.print_exc()
-                success = False
-                budget_status = False
+            send_budget_email(user, budget_level)
         else:
-            print("Budget is not set")
+            print("Budget is not set or has already alerted")
             print("'send_budget_email' haven't been executed!")
-    print("Ending 'emails_check' function...")
-    print(f"Balance Status: {'Success' if balance_status else 'Error'}")
-    print(f"Budget Status: {'Success' if budget_status else 'Error'}")
     print("************************** emails_check() ends *****************************")
-    return success
 
 
 # printing messages in terminal for debugging purposes
@@ -124,17 +103,42 @@ def send_report_email(user, start_date, end_date):
             # Create a email message
             msg = emails.report_email(user, start_date, end_date)
             print("Trying to send the email...")
-            mail.send(msg)
+            try:
+                send_email(msg)
+            except CircuitOpenError:
+                # The mail server is down, the outbox sends the report when it's back
+                queue_email(msg)
+                print("Mail server is unavailable, report email is queued!")
+                flash_message("Mail server is busy, your report will be emailed to you soon.", 'info', user.id)
+                return
             print("Report email is sent successfully!")
             flash_message("Quarterly Report is sent to your email!", 'success', user.id)
     else:
         flash_message("You haven't activated report email service.", 'info', user.id)
 
 
+def send_report_email_job(user_id, start_date, end_date):
+    """
+    Background job of '/report_mail': build and send the report email, the result is posted to the user's inbox.
+    :param user_id: user id
+    :param start_date: datetime
+    :param end_date: datetime, the day after the last day
+    :return: None
+    """
+    user = User.query.get(user_id)
+    if user is None:
+        return
+    try:
+        send_report_email(user, start_date, end_date)
+    except Exception:
+        traceback.print_exc()
+        flash_message("An error happened when sending the email. Try Again.", 'danger', user_id)
+
+
 # printing messages in terminal for debugging purposes
 def send_category_email(user, categorybudget, spending):
     msg = None
     msg = emails.category_budget_email(user, categorybudget, spending)
     print('Trying to send the email...')
-    mail.send(msg)
-    print('Category email is sent successfully!')
+    queue_email(msg)
+    print('Category email is queued successfully!')
@@ -0,0 +1,71 @@
+import os, hashlib, threading
+
+
+class Table:
+    """
+    An immutable, parsed copy of a text file.
+    It has:
+        1. value: whatever the parser returned, e.g. a tuple of (item, category) pairs
+        2. version: sha1 of the file content
+        3. Things built from the value, e.g. a Matcher, see 'derive()'
+    """
+
+    def __init__(self, value, version, mtime, size):
+        self.value = value
+        self.version = version
+        self.mtime = mtime
+        self.size = size
+        self._derived = {}
+
+    def derive(self, name, builder):
+        """
+        Build something from the table value once per version
+        :param name: name of the derived value, e.g. 'matcher'
+        :param builder: function that takes the value and builds the derived value
+        :return: the derived value
+        """
+        if name not in self._derived:
+            self._derived[name] = builder(self.value)
+        return self._derived[name]
+
+
+class TableRegistry:
+    """
+    Process-wide cache of parsed text files (description.txt, transactions.txt).
+    A file is parsed the first time it's needed and only parsed again if its mtime or size changes
+    and its content hash is different.
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def get(self, file, parser):
+        """
+        Get the parsed table of a file
+        :param file: path to the file
+        :param parser: function that takes the file content (str) and returns an immutable value
+        :return: Table
+        """
+        stat = os.stat(file)
+        key = (os.path.abspath(file), parser)
+        table = self._tables.get(key)
+        if table is not None and table.mtime == stat.st_mtime_ns and table.size == stat.st_size:
+            return table
+        with self._lock:
+            with open(file, 'rb') as f:
+                content = f.read()
+            version = hashlib.sha1(content).hexdigest()
+            if table is not None and table.version == version:
+                # Touched but not changed, keep the parsed value
+                table.mtime, table.size = stat.st_mtime_ns, stat.st_size
+            else:
+                table = Table(parser(content.decode('utf-8')), version, stat.st_mtime_ns, stat.st_size)
+                self._tables[key] = table
+        return table
+
+    def clear(self):
+        self._tables = {}
+
+
+tables = TableRegistry()
@@ -1,20 +1,148 @@
-from flask import flash
+import traceback
+from collections import Counter
+from functools import wraps
+from flask import flash, has_request_context, has_app_context, g, got_request_exception, abort, current_app
+from flask_login import current_user
+from sqlalchemy import event
 from spendingtracker.models import Message
 from spendingtracker import db
 from datetime import datetime
 
 
+class MessageBuffer:
+    """
+    Inbox messages of the current request (or background job), written behind:
+        1. 'flash_message()' only adds the message to a list in 'g'
+        2. The next 'db.session.commit()' of the request inserts the whole list with one executemany, in the same
+           database transaction as the request's own changes, and adds them to the users' unread counts
+        3. Messages left when the request ends (e.g. a request that flashes after its last commit) are written
+           with one commit before the response is sent, or when the app context of a job ends
+    Messages are only removed from the list once their commit succeeded. If the request or job fails with an
+    exception, its uncommitted changes are rolled back and its pending messages are dropped, they may describe
+    changes that never happened (e.g. 'generate_transaction' flashes before its commit).
+    """
+
+    def init_app(self, app):
+        app.after_request(self._after_request)
+        app.teardown_appcontext(self._teardown)
+        got_request_exception.connect(self._request_failed, app)
+
+    def add(self, rows):
+        """
+        :param rows: list of dicts of 'message' columns
+        :return: None
+        """
+        if 'pending_messages' not in g:
+            g.pending_messages = []
+        g.pending_messages.extend(rows)
+
+    def write(self, session):
+        # Insert the pending messages in the session's current database transaction
+        if not has_app_context() or not g.get('pending_messages'):
+            return
+        rows = list(g.pending_messages)
+        session.execute(Message.__table__.insert(), rows)
+        Message.add_unread(session.connection(), Counter(row['user_id'] for row in rows))
+        g.written_messages = len(rows)
+
+    def committed(self):
+        # The written messages are in the db now, a failed commit leaves them pending for the next one
+        if has_app_context() and g.get('written_messages'):
+            del g.pending_messages[:g.written_messages]
+            g.written_messages = 0
+
+    def discard(self):
+        """
+        Roll back the session and drop the pending messages, e.g. after a failed request
+        :return: None
+        """
+        db.session.rollback()
+        g.pop('pending_messages', None)
+        g.pop('written_messages', None)
+
+    def flush(self):
+        """
+        Commit the pending messages now, e.g. before reading the inbox
+        :return: None
+        """
+        if g.get('pending_messages'):
+            db.session.commit()
+
+    def _request_failed(self, sender, exception, **extra):
+        # Flask still calls 'after_request' for the error response, it mustn't commit
+        g.request_failed = True
+
+    def _after_request(self, response):
+        if not g.get('request_failed'):
+            self.flush()
+        return response
+
+    def _teardown(self, exception):
+        # Jobs and requests that failed before 'after_request'
+        if exception is not None or g.get('request_failed'):
+            self.discard()
+            return
+        try:
+            self.flush()
+        except Exception:
+            traceback.print_exc()
+            self.discard()
+
+
+message_buffer = MessageBuffer()
+
+
+@event.listens_for(db.session, 'before_commit')
+def write_pending_messages(session):
+    message_buffer.write(session)
+
+
+@event.listens_for(db.session, 'after_commit')
+def clear_written_messages(session):
+    message_buffer.committed()
+
+
+def admin_required(view):
+    """
+    Only let the users in 'ADMIN_EMAILS' see a view, other users get a 404, use it below '@login_required'
+    :param view: view function
+    :return: view function
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if current_user.email not in current_app.config['ADMIN_EMAILS']:
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def get_message_row(content, type, user_id):
+    time = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    return {'content': content, 'type': type, 'timestamp': datetime.strptime(time, "%Y-%m-%d %H:%M:%S"), 'user_id': user_id}
+
+
 def flash_message(content, type, user_id):
     """
     Flash a message and add that message into database.
+    Outside of a request (e.g. in a background job) the message is only added into database, the user sees it in the inbox.
+    The message is written with the request's next commit, see 'MessageBuffer'.
     :param content: flash message content
     :param type: flash message type, e.g. 'success', 'danger', 'info'
     :param user_id: user id
     :return: None
     """
-    flash(content, type)
-    time = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-    message = Message(content=content, type=type, timestamp=datetime.strptime(time, "%Y-%m-%d %H:%M:%S"), user_id=user_id)
-    db.session.add(message)
-    db.session.commit()
+    if has_request_context():
+        flash(content, type)
+    message_buffer.add([get_message_row(content, type, user_id)])
+
 
+def post_message(content, type, user_ids):
+    """
+    Add the same message to the inbox of many users (fan-out), written in one executemany with the request's next commit.
+    Nothing is flashed, the users see the message in their inbox.
+    :param content: message content
+    :param type: message type, e.g. 'success', 'danger', 'info'
+    :param user_ids: list of user ids
+    :return: None
+    """
+    message_buffer.add([get_message_row(content, type, user_id) for user_id in user_ids])
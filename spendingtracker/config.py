@@ -10,3 +10,60 @@ class Config:
     MAIL_PASSWORD = 'GRPTeam1'
     # MAIL_USERNAME = os.environ.get('EMAIL_USER')
     # MAIL_PASSWORD = os.environ.get('EMAIL_PASS')
+    # Seconds to connect and log in to the mail server, and seconds each SMTP command may take, see 'common/mailer.py'
+    MAIL_CONNECT_TIMEOUT = 10
+    MAIL_SEND_TIMEOUT = 30
+    # Stop calling the mail server after this many failures in a row, and try again after the cooldown (seconds)
+    MAIL_BREAKER_FAILURES = 5
+    MAIL_BREAKER_COOLDOWN = 60
+    # Cache of transaction classifications, shared by all processes
+    CLASSIFICATION_CACHE_PATH = 'spendingtracker/cards/classification_cache.db'
+    CLASSIFICATION_CACHE_SIZE = 10000
+    # Emails of the users who can see the '/*_stats' endpoints (process-wide cache, queue and mail server state), empty for nobody
+    ADMIN_EMAILS = []
+    # Upgrade the database schema when the app starts, see 'migrations.py'
+    DATABASE_AUTO_UPGRADE = True
+    # Transactions per page of '/api/transactions' and the accounts page
+    TRANSACTIONS_PAGE_SIZE = 50
+    TRANSACTIONS_MAX_PAGE_SIZE = 500
+    # Budget alerts, see 'common/budgets.py'
+    # Spending within this much of the overall budget is 'close to budget'
+    BUDGET_CLOSE_MARGIN = 50
+    # An alert can be sent again in the same month only after the spending falls this much below its threshold
+    BUDGET_REARM_MARGIN = 10
+    # Messages per page of '/api/messages' and the inbox page
+    MESSAGES_PAGE_SIZE = 50
+    MESSAGES_MAX_PAGE_SIZE = 500
+    # Retention of inbox messages and login logs, see 'common/retention.py' and 'flask prune', None keeps rows forever
+    # Maximum age in days, and maximum number of rows kept per user (the newest)
+    MESSAGE_RETENTION_DAYS = 365
+    MESSAGE_MAX_PER_USER = 1000
+    LOG_RETENTION_DAYS = 365
+    LOG_MAX_PER_USER = 100
+    # Rows deleted per commit
+    RETENTION_CHUNK_SIZE = 500
+    # Statements imported via the accounts page or 'flask import-transactions', see 'cards/imports.py'
+    # Transactions inserted per database transaction
+    IMPORT_CHUNK_SIZE = 500
+    # Largest upload in bytes
+    MAX_CONTENT_LENGTH = 32 * 1024 * 1024
+    # Reports kept in memory by each process, see 'main/reports.py'
+    REPORT_CACHE_SIZE = 256
+    # Background jobs (report emails), see 'common/jobs.py'
+    # Number of worker threads per process, 0 runs jobs in the request
+    JOB_QUEUE_WORKERS = 2
+    # Maximum number of waiting jobs, 0 for no limit
+    JOB_QUEUE_SIZE = 100
+    # Outbox of alert emails, see 'common/outbox.py'
+    # Send from a background thread in each process, False to only send with 'flask drain-outbox'
+    OUTBOX_SENDER_THREAD = True
+    # Emails sent per SMTP connection
+    OUTBOX_BATCH_SIZE = 50
+    # Seconds between checks for due emails (retries)
+    OUTBOX_POLL_INTERVAL = 30
+    # Seconds before the first retry of a failed email, doubled after every failure up to the maximum
+    OUTBOX_RETRY_DELAY = 30
+    OUTBOX_MAX_RETRY_DELAY = 3600
+    OUTBOX_MAX_ATTEMPTS = 10
+    # Seconds an email is reserved by the process sending it
+    OUTBOX_LEASE = 300
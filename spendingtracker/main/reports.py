@@ -0,0 +1,153 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+from datetime import datetime, time, timedelta
+from sqlalchemy import select, union_all
+from spendingtracker import db
+from spendingtracker.models import Card, Transaction, DailySpending
+
+
+class SpendingReport:
+    """
+    Columnar copy of a user's spending in a range of datetimes (the end excluded), used by the report functions in 'utils.py'.
+    The range is loaded once into arrays, one element per transaction or per 'daily_spending' row:
+        1. amounts: float64 sum of the row's transactions
+        2. counts: number of transactions in the row (1 for a single transaction)
+        3. weekdays: 0 (Monday) to 6 (Sunday)
+        4. categories: code of the category, an index into 'category_names'
+    Statistics are computed with 'np.bincount()' over these arrays instead of Python loops, and they are
+    returned in the same format as 'sum_spending()', 'average_spending_by_weekday()' and 'sum_spending_by_category()'.
+    """
+
+    def __init__(self, amounts, counts, weekdays, categories, category_names):
+        self.amounts = amounts
+        self.counts = counts
+        self.weekdays = weekdays
+        self.categories = categories
+        self.category_names = category_names
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build a report from rows of (amount, count, weekday, category)
+        :param rows: iterable of rows, weekday is SQLite's '%w': 0 (Sunday) to 6 (Saturday)
+        :return: SpendingReport
+        """
+        rows = list(rows)
+        if not rows:
+            empty = np.zeros(0)
+            return cls(empty, empty, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), [])
+        amounts, counts, weekdays, categories = zip(*rows)
+        # SQLite's '%w' is 0 for Sunday, Python's weekday() is 0 for Monday
+        weekdays = (np.array(weekdays, dtype=np.int64) + 6) % 7
+        category_names, categories = np.unique(np.array([str(category) for category in categories], dtype=object), return_inverse=True)
+        return cls(np.array(amounts, dtype=np.float64), np.array(counts, dtype=np.float64), weekdays,
+                   categories.astype(np.int64), [str(name) for name in category_names])
+
+    @classmethod
+    def load(cls, user, start_date, end_date):
+        """
+        Load the user's spending from 'start_date' (included) to 'end_date' (excluded, e.g. the day after the last day).
+        Whole days inside the range are read from the 'daily_spending' rollup, only the transactions of the first
+        and last day are read one by one, so the cost depends on the number of days, not on the number of transactions.
+        :param user: user
+        :param start_date: datetime
+        :param end_date: datetime
+        :return: SpendingReport
+        """
+        # First whole day after the start day, and the beginning of the day of the end
+        first_day = datetime.combine(start_date.date(), time()) + timedelta(days=1)
+        last_day = datetime.combine(end_date.date(), time())
+        transactions = Transaction.__table__.join(Card.__table__, Card.id == Transaction.card_id)
+        transaction_rows = select([Transaction.amount, db.literal(1), db.cast(db.func.strftime('%w', Transaction.timestamp), db.Integer), Transaction.category])\
+            .select_from(transactions).where(db.and_(Card.user_id == user.id, Transaction.timestamp >= start_date, Transaction.timestamp < end_date))
+        if last_day < first_day:
+            # Start and end are on the same day
+            return cls.from_rows(db.session.execute(transaction_rows))
+        transaction_rows = transaction_rows.where(db.or_(Transaction.timestamp < first_day, Transaction.timestamp >= last_day))
+        rollup_rows = select([DailySpending.amount, DailySpending.count, db.cast(db.func.strftime('%w', DailySpending.date), db.Integer), DailySpending.category])\
+            .where(db.and_(DailySpending.user_id == user.id, DailySpending.count > 0,
+                           DailySpending.date >= first_day.strftime('%Y-%m-%d'), DailySpending.date < last_day.strftime('%Y-%m-%d')))
+        return cls.from_rows(db.session.execute(union_all(rollup_rows, transaction_rows)))
+
+    def total_spending(self):
+        """
+        :return: total spending rounded to 2 decimals, e.g. 120.5
+        """
+        return round(float(self.amounts.sum()), 2)
+
+    def average_spending_by_weekday(self):
+        """
+        :return: dictionary of weekdays and average transaction amount, e.g. "{'0': 12.5, '4': 30.0}" ('0' is Monday)
+        """
+        amounts = np.bincount(self.weekdays, weights=self.amounts, minlength=7)
+        counts = np.bincount(self.weekdays, weights=self.counts, minlength=7)
+        return {str(day): round(float(amounts[day] / counts[day]), 2) for day in np.flatnonzero(counts)}
+
+    def spending_by_category(self):
+        """
+        :return: dictionary of categories and total amount, e.g. "{'Food': 50.25, 'General': 70.25}"
+        """
+        amounts = np.bincount(self.categories, weights=self.amounts, minlength=len(self.category_names))
+        return {name: float(amount) for name, amount in zip(self.category_names, amounts)}
+
+
+class ReportCache:
+    """
+    Bounded LRU of computed reports in the current process.
+    The key contains the user's 'data_version', so a report is never returned after the user's transactions
+    or cards change, old entries are simply evicted.
+    """
+
+    def __init__(self, size=256):
+        """
+        :param size: maximum number of reports kept
+        """
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._reports = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, size):
+        with self._lock:
+            self.size = size
+            self._reports.clear()
+
+    def get(self, key):
+        """
+        Look up a report
+        :param key: (user id, start datetime, end datetime, data version)
+        :return: report, or None if it's not cached
+        """
+        with self._lock:
+            report = self._reports.get(key)
+            if report is None:
+                self.misses += 1
+            else:
+                self._reports.move_to_end(key)
+                self.hits += 1
+            return report
+
+    def set(self, key, report):
+        with self._lock:
+            self._reports[key] = report
+            self._reports.move_to_end(key)
+            while len(self._reports) > self.size:
+                self._reports.popitem(last=False)
+
+    def get_stats(self):
+        """
+        Get hit and miss counters of the current process
+        :return: dict, e.g. "{'hits': 9, 'misses': 1, 'hit_rate': 0.9, 'size': 1}"
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+            'size': len(self._reports),
+        }
+
+
+report_cache = ReportCache()
@@ -1,12 +1,18 @@
-from flask import Blueprint, render_template, request, abort, redirect, url_for
+from flask import Blueprint, render_template, request, abort, redirect, url_for, current_app, Response, stream_with_context
 from flask_login import login_required, current_user
-from spendingtracker.models import Transaction, TransactionSchema, Message, MessageSchema, Categorybudget, CategorybudgetSchema
-from spendingtracker.common.utils import flash_message
+from spendingtracker.models import Message, Categorybudget
+from spendingtracker.common.utils import flash_message, admin_required
+from spendingtracker.common.serializers import categorybudget_serializer, json_response
 from spendingtracker import db
 from spendingtracker.main import utils
-from datetime import datetime
-from spendingtracker.common.senders import send_report_email
-from spendingtracker.cards.utils import read_matching_table
+from spendingtracker.main.reports import report_cache
+from datetime import datetime, timedelta
+from spendingtracker.common.senders import send_report_email_job
+from spendingtracker.common.jobs import job_queue
+from spendingtracker.common.breaker import mail_breaker
+from spendingtracker.common.outbox import outbox_sender
+import queue
+from spendingtracker.cards.utils import get_categories
 
 
 main = Blueprint('main', __name__)
@@ -18,33 +24,129 @@ main = Blueprint('main', __name__)
 def homepage():
     """
     Display the homepage for user.
-    :return: 'homepage.html', the dictionary of all transactions, all categories the system knows, current user's category budgets
-    """
-    # Get all cards of the current user
-    cards = current_user.cards
-    # Get all transactions of each card and save them in a list
-    dict = []
-    transaction_schema = TransactionSchema()
-    for card in cards:
-        # Get all transactions that belong to the current card and order them by descending order
-        transactions = Transaction.query.filter_by(card_id=card.id).order_by(Transaction.timestamp.desc())
-        for transacion in transactions:
-            # Convert SQL object into a list element
-            dict_transaction = transaction_schema.dump(transacion)
-            dict = dict + [dict_transaction]
+    :return: 'homepage.html', this month's chart points, total spending of each card, all categories the system knows, current user's category budgets
+    """
+    # Points of this month's line chart of each card, and the total spending of each card
+    # Transactions themselves are loaded page by page from '/api/transactions'
+    chart_points = utils.get_month_chart_points(current_user)
+    card_totals = utils.sum_spending_by_card(current_user)
     # Get all categories the system knows
-    categories = []
-    for item in read_matching_table():
-        if not item[1] in categories:
-            categories += [item[1],]
+    categories = get_categories()
     #Get current user's category budgets
-    categorybudgets = current_user.categorybudgets
-    dict2 = []
-    categories_schema = CategorybudgetSchema()
-    for categorybudget in categorybudgets:
-        category = categories_schema.dump(categorybudget)
-        dict2 = dict2 + [category]
-    return render_template('homepage.html', title='Homepage', transactions=dict, categories=categories, categorybudget=dict2)
+    categorybudgets = categorybudget_serializer.dump(categorybudget_serializer.query().filter(Categorybudget.user_id == current_user.id))
+    return render_template('homepage.html', title='Homepage', chart_points=chart_points, card_totals=card_totals, categories=categories, categorybudget=categorybudgets)
+
+
+@main.route('/api/transactions')
+@login_required
+def transactions_feed():
+    """
+    A page of the current user's transactions as JSON, newest first.
+    Pages are linked by cursors: pass 'next_cursor' of a page to get the page after it.
+    :param: 'cursor': cursor of the page, the first page if it's not given
+            'limit': number of transactions per page, at most 'TRANSACTIONS_MAX_PAGE_SIZE'
+            'card_id': only transactions of this card
+            'category': only transactions of this category
+            'start', 'end': only transactions between these dates, in "%Y-%m-%d" format
+    :return: JSON, e.g. {"transactions": [...], "next_cursor": "2020-05-27T19:59:17.138329_42"}, 400 if a parameter is invalid
+    """
+    try:
+        limit = min(request.args.get('limit', current_app.config['TRANSACTIONS_PAGE_SIZE'], type=int),
+                    current_app.config['TRANSACTIONS_MAX_PAGE_SIZE'])
+        card_id = request.args.get('card_id', type=int)
+        start, end = request.args.get('start'), request.args.get('end')
+        start_date = datetime.strptime(start + " 00:00:00", "%Y-%m-%d %H:%M:%S") if start else None
+        # Up to the end of the last day, timestamps have microseconds
+        end_date = datetime.strptime(end, "%Y-%m-%d") + timedelta(days=1) if end else None
+        transactions, next_cursor = utils.get_transaction_page(current_user, cursor=request.args.get('cursor'), limit=max(limit, 1),
+                                                               card_id=card_id, category=request.args.get('category'),
+                                                               start_date=start_date, end_date=end_date)
+    except ValueError:
+        abort(400)
+    return json_response(transactions=transactions, next_cursor=next_cursor)
+
+
+@main.route('/api/category_spending')
+@login_required
+def category_spending():
+    """
+    A card's total spending per category as JSON, for the donut chart of the accounts page.
+    :param: 'card_id': card of the current user
+            'start', 'end': only spending between these dates (both included), in "%Y-%m-%d" format
+    :return: JSON, e.g. {"spending": {"Food": 120.5, "Bills": 40.0}}, 400 if a parameter is invalid
+    """
+    card_id = request.args.get('card_id', type=int)
+    start, end = request.args.get('start') or None, request.args.get('end') or None
+    try:
+        for date in (start, end):
+            if date is not None:
+                datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        abort(400)
+    if card_id is None:
+        abort(400)
+    return json_response(spending=utils.get_card_spending_by_category(current_user, card_id, start_date=start, end_date=end))
+
+
+@main.route('/export')
+@login_required
+def export():
+    """
+    Download the current user's transactions, oldest first.
+    The file is streamed while it's read from the db, so any history length can be exported.
+    :param: 'format': 'ndjson' (default) or 'csv'
+            'card_id': only transactions of this card
+            'start', 'end': only transactions between these dates, in "%Y-%m-%d" format
+    :return: NDJSON or CSV file, 400 if a parameter is invalid
+    """
+    format = request.args.get('format', 'ndjson')
+    if format not in utils.EXPORT_FORMATS:
+        abort(400)
+    try:
+        card_id = request.args.get('card_id', type=int)
+        start, end = request.args.get('start'), request.args.get('end')
+        start_date = datetime.strptime(start + " 00:00:00", "%Y-%m-%d %H:%M:%S") if start else None
+        # Up to the end of the last day, timestamps have microseconds
+        end_date = datetime.strptime(end, "%Y-%m-%d") + timedelta(days=1) if end else None
+    except ValueError:
+        abort(400)
+    chunks = utils.export_transactions(current_user, format, start_date=start_date, end_date=end_date, card_id=card_id)
+    # Keep the request context (current_user, db session) while the response is streamed
+    return Response(stream_with_context(chunks), mimetype=utils.EXPORT_FORMATS[format],
+                    headers={'Content-Disposition': f'attachment; filename=transactions.{format}'})
+
+
+@main.route('/report_stats')
+@login_required
+@admin_required
+def report_stats():
+    """
+    Hit and miss counters of the report cache in this process.
+    :return: JSON, e.g. {"hits": 9, "misses": 1, "hit_rate": 0.9, "size": 1}
+    """
+    return json_response(**report_cache.get_stats())
+
+
+@main.route('/job_stats')
+@login_required
+@admin_required
+def job_stats():
+    """
+    Number of workers and waiting, running, done and failed jobs of the background job queue in this process.
+    :return: JSON, e.g. {"workers": 2, "depth": 3, "running": 2, "done": 10, "failed": 0}
+    """
+    return json_response(**job_queue.get_stats())
+
+
+@main.route('/mail_stats')
+@login_required
+@admin_required
+def mail_stats():
+    """
+    State of the mail server's circuit breaker and counters of the outbox in this process.
+    :return: JSON, e.g. {"breaker": {"state": "open", "retry_in": 42.0, ...}, "outbox": {"sent": 10, "pending": 3, ...}}
+    """
+    return json_response(breaker=mail_breaker.get_stats(), outbox=outbox_sender.get_stats())
 
 
 # Set user's budget via a request (Ajax).
@@ -75,6 +177,8 @@ def set_budget():
     current_user.spending.budget = budget
     # Update the budget timestamp
     current_user.spending.budget_set_timestamp = datetime.utcnow()
+    # The new budget can alert again
+    current_user.spending.alert_level = 0
     db.session.commit()
     flash_message(f'You just set a monthly budget: {budget}!', 'success', current_user.id)
     return f"Budget: ￡{budget} has been set to {current_user.email}"
@@ -104,6 +208,8 @@ def set_category_budget():
                 # The user has already set a budget on this category but the new budget doesn't equal to the old budget
                 # Change the budget
                 db_categorybudget.budget = budget
+                # The new budget can alert again
+                db_categorybudget.alert_level = 0
                 db.session.commit()
                 flash_message(f"Category: {category}, Budget: ￡{budget}", 'success', current_user.id)
                 return "Successfully"
@@ -115,6 +221,8 @@ def set_category_budget():
         owner=current_user
     )
     db.session.add(category_budget)
+    # The spending of the new category is read on the next budget evaluation
+    current_user.spending.budget_version = None
     db.session.commit()
     flash_message(f"Category: {category}, Budget: ￡{budget}", 'success', current_user.id)
     return "Successfully"
@@ -177,15 +285,48 @@ def support():
 def inbox():
     """
     A page for users to view their messages.
-    :return: 'inbox.html', all flashed messages belong to the current user, list of flashed messages
+    Only the newest page is loaded, older messages are loaded page by page from '/api/messages'.
+    :return: 'inbox.html', the newest page of the current user's messages, cursor of the next page
     """
-    messages = Message.query.filter_by(user_id=current_user.id).order_by(Message.timestamp.desc())
-    messages_schema = MessageSchema()
-    listOfDict = []
-    for message in messages:
-        dict_message = messages_schema.dump(message)
-        listOfDict += [dict_message]
-    return render_template('inbox.html', title='Inbox', messages_flashed=messages, messages_json=listOfDict)
+    messages, next_cursor = utils.get_message_page(current_user, limit=current_app.config['MESSAGES_PAGE_SIZE'])
+    return render_template('inbox.html', title='Inbox', messages_json=messages, next_cursor=next_cursor)
+
+
+@main.route('/api/messages')
+@login_required
+def messages_feed():
+    """
+    A page of the current user's messages as JSON, newest first, and the number of unread messages.
+    Pages are linked by cursors: pass 'next_cursor' of a page to get the page after it.
+    :param: 'cursor': cursor of the page, the first page if it's not given
+            'limit': number of messages per page, at most 'MESSAGES_MAX_PAGE_SIZE'
+    :return: JSON, e.g. {"messages": [...], "next_cursor": "2020-05-27T19:59:17_42", "unread": 3}, 400 if the cursor is invalid
+    """
+    limit = min(request.args.get('limit', current_app.config['MESSAGES_PAGE_SIZE'], type=int),
+                current_app.config['MESSAGES_MAX_PAGE_SIZE'])
+    try:
+        messages, next_cursor = utils.get_message_page(current_user, cursor=request.args.get('cursor'), limit=max(limit, 1))
+    except ValueError:
+        abort(400)
+    return json_response(messages=messages, next_cursor=next_cursor, unread=current_user.unread_messages)
+
+
+@main.route('/api/messages/read', methods=['POST'])
+@login_required
+def read_messages():
+    """
+    Mark messages of the current user as read.
+    This method only accepts 'POST' method.
+    :param: 'ids': ids of the messages (repeated form field), all messages if it's not given
+    :return: JSON, e.g. {"marked": 2, "unread": 1}, 400 if an id is invalid
+    """
+    try:
+        ids = [int(id) for id in request.form.getlist('ids')] or None
+    except ValueError:
+        abort(400)
+    marked = Message.mark_read(current_user.id, ids)
+    db.session.commit()
+    return json_response(marked=marked, unread=current_user.unread_messages)
 
 
 @main.route('/report_mail', methods=['POST'])
@@ -195,8 +336,8 @@ def report_mail():
     This method handles report requests.
     This method only accepts 'POST' method.
     This method accepts Ajax request.
-    It validates the start date and end date of the report, if everything is valid, it will construct a email
-    and send it to the user, otherwise prompts error messages.
+    It validates the start date and end date of the report, if everything is valid, the report email is built
+    and sent by a background job and the result is posted to the inbox, otherwise prompts error messages.
     :return: 'homepage.html'
     """
     start = request.form.get('start')
@@ -205,12 +346,14 @@ def report_mail():
         flash_message("Invalid dates! Please select valid dates", 'danger', current_user.id)
     else:
         start_date = datetime.strptime(start + " 00:00:00", "%Y-%m-%d %H:%M:%S")
-        end_date = datetime.strptime(end + " 23:59:59", "%Y-%m-%d %H:%M:%S")
+        # Up to the end of the last day, timestamps have microseconds
+        end_date = datetime.strptime(end, "%Y-%m-%d") + timedelta(days=1)
         try:
-            send_report_email(current_user, start_date, end_date)
-        except:
-            print("Failed to send the email!")
-            flash_message("An error happened when sending the email. Try Again.", 'danger', current_user.id)
+            job_queue.enqueue(send_report_email_job, current_user.id, start_date, end_date)
+            flash_message("Your report is being prepared, you'll find the result in your inbox.", 'info', current_user.id)
+        except queue.Full:
+            print("The job queue is full!")
+            flash_message("Too many reports are being prepared. Try Again later.", 'danger', current_user.id)
     return redirect(url_for('main.homepage'))
 
 
@@ -1,23 +1,221 @@
 
 
 
-# Get a list of all transactions belong to the user
-def get_all_transactions(user, start_date, end_date):
-    transactions = []
-    for card in user.cards:
-        for transaction in card.transactions:
-            transaction_datetime = transaction.timestamp
-            if transaction_datetime >= start_date and transaction_datetime <= end_date:
-                transactions.append(transaction)
-    return transactions
+import csv, io
+from datetime import datetime
+from sqlalchemy import select, union_all, and_, or_
+from spendingtracker import db
+from spendingtracker.models import Card, Transaction, Message, DailySpending
+from spendingtracker.common.serializers import transaction_serializer, message_serializer, dumps
+from spendingtracker.main.reports import SpendingReport, report_cache
+
+
+# Query of the user's transactions between two datetimes (both included), across all cards
+def get_transactions_query(user, start_date, end_date):
+    return Transaction.query.join(Card, Card.id == Transaction.card_id)\
+        .filter(Card.user_id == user.id, Transaction.timestamp >= start_date, Transaction.timestamp <= end_date)
+
+
+# Get all transactions belong to the user between two datetimes
+# The transactions are streamed from the db 'chunk_size' rows at a time, iterate over the result only once
+def get_all_transactions(user, start_date, end_date, chunk_size=1000):
+    return get_transactions_query(user, start_date, end_date).order_by(Transaction.timestamp).yield_per(chunk_size)
+
+
+# A cursor points at the last transaction of a page: '<timestamp>_<id>'
+def encode_cursor(timestamp, id):
+    return f"{timestamp.isoformat()}_{id}"
+
+
+def decode_cursor(cursor):
+    timestamp, id = cursor.rsplit('_', 1)
+    return datetime.fromisoformat(timestamp), int(id)
+
+
+def get_transaction_page(user, cursor=None, limit=50, card_id=None, category=None, start_date=None, end_date=None):
+    """
+    Get a page of the user's transactions, newest first, using keyset pagination on (timestamp, id).
+    Every card's page is read from the (card_id, timestamp) index and the pages are merged in one query,
+    so a page costs the same no matter how many transactions the user has.
+    :param user: user
+    :param cursor: 'next_cursor' of the previous page, None for the first page
+    :param limit: number of transactions in a page
+    :param card_id: only transactions of this card
+    :param category: only transactions of this category
+    :param start_date: only transactions at or after this datetime
+    :param end_date: only transactions before this datetime, e.g. the day after the last day
+    :return: (list of transaction dictionaries, cursor of the next page or None if this is the last page)
+    """
+    card_ids = [id for (id,) in db.session.query(Card.id).filter(Card.user_id == user.id)]
+    if card_id is not None:
+        card_ids = [id for id in card_ids if id == card_id]
+    if not card_ids:
+        return [], None
+    conditions = []
+    if category is not None:
+        conditions.append(Transaction.category == category)
+    if start_date is not None:
+        conditions.append(Transaction.timestamp >= start_date)
+    if end_date is not None:
+        conditions.append(Transaction.timestamp < end_date)
+    if cursor is not None:
+        timestamp, id = decode_cursor(cursor)
+        conditions.append(or_(Transaction.timestamp < timestamp, and_(Transaction.timestamp == timestamp, Transaction.id < id)))
+    # Only the serialized columns are selected, one more row than the limit tells if there is a next page
+    pages = [select(transaction_serializer.columns).where(and_(Transaction.card_id == id, *conditions))
+             .order_by(Transaction.timestamp.desc(), Transaction.id.desc()).limit(limit + 1) for id in card_ids]
+    if len(pages) == 1:
+        query = pages[0]
+    else:
+        # SQLite doesn't allow ORDER BY or LIMIT in the parts of a UNION, so each page is a subquery
+        merged = union_all(*[select([page.alias()]) for page in pages]).alias()
+        query = select([merged]).order_by(merged.c.timestamp.desc(), merged.c.id.desc()).limit(limit + 1)
+    rows = db.session.execute(query).fetchall()
+    next_cursor = encode_cursor(rows[limit - 1].timestamp, rows[limit - 1].id) if len(rows) > limit else None
+    return transaction_serializer.dump(rows[:limit]), next_cursor
+
+
+def get_card_spending_by_category(user, card_id, start_date=None, end_date=None):
+    """
+    Get a card's total spending per category from the 'daily_spending' rollup, e.g. for the donut chart of the
+    accounts page. It covers the card's whole history, not only the transactions loaded on the page.
+    :param user: user, only their cards are counted
+    :param card_id: card id
+    :param start_date: only spending on or after this day, "%Y-%m-%d"
+    :param end_date: only spending on or before this day, "%Y-%m-%d"
+    :return: dict of category -> amount, e.g. {"Food": 120.5, "Bills": 40.0}
+    """
+    query = db.session.query(DailySpending.category, db.func.sum(DailySpending.amount))\
+        .filter(DailySpending.user_id == user.id, DailySpending.card_id == card_id)
+    if start_date is not None:
+        query = query.filter(DailySpending.date >= start_date)
+    if end_date is not None:
+        query = query.filter(DailySpending.date <= end_date)
+    # Rows whose transactions were all moved to another category are left with a count of 0
+    rows = query.group_by(DailySpending.category).having(db.func.sum(DailySpending.count) > 0)
+    return {category: round(amount, 2) for category, amount in rows}
+
+
+def get_message_page(user, cursor=None, limit=50):
+    """
+    Get a page of the user's inbox, newest first, using keyset pagination on (timestamp, id) like 'get_transaction_page()'.
+    The page is read from the (user_id, timestamp) index, so it costs the same no matter how many messages the user has.
+    :param user: user
+    :param cursor: 'next_cursor' of the previous page, None for the first page
+    :param limit: number of messages in a page
+    :return: (list of message dictionaries, cursor of the next page or None if this is the last page)
+    """
+    query = message_serializer.query().filter(Message.user_id == user.id)
+    if cursor is not None:
+        timestamp, id = decode_cursor(cursor)
+        query = query.filter(or_(Message.timestamp < timestamp, and_(Message.timestamp == timestamp, Message.id < id)))
+    rows = db.session.execute(query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1).statement).fetchall()
+    next_cursor = encode_cursor(rows[limit - 1].timestamp, rows[limit - 1].id) if len(rows) > limit else None
+    return message_serializer.dump(rows[:limit]), next_cursor
+
+
+# Export formats and their mimetypes
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def export_transactions(user, format='ndjson', start_date=None, end_date=None, card_id=None, chunk_size=1000):
+    """
+    Export the user's transactions, oldest first, as NDJSON (one JSON object per line) or CSV (with a header row).
+    The transactions are read and encoded 'chunk_size' rows at a time, so memory use stays the same however long the history is.
+    :param user: user
+    :param format: 'ndjson' or 'csv'
+    :param start_date: only transactions at or after this datetime
+    :param end_date: only transactions before this datetime, e.g. the day after the last exported day
+    :param card_id: only transactions of this card
+    :param chunk_size: number of transactions per chunk
+    :return: generator of strings, one per chunk
+    """
+    query = transaction_serializer.query().join(Card, Card.id == Transaction.card_id).filter(Card.user_id == user.id)
+    if start_date is not None:
+        query = query.filter(Transaction.timestamp >= start_date)
+    if end_date is not None:
+        query = query.filter(Transaction.timestamp < end_date)
+    if card_id is not None:
+        query = query.filter(Transaction.card_id == card_id)
+    query = query.order_by(Transaction.timestamp, Transaction.id)
+    if format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(transaction_serializer.keys)
+        for transactions in transaction_serializer.stream(query, chunk_size):
+            writer.writerows(transaction.values() for transaction in transactions)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        # Only the header if there are no transactions
+        if buffer.tell():
+            yield buffer.getvalue()
+    else:
+        for transactions in transaction_serializer.stream(query, chunk_size):
+            yield ''.join(dumps(transaction) + '\n' for transaction in transactions)
+
+
+# Get the total spending of every card of the user
+def sum_spending_by_card(user):
+    rows = db.session.query(Transaction.card_id, db.func.sum(Transaction.amount)).join(Card, Card.id == Transaction.card_id)\
+        .filter(Card.user_id == user.id).group_by(Transaction.card_id)
+    return {card_id: amount for card_id, amount in rows}
+
+
+# Get the points of the homepage line charts: [card id, date, amount] of every transaction this month, newest first
+def get_month_chart_points(user):
+    now = datetime.utcnow()
+    rows = db.session.query(Transaction.card_id, Transaction.timestamp, Transaction.amount).join(Card, Card.id == Transaction.card_id)\
+        .filter(Card.user_id == user.id, Transaction.timestamp >= datetime(now.year, now.month, 1))\
+        .order_by(Transaction.timestamp.desc())
+    return [[card_id, timestamp.strftime('%Y-%m-%d'), amount] for card_id, timestamp, amount in rows]
 
 
 # Get balance of all cards belong to the user
 def get_all_balance(user):
-    total_balance = 0
-    for card in user.cards:
-        total_balance += card.balance
-    return total_balance
+    return db.session.query(db.func.sum(Card.balance)).filter(Card.user_id == user.id).scalar() or 0
+
+
+def get_report(user, start_date, end_date):
+    """
+    Get the statistics of a report email, computed once per version of the user's data
+    :param user: user
+    :param start_date: datetime
+    :param end_date: datetime, excluded, e.g. the day after the last day
+    :return: dict of 'total_balance', 'total_spending', 'weekday_list' and 'categories_list', don't change it
+    """
+    key = (user.id, start_date, end_date, user.data_version)
+    report = report_cache.get(key)
+    if report is None:
+        # Load the date range once and compute every statistic from it
+        spending = SpendingReport.load(user, start_date, end_date)
+        report = {
+            'total_balance': get_all_balance(user),
+            'total_spending': spending.total_spending(),
+            'weekday_list': spending.average_spending_by_weekday(),
+            'categories_list': spending.spending_by_category(),
+        }
+        report_cache.set(key, report)
+    return report
+
+
+# Get total spending of the user between two datetimes, computed from the daily rollup
+def sum_spending(user, start_date, end_date):
+    return SpendingReport.load(user, start_date, end_date).total_spending()
+
+
+# Get a dictionary of categories and corresponding amount between two datetimes, computed from the daily rollup
+def sum_spending_by_category(user, start_date, end_date):
+    return SpendingReport.load(user, start_date, end_date).spending_by_category()
+
+
+# Get a dictionary of weekdays and corresponding average transaction amount between two datetimes, computed from the daily rollup
+# Keys are the same as 'get_weekday_spending()': '0' (Monday) to '6' (Sunday)
+def average_spending_by_weekday(user, start_date, end_date):
+    return SpendingReport.load(user, start_date, end_date).average_spending_by_weekday()
 
 
 # Get total spending of all transactions
@@ -0,0 +1,105 @@
+from spendingtracker import db
+from spendingtracker.models import MonthlySpending, DailySpending
+
+
+# Schema migrations of site.db
+# The version of a database is saved in SQLite's 'user_version', migration N upgrades a database from version N-1 to N.
+# 'upgrade_database()' first runs 'db.create_all()', which creates missing tables (with their indexes) from the models,
+# so migrations only need to change tables that already exist: add columns and indexes, or fill in data.
+# Add new migrations at the end of 'MIGRATIONS', never change a migration that has been released.
+
+
+def get_columns(connection, table):
+    return [row[1] for row in connection.execute(f'PRAGMA table_info("{table}")')]
+
+
+def add_column(connection, table, column, definition):
+    """
+    Add a column if the table doesn't have it yet (new databases are created with it)
+    :param connection: SQLAlchemy connection
+    :param table: table name, e.g. 'message'
+    :param column: column name, e.g. 'read'
+    :param definition: column definition, e.g. 'BOOLEAN NOT NULL DEFAULT 0'
+    :return: None
+    """
+    if column not in get_columns(connection, table):
+        connection.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition}')
+
+
+def migration_1(connection):
+    # Composite indexes for the transaction, inbox and login log lists
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_transaction_card_id_timestamp ON "transaction" (card_id, timestamp)')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_transaction_card_id_category_timestamp ON "transaction" (card_id, category, timestamp)')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_message_user_id_timestamp ON message (user_id, timestamp)')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_log_user_id_id ON log (user_id, id)')
+    connection.execute('ANALYZE')
+
+
+def migration_2(connection):
+    # Monthly spending rollup of existing transactions
+    MonthlySpending.rebuild(connection)
+
+
+def migration_3(connection):
+    # Month of the total spending, the totals are computed again for the current month
+    add_column(connection, 'spending', 'period', 'VARCHAR(7)')
+    connection.execute('''UPDATE spending SET period = strftime('%Y-%m', 'now'), "totalAccountSpending" = ROUND(COALESCE((
+        SELECT SUM(t.amount) FROM "transaction" AS t JOIN card ON card.id = t.card_id
+        WHERE card.user_id = spending.user_id AND strftime('%Y-%m', t.timestamp) = strftime('%Y-%m', 'now')), 0), 2)''')
+
+
+def migration_4(connection):
+    # Daily spending rollup of existing transactions
+    DailySpending.rebuild(connection)
+
+
+def migration_5(connection):
+    # Version of each user's data, used as part of the report cache key
+    add_column(connection, 'user', 'data_version', 'INTEGER NOT NULL DEFAULT 0')
+
+
+def migration_6(connection):
+    # State of the budget evaluator, the category totals are computed on the next evaluation
+    add_column(connection, 'spending', 'alert_period', 'VARCHAR(7)')
+    add_column(connection, 'spending', 'alert_level', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(connection, 'spending', 'budget_version', 'INTEGER')
+    add_column(connection, 'categorybudget', 'spending', 'FLOAT NOT NULL DEFAULT 0')
+    add_column(connection, 'categorybudget', 'alert_level', 'INTEGER NOT NULL DEFAULT 0')
+
+
+def migration_7(connection):
+    # Read state of messages, the messages received before are counted as read
+    add_column(connection, 'message', 'read', 'BOOLEAN NOT NULL DEFAULT 0')
+    add_column(connection, 'user', 'unread_messages', 'INTEGER NOT NULL DEFAULT 0')
+    connection.execute('UPDATE message SET "read" = 1')
+
+
+MIGRATIONS = [
+    migration_1,
+    migration_2,
+    migration_3,
+    migration_4,
+    migration_5,
+    migration_6,
+    migration_7,
+]
+
+
+def get_version(connection):
+    return connection.execute('PRAGMA user_version').scalar()
+
+
+def upgrade_database():
+    """
+    Upgrade the database of the current app to the latest version in place.
+    It must be called within an app context.
+    :return: (version before the upgrade, version after the upgrade)
+    """
+    db.create_all()
+    with db.engine.begin() as connection:
+        old_version = get_version(connection)
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            if version > old_version:
+                migration(connection)
+        connection.execute(f'PRAGMA user_version = {len(MIGRATIONS)}')
+    return old_version, len(MIGRATIONS)
@@ -2,8 +2,9 @@ from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from spendingtracker import db, login_manager, ma
 from flask_login import UserMixin
 from flask import current_app
-from spendingtracker.cards.utils import get_UUID, get_amount, get_currency, get_datetime, get_desctiption, classify_transaction
-from datetime import datetime
+from sqlalchemy import event, inspect, text, bindparam
+from spendingtracker.cards.utils import get_UUID, get_amount, get_currency, get_datetime, get_desctiption, classify_transaction, get_merchant
+from datetime import datetime, timedelta
 
 
 @login_manager.user_loader
@@ -20,6 +21,10 @@ class User(db.Model, UserMixin):
     lastname = db.Column(db.String(20), nullable=False)
     phone = db.Column(db.String(20), unique=True, nullable=False)
     password = db.Column(db.String(60), nullable=False)
+    # Bumped whenever the user's transactions or cards change, cached reports of an older version are never used
+    data_version = db.Column(db.Integer, nullable=False, default=0)
+    # Number of unread messages in the inbox, kept up to date when messages are added or read (the navbar badge)
+    unread_messages = db.Column(db.Integer, nullable=False, default=0)
     # in Card table, user will be marked/saved as 'owner'
     # lazy=True: SQLAlchemy will load data when necessary in one go
     # One User can have multiple bank Card(s); one-to-many
@@ -28,6 +33,8 @@ class User(db.Model, UserMixin):
     messages = db.relationship('Message', backref='owner', lazy=True)
     logs = db.relationship('Log', backref='owner', lazy=True)
     categorybudgets = db.relationship('Categorybudget', backref='owner', lazy=True)
+    # Categories the user chose for merchants via '/change_category'
+    category_overrides = db.relationship('CategoryOverride', backref='owner', lazy=True)
     # 'uselist=False' means User and e.g. Spending table has one-to-one relationship, i.e. one user can only have one spending setting
     # 'uselist=True' is default, which means User and another table has one-to-many relationship, i.e. one user can have several e.g. cards
     # One User can only have one Spending (habit/record); one-to-one
@@ -103,13 +110,9 @@ class Card(db.Model):
             self.balance = round(self.balance - transaction.amount, 2)
             return True
 
-    # Get total card spending
+    # Get total card spending of the current month
     def get_total_spending(self):
-        totalSpending = 0
-        for transaction in self.transactions:
-            if transaction.timestamp.month == datetime.utcnow().month:
-                totalSpending += transaction.amount
-        return round(totalSpending, 2)
+        return round(MonthlySpending.get_total(card_id=self.id), 2)
 
     # how an object is printed when using 'print'
     def __repr__(self):
@@ -120,6 +123,9 @@ class Card(db.Model):
 class Transaction(db.Model):
 
     __tablename__ = 'transaction'
+    # Transactions are listed per card by time, and filtered by category and time
+    __table_args__ = (db.Index('ix_transaction_card_id_timestamp', 'card_id', 'timestamp'),
+                      db.Index('ix_transaction_card_id_category_timestamp', 'card_id', 'category', 'timestamp'))
     id = db.Column(db.Integer, primary_key=True)
     transactionUUID = db.Column(db.String(50), unique=True, nullable=False)
     amount = db.Column(db.Float, nullable=False)
@@ -130,13 +136,17 @@ class Transaction(db.Model):
     card_id = db.Column(db.Integer, db.ForeignKey('card.id'), nullable=False)
 
     # Generate a random transaction
-    def __init__(self, card_id):
+    # 'overrides' is the card owner's {merchant: category} index, see 'CategoryOverride.get_overrides()'
+    # For a single transaction pass the owner's 'user_id' instead, only the override of its merchant is looked up
+    def __init__(self, card_id, overrides=None, user_id=None):
         self.transactionUUID = get_UUID()
         self.amount = get_amount()
         self.currency = get_currency()
         self.timestamp = get_datetime()
         self.description = get_desctiption()
-        self.category = classify_transaction(self.description)
+        if overrides is None and user_id is not None:
+            overrides = CategoryOverride.get_overrides(user_id, merchant=get_merchant(self.description))
+        self.category = classify_transaction(self.description, overrides=overrides)
         self.card_id = card_id
 
     # how an object is printed when we print it out
@@ -148,6 +158,8 @@ class Transaction(db.Model):
 class Log(db.Model):
 
     __tablename__ = 'log'
+    # The latest logins of a user
+    __table_args__ = (db.Index('ix_log_user_id_id', 'user_id', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), nullable=False)
     login = db.Column(db.String(50), nullable=False)
@@ -170,15 +182,45 @@ class Spending(db.Model):
     budget_set_timestamp = db.Column(db.DateTime)
     # Default currency is GBP
     totalAccountSpending = db.Column(db.Float, default=0)
+    # Month of 'totalAccountSpending', e.g. '2020-03'
+    period = db.Column(db.String(7))
+    # Budget alerts, see 'common/budgets.py':
+    # month of the alert levels, highest alert sent for the overall budget, and 'User.data_version' of the category totals
+    alert_period = db.Column(db.String(7))
+    alert_level = db.Column(db.Integer, nullable=False, default=0)
+    budget_version = db.Column(db.Integer)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
-    def update_spending(self):
-        self.totalAccountSpending = 0
-        for card in self.owner.cards:
-            self.totalAccountSpending += card.get_total_spending()
-        round(self.totalAccountSpending, 2)
+    # Start counting from 0 when a new month begins
+    def roll_over(self):
+        period = datetime.utcnow().strftime('%Y-%m')
+        if self.period != period:
+            self.period = period
+            self.totalAccountSpending = 0
+
+    # Add the amount of a new transaction, transactions of other months don't count
+    def add_spending(self, amount, timestamp):
+        self.roll_over()
+        if timestamp.strftime('%Y-%m') == self.period:
+            self.totalAccountSpending = round((self.totalAccountSpending or 0) + amount, 2)
+
+    # Subtract the amount of a removed transaction (or the spending of a removed card)
+    def subtract_spending(self, amount, timestamp):
+        self.add_spending(-amount, timestamp)
+
+    # Compute the total spending of this month again from all transactions of the user
+    # This scans the user's transactions, it's only used to repair the total, e.g. by 'flask reconcile-spending'
+    def reconcile(self):
+        now = datetime.utcnow()
+        start = datetime(now.year, now.month, 1)
+        end = (start + timedelta(days=32)).replace(day=1)
+        total = db.session.query(db.func.sum(Transaction.amount)).join(Card)\
+            .filter(Card.user_id == self.user_id, Transaction.timestamp >= start, Transaction.timestamp < end).scalar() or 0
+        self.period = now.strftime('%Y-%m')
+        self.totalAccountSpending = round(total, 2)
 
     def check_spending(self):
+        self.roll_over()
         if (self.budget != '' and self.budget != None) and self.totalAccountSpending >= self.budget:
             return True
         else:
@@ -193,15 +235,72 @@ class Spending(db.Model):
 class Message(db.Model):
 
     __tablename__ = 'message'
+    # The inbox lists a user's messages by time
+    __table_args__ = (db.Index('ix_message_user_id_timestamp', 'user_id', 'timestamp'),)
     id = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.DateTime, nullable=False)
     type = db.Column(db.String(20), nullable=False)
     content = db.Column(db.String(1000))
+    read = db.Column(db.Boolean, nullable=False, default=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+    @staticmethod
+    def add_unread(connection, counts):
+        """
+        Count new messages as unread, must be called in the database transaction that inserts them
+        :param connection: connection of the current database transaction
+        :param counts: dict of user id -> number of new messages
+        :return: None
+        """
+        connection.execute(text('UPDATE "user" SET unread_messages = unread_messages + :count WHERE id = :user_id'),
+                           [{'user_id': user_id, 'count': count} for user_id, count in counts.items()])
+
+    @staticmethod
+    def mark_read(user_id, ids=None):
+        """
+        Mark messages of a user as read and update the user's unread count (not committed)
+        :param user_id: user id
+        :param ids: ids of the messages, None for all messages of the user
+        :return: number of messages that were unread
+        """
+        query = Message.query.filter(Message.user_id == user_id, Message.read == False)
+        if ids is not None:
+            query = query.filter(Message.id.in_(ids))
+        count = query.update({Message.read: True}, synchronize_session=False)
+        if count:
+            db.session.execute(text('UPDATE "user" SET unread_messages = MAX(unread_messages - :count, 0) WHERE id = :user_id'),
+                               {'user_id': user_id, 'count': count})
+        return count
+
     # how an object is printed when using 'print'
     def __repr__(self):
-        return f"Message(User:'{self.owner.firstname}', Time:'{self.timestamp}', Type:'{self.type}', Content:'{self.content}')"
+        return f"Message(User:'{self.owner.firstname}', Time:'{self.timestamp}', Type:'{self.type}', Content:'{self.content}', Read:'{self.read}')"
+
+
+# Emails waiting to be sent, see 'common/outbox.py'
+class OutboxEmail(db.Model):
+
+    __tablename__ = 'outbox'
+    # The sender looks for unsent emails that are due
+    __table_args__ = (db.Index('ix_outbox_sent_next_attempt', 'sent', 'next_attempt'),)
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(200), nullable=False)
+    sender = db.Column(db.String(120))
+    # Comma separated email addresses
+    recipients = db.Column(db.String(1000), nullable=False)
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # When the email can be sent (again), None if it has been given up
+    next_attempt = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # Error of the last failed attempt
+    error = db.Column(db.String(500))
+    sent = db.Column(db.DateTime, nullable=True)
+
+    # how an object is printed when using 'print'
+    def __repr__(self):
+        return f"OutboxEmail(To:'{self.recipients}', Subject:'{self.subject}', Attempts:'{self.attempts}', Sent:'{self.sent}')"
 
 
 # User settings preference:
@@ -227,12 +326,273 @@ class Categorybudget(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     category = db.Column(db.String, nullable=False)
     budget = db.Column(db.Float, nullable=False)
+    # Spending of this month in the category and the highest alert sent, see 'common/budgets.py'
+    spending = db.Column(db.Float, nullable=False, default=0)
+    alert_level = db.Column(db.Integer, nullable=False, default=0)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
     def __repr__(self):
         return f"Category Budget(User:'{self.owner.firstname}', Category:'{self.category}', Budget:'￡{self.budget}')"
 
 
+# Category a user chose for a merchant, it's used instead of the matching table for that user's transactions
+class CategoryOverride(db.Model):
+
+    __tablename__ = 'category_override'
+    __table_args__ = (db.UniqueConstraint('user_id', 'merchant'),)
+    id = db.Column(db.Integer, primary_key=True)
+    # Merchant part of the description, see 'get_merchant()'
+    merchant = db.Column(db.String(50), nullable=False)
+    category = db.Column(db.String(50), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+
+    @staticmethod
+    def get_overrides(user_id, merchant=None):
+        """
+        Get the override index of a user, e.g. once for a whole import
+        :param user_id: user id
+        :param merchant: only the override of this merchant, one lookup in the (user_id, merchant) index
+        :return: dict of merchant -> category, e.g. "{'tesco metro': 'Groceries'}"
+        """
+        query = db.session.query(CategoryOverride.merchant, CategoryOverride.category).filter_by(user_id=user_id)
+        if merchant is not None:
+            query = query.filter_by(merchant=merchant)
+        return dict(query)
+
+    @staticmethod
+    def set_override(user_id, description, category):
+        """
+        Remember the category a user chose for the merchant of a description (not committed)
+        :param user_id: user id
+        :param description: description of a transaction, e.g. 'Tesco Metro, Nottingham, England'
+        :param category: the category the user chose
+        :return: CategoryOverride
+        """
+        merchant = get_merchant(description)
+        override = CategoryOverride.query.filter_by(user_id=user_id, merchant=merchant).first()
+        if override is None:
+            override = CategoryOverride(merchant=merchant, category=category, user_id=user_id)
+            db.session.add(override)
+        else:
+            override.category = category
+        return override
+
+    def __repr__(self):
+        return f"Category Override(User:'{self.owner.firstname}', Merchant:'{self.merchant}', Category:'{self.category}')"
+
+
+# Spending rollups: totals of the 'transaction' table per period, kept up to date with it
+class SpendingRollup:
+    """
+    Base of the spending rollup tables: the sum and count of transactions per user, card, period and category.
+    A subclass (a 'db.Model', so the base can't be an ABC) declares:
+        1. its period columns and 'periods', the SQL that computes each period column from a transaction's
+           timestamp 't.timestamp'
+        2. the classmethod 'get_period(timestamp)', the same values computed in Python for one transaction,
+           a dictionary of period columns and values, e.g. "{'year': 2020, 'month': 5}"
+    The rollups are kept up to date by the events below, changes that skip the ORM (e.g. 'Query.update()')
+    must call 'add_transactions()' themselves.
+    """
+    periods = {}
+
+    @classmethod
+    def get_key(cls):
+        return ', '.join(['user_id', 'card_id'] + list(cls.periods) + ['category'])
+
+    @classmethod
+    def add(cls, connection, card_id, timestamp, category, amount, count):
+        """
+        Add (or subtract, with negative values) spending to the row of a card, period and category
+        :param connection: connection of the current database transaction
+        :return: None
+        """
+        period = cls.get_period(timestamp)
+        connection.execute(text(
+            f'INSERT INTO {cls.__tablename__} ({cls.get_key()}, amount, count) '
+            f'SELECT user_id, :card_id, {", ".join(":" + column for column in period)}, :category, :amount, :count FROM card WHERE id = :card_id '
+            f'ON CONFLICT ({cls.get_key()}) '
+            'DO UPDATE SET amount = amount + excluded.amount, count = count + excluded.count'),
+            card_id=card_id, category=category, amount=amount, count=count, **period)
+
+    @classmethod
+    def add_transactions(cls, connection, where, params, sign=1, category=None):
+        """
+        Add (sign=1) or subtract (sign=-1) the transactions matching a condition, used after bulk changes
+        that don't go through the ORM, e.g. 'Query.update()'
+        :param connection: connection of the current database transaction
+        :param where: SQL condition on the 'transaction' table, e.g. 'description IN :descriptions'
+        :param params: parameters of the condition
+        :param sign: 1 to add, -1 to subtract
+        :param category: count the transactions in this category instead of their own
+        :return: None
+        """
+        columns = len(cls.periods) + 3
+        statement = text(
+            f'INSERT INTO {cls.__tablename__} ({cls.get_key()}, amount, count) '
+            f'SELECT card.user_id, t.card_id, {", ".join(cls.periods.values())}, COALESCE(:new_category, t.category), '
+            ':sign * SUM(t.amount), :sign * COUNT(*) '
+            f'FROM "transaction" AS t JOIN card ON card.id = t.card_id WHERE {where} '
+            f'GROUP BY {", ".join(str(column) for column in range(1, columns + 1))} '
+            f'ON CONFLICT ({cls.get_key()}) '
+            'DO UPDATE SET amount = amount + excluded.amount, count = count + excluded.count')
+        # Lists and tuples are used with 'IN'
+        statement = statement.bindparams(*[bindparam(key, expanding=True) for key, value in params.items() if isinstance(value, (list, tuple))])
+        connection.execute(statement, new_category=category, sign=sign, **params)
+
+    @classmethod
+    def delete_card(cls, connection, card_id):
+        connection.execute(text(f'DELETE FROM {cls.__tablename__} WHERE card_id = :card_id'), card_id=card_id)
+
+    @classmethod
+    def rebuild(cls, connection):
+        """
+        Compute the whole table again from the 'transaction' table
+        :param connection: connection of the current database transaction
+        :return: None
+        """
+        connection.execute(text(f'DELETE FROM {cls.__tablename__}'))
+        cls.add_transactions(connection, '1 = 1', {})
+
+
+# Total spending of every card per month and category
+class MonthlySpending(SpendingRollup, db.Model):
+
+    __tablename__ = 'monthly_spending'
+    __table_args__ = (db.UniqueConstraint('user_id', 'card_id', 'year', 'month', 'category'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    card_id = db.Column(db.Integer, db.ForeignKey('card.id'), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    category = db.Column(db.String(50), nullable=False)
+    amount = db.Column(db.Float, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    periods = {
+        'year': 'CAST(strftime(\'%Y\', t.timestamp) AS INTEGER)',
+        'month': 'CAST(strftime(\'%m\', t.timestamp) AS INTEGER)',
+    }
+
+    @classmethod
+    def get_period(cls, timestamp):
+        return {'year': timestamp.year, 'month': timestamp.month}
+
+    @staticmethod
+    def get_total(user_id=None, card_id=None, category=None, year=None, month=None):
+        """
+        Get the total spending of a user or a card in a month
+        :param user_id: user id, or None to only filter by card
+        :param card_id: card id, or None for all cards of the user
+        :param category: category, or None for all categories
+        :param year: year, default is the current year
+        :param month: month, default is the current month
+        :return: total spending (float)
+        """
+        now = datetime.utcnow()
+        query = db.session.query(db.func.sum(MonthlySpending.amount)).filter_by(year=year or now.year, month=month or now.month)
+        if user_id is not None:
+            query = query.filter_by(user_id=user_id)
+        if card_id is not None:
+            query = query.filter_by(card_id=card_id)
+        if category is not None:
+            query = query.filter_by(category=category)
+        return query.scalar() or 0
+
+    def __repr__(self):
+        return f"Monthly Spending(CardID:'{self.card_id}', Month:'{self.year}-{self.month}', Category:'{self.category}', Amount:'{self.amount}', Count:'{self.count}')"
+
+
+# Total spending of every card per day and category
+class DailySpending(SpendingRollup, db.Model):
+
+    __tablename__ = 'daily_spending'
+    __table_args__ = (db.UniqueConstraint('user_id', 'card_id', 'date', 'category'),
+                      db.Index('ix_daily_spending_user_id_date', 'user_id', 'date'))
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    card_id = db.Column(db.Integer, db.ForeignKey('card.id'), nullable=False)
+    # "%Y-%m-%d"
+    date = db.Column(db.String(10), nullable=False)
+    category = db.Column(db.String(50), nullable=False)
+    amount = db.Column(db.Float, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    periods = {
+        'date': 'date(t.timestamp)',
+    }
+
+    @classmethod
+    def get_period(cls, timestamp):
+        return {'date': timestamp.strftime('%Y-%m-%d')}
+
+    def __repr__(self):
+        return f"Daily Spending(CardID:'{self.card_id}', Date:'{self.date}', Category:'{self.category}', Amount:'{self.amount}', Count:'{self.count}')"
+
+
+# Every rollup table, in the order they are updated
+ROLLUPS = [MonthlySpending, DailySpending]
+
+
+# Keep the rollups up to date in the same database transaction as the change to 'transaction'
+@event.listens_for(Transaction, 'after_insert')
+def transaction_inserted(mapper, connection, target):
+    for rollup in ROLLUPS:
+        rollup.add(connection, target.card_id, target.timestamp, target.category, target.amount, 1)
+
+
+@event.listens_for(Transaction, 'after_delete')
+def transaction_deleted(mapper, connection, target):
+    for rollup in ROLLUPS:
+        rollup.add(connection, target.card_id, target.timestamp, target.category, -target.amount, -1)
+
+
+@event.listens_for(Transaction, 'after_update')
+def transaction_updated(mapper, connection, target):
+    state = inspect(target)
+    old = {}
+    for attribute in ('card_id', 'timestamp', 'category', 'amount'):
+        history = state.attrs[attribute].history
+        old[attribute] = history.deleted[0] if history.deleted else getattr(target, attribute)
+    if old != {attribute: getattr(target, attribute) for attribute in old}:
+        for rollup in ROLLUPS:
+            rollup.add(connection, old['card_id'], old['timestamp'], old['category'], -old['amount'], -1)
+            rollup.add(connection, target.card_id, target.timestamp, target.category, target.amount, 1)
+
+
+@event.listens_for(Card, 'after_delete')
+def card_deleted(mapper, connection, target):
+    for rollup in ROLLUPS:
+        rollup.delete_card(connection, target.id)
+
+
+def bump_data_version(connection, user_id):
+    """
+    Mark the user's data as changed, see 'User.data_version'
+    :param connection: connection of the current database transaction
+    :param user_id: user id, or None to bump every user
+    :return: None
+    """
+    if user_id is None:
+        connection.execute(text('UPDATE "user" SET data_version = data_version + 1'))
+    else:
+        connection.execute(text('UPDATE "user" SET data_version = data_version + 1 WHERE id = :user_id'), user_id=user_id)
+
+
+@event.listens_for(Transaction, 'after_insert')
+@event.listens_for(Transaction, 'after_update')
+@event.listens_for(Transaction, 'after_delete')
+def transaction_changed(mapper, connection, target):
+    connection.execute(text('UPDATE "user" SET data_version = data_version + 1 WHERE id = (SELECT user_id FROM card WHERE id = :card_id)'),
+                       card_id=target.card_id)
+
+
+@event.listens_for(Card, 'after_insert')
+@event.listens_for(Card, 'after_update')
+@event.listens_for(Card, 'after_delete')
+def card_changed(mapper, connection, target):
+    bump_data_version(connection, target.user_id)
+
+
 class UserSchema(ma.ModelSchema):
     class Meta:
         model = User
@@ -0,0 +1,167 @@
+import numpy as np
+from datetime import datetime, timedelta
+from spendingtracker import db, bcrypt
+from spendingtracker.models import User, Card, Transaction, ROLLUPS
+from spendingtracker.cards.utils import parse_descriptions, classify_transactions
+from spendingtracker.common.tables import tables
+
+
+# Synthetic data for load and scale testing, see 'flask seed'
+# Rows generated and inserted per database transaction
+CHUNK_SIZE = 200000
+FIRSTNAMES = ['Oliver', 'Amelia', 'George', 'Isla', 'Harry', 'Ava', 'Noah', 'Mia', 'Jack', 'Ivy', 'Leo', 'Lily', 'Arthur',
+              'Freya', 'Muhammad', 'Grace', 'Oscar', 'Sophia', 'Charlie', 'Emily', 'Wei', 'Priya', 'Kofi', 'Sara']
+LASTNAMES = ['Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson', 'Johnson', 'Davies', 'Patel', 'Wright', 'Robinson',
+             'Thompson', 'Evans', 'Walker', 'White', 'Roberts', 'Green', 'Hall', 'Wood', 'Khan', 'Chen', 'Okafor']
+
+
+def get_next_id(connection, model):
+    return (connection.execute(f'SELECT MAX(id) FROM "{model.__tablename__}"').scalar() or 0) + 1
+
+
+def seed_users(connection, rng, users, password):
+    """
+    Insert users with their spending and preference rows
+    :param connection: SQLAlchemy connection in a transaction
+    :param rng: numpy Generator
+    :param users: number of users
+    :param password: password of every user, it's hashed once
+    :return: ids of the new users (numpy array)
+    """
+    first_id = get_next_id(connection, User)
+    ids = np.arange(first_id, first_id + users)
+    firstnames = np.array(FIRSTNAMES, dtype=object)[rng.integers(len(FIRSTNAMES), size=users)]
+    lastnames = np.array(LASTNAMES, dtype=object)[rng.integers(len(LASTNAMES), size=users)]
+    # bcrypt is slow on purpose, every user gets the same hash
+    password = bcrypt.generate_password_hash(password).decode('utf-8')
+    cursor = connection.connection.cursor()
+    cursor.executemany('INSERT INTO "user" (id, email, firstname, lastname, phone, password, data_version, unread_messages) '
+                       'VALUES (?, ?, ?, ?, ?, ?, 0, 0)',
+                       [(id, f'{first.lower()}.{last.lower()}.{id}@example.com', first, last, f'0700{id:08d}', password)
+                        for id, first, last in zip(ids.tolist(), firstnames, lastnames)])
+    cursor.executemany('INSERT INTO spending ("totalAccountSpending", alert_level, user_id) VALUES (0, 0, ?)', [(id,) for id in ids.tolist()])
+    cursor.executemany('INSERT INTO preference (budget, balance, report, user_id) VALUES (1, 1, 1, ?)', [(id,) for id in ids.tolist()])
+    return ids
+
+
+def seed_cards(connection, rng, user_ids, cards):
+    """
+    Insert 'cards' cards for every user
+    :return: ids of the new cards (numpy array)
+    """
+    first_id = get_next_id(connection, Card)
+    ids = np.arange(first_id, first_id + len(user_ids) * cards)
+    owners = np.repeat(user_ids, cards)
+    sort_codes = rng.integers(100000, 1000000, size=len(ids))
+    balances = np.round(rng.uniform(100, 3000, size=len(ids)), 2)
+    cursor = connection.connection.cursor()
+    cursor.executemany('INSERT INTO card (id, sort_code, account_number, card_name, balance, user_id) VALUES (?, ?, ?, ?, ?, ?)',
+                       [(id, f'{code // 10000:02d}-{code // 100 % 100:02d}-{code % 100:02d}', f'70{id:09d}', f'Card {number + 1}', balance, owner)
+                        for id, code, number, balance, owner in zip(ids.tolist(), sort_codes.tolist(), (np.arange(len(ids)) % cards).tolist(),
+                                                                    balances.tolist(), owners.tolist())])
+    return ids
+
+
+def get_day_weights(start, days):
+    # People spend more at the end of the week
+    weekdays = (np.arange(days) + start.weekday()) % 7
+    weights = np.array([0.9, 0.9, 0.95, 1.0, 1.3, 1.4, 1.1])[weekdays]
+    return weights / weights.sum()
+
+
+def seed_transactions(connection, rng, card_ids, per_card, start, days):
+    """
+    Insert 'per_card' transactions for every card, generated with numpy 'CHUNK_SIZE' rows at a time:
+        1. Dates are spread over the 'days' days from 'start', with more spending on Fridays and Saturdays,
+           and times around the middle of the day
+        2. Amounts are log-normal (mostly small, a few large) between 1 and 200, like 'get_amount()'
+        3. Merchants follow a popularity curve, each description is classified once
+    Each card's transactions are inserted in time order, and the UUIDs start with the row id, so every index is
+    appended to rather than updated at random places.
+    :return: (id of the first inserted transaction, number of inserted transactions)
+    """
+    descriptions = np.array(tables.get('spendingtracker/cards/transactions.txt', parse_descriptions).value, dtype=object)
+    categories = np.array(classify_transactions(list(descriptions)), dtype=object)
+    popularity = 1 / np.arange(1, len(descriptions) + 1)
+    popularity = rng.permutation(popularity / popularity.sum())
+    day_weights = get_day_weights(start, days)
+    start = np.datetime64(start, 'us')
+    first_id = next_id = get_next_id(connection, Transaction)
+    cards_per_chunk = max(1, CHUNK_SIZE // per_card)
+    cursor = connection.connection.cursor()
+    for i in range(0, len(card_ids), cards_per_chunk):
+        chunk_cards = card_ids[i:i + cards_per_chunk]
+        size = len(chunk_cards) * per_card
+        cards = np.repeat(chunk_cards, per_card)
+        day = rng.choice(days, size=size, p=day_weights)
+        # Microseconds since midnight, most spending is between 9:30 and 17:30
+        time = np.clip(rng.normal(13.5 * 3600, 4 * 3600, size=size) * 10 ** 6, 0, 86400 * 10 ** 6 - 1).astype(np.int64)
+        timestamps = start + (day * 86400 * 10 ** 6 + time).astype('timedelta64[us]')
+        order = np.lexsort((timestamps, cards))
+        cards, timestamps = cards[order], timestamps[order]
+        merchants = rng.choice(len(descriptions), size=size, p=popularity)
+        amounts = np.round(np.clip(rng.lognormal(np.log(18), 0.9, size=size), 1, 200), 2)
+        ids = np.arange(next_id, next_id + size)
+        suffixes = rng.integers(16 ** 12, size=size, dtype=np.int64)
+        cursor.executemany('INSERT INTO "transaction" (id, "transactionUUID", amount, currency, timestamp, description, category, card_id) '
+                           "VALUES (?, ?, ?, 'GBP', replace(?, 'T', ' '), ?, ?, ?)",
+                           zip(ids.tolist(),
+                               [f'{id:08x}-5eed-4000-8000-{suffix:012x}' for id, suffix in zip(ids.tolist(), suffixes.tolist())],
+                               amounts.tolist(),
+                               np.datetime_as_string(timestamps, unit='us').tolist(),
+                               descriptions[merchants].tolist(),
+                               categories[merchants].tolist(),
+                               cards.tolist()))
+        connection.connection.commit()
+        next_id += size
+        print(f"Seed: {i * per_card + size} of {len(card_ids) * per_card} transactions inserted")
+    return first_id, len(card_ids) * per_card
+
+
+def seed_database(users, cards, transactions, months=12, seed=0, password='password', end_date=None):
+    """
+    Add synthetic users, cards and transactions to the database of the current app, e.g. for load tests.
+    Existing data is kept: new rows get ids after the existing ones, and the rollups, total spending and
+    statistics of the query planner are computed for the new rows at the end.
+    The same arguments, seed and 'end_date' give the same data. Emails, account numbers and UUIDs contain the
+    row ids, so those only match when the run starts from the same database, e.g. an empty one.
+    :param users: number of users
+    :param cards: number of cards per user
+    :param transactions: number of transactions per card
+    :param months: the transactions are spread over this many months before 'end_date'
+    :param seed: seed of the random generator
+    :param end_date: date (datetime) after the last transaction, defaults to today (UTC) so no transaction is in the future
+    :param password: password of every new user
+    :return: (number of users, number of cards, number of transactions)
+    """
+    rng = np.random.default_rng(seed)
+    end_date = (end_date or datetime.utcnow()).replace(hour=0, minute=0, second=0, microsecond=0)
+    days = round(months * 30.44)
+    start = end_date - timedelta(days=days)
+    with db.engine.connect() as connection:
+        synchronous = connection.execute('PRAGMA synchronous').scalar()
+        # Nothing is written to disk until a chunk is committed, and a crash can corrupt the file: only for test data
+        connection.execute('PRAGMA synchronous = OFF')
+        connection.execute('PRAGMA cache_size = -262144')
+        try:
+            user_ids = seed_users(connection, rng, users, password)
+            card_ids = seed_cards(connection, rng, user_ids, cards)
+            connection.connection.commit()
+            first_transaction, count = seed_transactions(connection, rng, card_ids, transactions, start, days)
+            # Without statistics of the new rows the planner runs the queries below in O(cards * rows) or O(users * rows)
+            connection.execute('PRAGMA analysis_limit = 1000')
+            connection.execute('ANALYZE')
+            with connection.begin():
+                # Only the new transactions are added to the rollups, in one scan of the rowid range
+                for rollup in ROLLUPS:
+                    rollup.add_transactions(connection, 't.id >= :first_transaction', {'first_transaction': first_transaction})
+            connection.execute('ANALYZE')
+            with connection.begin():
+                now = datetime.utcnow()
+                connection.execute('UPDATE spending SET period = :period, "totalAccountSpending" = ROUND(COALESCE(('
+                                   'SELECT SUM(amount) FROM monthly_spending WHERE user_id = spending.user_id AND year = :year AND month = :month'
+                                   '), 0), 2) WHERE user_id >= :first_user',
+                                   period=now.strftime('%Y-%m'), year=now.year, month=now.month, first_user=int(user_ids[0]))
+        finally:
+            connection.execute(f'PRAGMA synchronous = {synchronous}')
+    return len(user_ids), len(card_ids), count
@@ -34,7 +34,7 @@ $(document).ready(function() {
 // This function will:
 // ---> Remove any previous chart so a new updated chart can be placed into the DOM
 // ---> Empty the chart data
-// ---> Inputs new chart data depending on the dates selected on the datatable
+// ---> Inputs the spending per category of the card (all of its transactions, not only the loaded pages)
 // ---> Constructs the new chart - builds the SVG
 function updateChart() {
     removePreviousChart();
@@ -43,22 +43,28 @@ function updateChart() {
     displayChart(chart);
 }
 
-// Helper function to determine what data to select depending on the date range selected on the datatable
-// If no dates are selected then add all transaction data within the donut chart
+// Helper function to add the spending per category to the donut chart
+// 'category_spending' is the card's whole history on page load, or the date range selected on the datatable
 function filterCategoryInsertion() {
-    if (dateFrom === "" && dateTo === "") {
-        for (let i = 0; i < transaction_json.length; i ++)
-            addCategoryData(chart, transaction_json[i].category, transaction_json[i].amount, null);
-    }
-    else if (dateFrom !== "" && dateTo !== "") {
-        let dateFromObj = new Date(dateFrom);
-        let dateToObj = new Date(dateTo);
-        for (let i = 0; i < transaction_json.length; i++) {
-            let dateObj = new Date(transaction_json[i].timestamp.substring(0, 10));
-            if (dateFromObj <= dateObj && dateObj <= dateToObj)
-                addCategoryData(chart, transaction_json[i].category, transaction_json[i].amount, null);
+    for (let category in category_spending)
+        addCategoryData(chart, category, category_spending[category], null);
+}
+
+// Function to fetch the spending per category between the selected dates from the server and redraw the chart
+function loadCategorySpending() {
+    $.ajax({
+        url : '/api/category_spending',
+        data : {
+            card_id : card_id,
+            start : dateFrom,
+            end : dateTo
+        },
+        type : 'GET',
+        success: function (data) {
+            category_spending = data.spending;
+            updateChart();
         }
-    }
+    });
 }
 
 // Function to remove the transaction location from the transaction description
@@ -77,6 +83,65 @@ function formatTransactions() {
     datatable.draw();
 }
 
+// Helper function to escape text before it's put into the table as HTML
+function escapeHtml(text) {
+    return $('<div>').text(text).html();
+}
+
+// Helper function to build the change category dropdown of a transaction, same as the one in accounts.html
+function categoryDropdown(transaction) {
+    let html = '<div class="dropdown">' +
+        '<button class="dropdown-toggle" type="button" id="changeButton" data-toggle="dropdown" style="border: none;"></button>' +
+        '<div class="dropdown-menu" id="changeDropdown" style="padding: 15px;"><form>';
+    for (let i = 0; i < all_categories.length; i++) {
+        let category = escapeHtml(all_categories[i]);
+        let checked = all_categories[i].includes(transaction.category) ? ' checked' : '';
+        html += '<div class="form-check">' +
+            '<input class="form-check-input ' + transaction.id + '" type="radio" name="radios" value="' + category + '"' + checked + '>' +
+            '<label class="form-check-label" for="' + category + '">' + category + '</label></div>';
+    }
+    html += '<button type="button" class="btn btn-primary" data-toggle="dropdown" id="' + transaction.id + '" onclick="changeCategory(id)">Change</button>' +
+        '</form></div></div>';
+    return html;
+}
+
+// Function to fetch the next page of transactions from the server and add them to the table
+// The descriptions are formatted here because formatTransactions() only runs once on page load
+function loadMoreTransactions() {
+    if (next_cursor === null) {
+        return;
+    }
+    $.ajax({
+        url : '/api/transactions',
+        data : {
+            card_id : card_id,
+            cursor : next_cursor
+        },
+        type : 'GET',
+        success: function (data) {
+            let rows = [];
+            for (let i = 0; i < data.transactions.length; i++) {
+                let transaction = data.transactions[i];
+                let splitAt = transaction.description.indexOf(',');
+                transaction_json.push(transaction);
+                rows.push([
+                    escapeHtml(splitAt === -1 ? transaction.description : transaction.description.slice(0, splitAt)),
+                    transaction.timestamp.substring(0, 10),
+                    '£' + transaction.amount,
+                    escapeHtml(transaction.category),
+                    categoryDropdown(transaction)
+                ]);
+            }
+            datatable.rows.add(rows).draw(false);
+            next_cursor = data.next_cursor;
+            if (next_cursor === null) {
+                $('#loadMoreButton').hide();
+            }
+            sumTableData();
+        }
+    });
+}
+
 // Helper function for the date search to convert dates into a numerical value like '20200504'
 function parseDateValue(rawDate) {
     let dateArray = rawDate.split("-");
@@ -158,7 +223,7 @@ function datesSearch() {
     datatable.draw();
 
     sumTableData();
-    updateChart();
+    loadCategorySpending();
 }
 
 // function to generate the total for the current page of the table
@@ -26,15 +26,11 @@ function create() {
         let card_id = carouselSlides[i].attributes[2].value;
         // This card_id is then used to fetch the correct element in the DOM to add the SVG
         let graph = constructGraph(card_id, chartDiv.clientWidth, chartDiv.clientHeight);
-        // Loop through user transactions and only add data into chart if they are dated with the current month and year
-        // This also only fetches and adds transactions to the chart associated with the card_id
-        for (let j = 0; j < transaction_json.length; j++) {
-            let transactionDate = new Date(transaction_json[j].timestamp);
-            if (currentMonth === transactionDate.getMonth() && currentYear === transactionDate.getFullYear()) {
-                if (transaction_json[j].card === parseInt(card_id)) {
-                    let str = transaction_json[j].timestamp;
-                    addDateValue(graph, str.substring(0, 10), transaction_json[j].amount);
-                }
+        // Loop through this month's chart points ([card id, date, amount]) and only add the ones
+        // associated with the card_id
+        for (let j = 0; j < chart_json.length; j++) {
+            if (chart_json[j][0] === parseInt(card_id)) {
+                addDateValue(graph, chart_json[j][1], chart_json[j][2]);
             }
         }
         displayGraph(graph);
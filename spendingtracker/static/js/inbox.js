@@ -1,23 +1,78 @@
+let datatable;
+
 //Initialises datatable for the inbox on page load
 $(document).ready(function() {
-    $('#inboxTable').DataTable({
+    datatable = $('#inboxTable').DataTable({
           "columns": [
             {"name": "Message", "orderable": true},
             {"name": "Date", "orderable": true},
         ],
-        data: formatMessages()
-    })
+        "order": [],
+        data: formatMessages(messages_json)
+    });
+    markRead(messages_json);
 });
 
-// Formats message data so it can be displayed in the datatable
-function formatMessages() {
+// Escapes text before it is put into the table as HTML
+function escapeHtml(text) {
+    return $('<div>').text(text).html();
+}
+
+// Formats message data so it can be displayed in the datatable, unread messages are shown in bold
+function formatMessages(messages) {
     let formattedData = [];
-    for (let i = 0; i < messages_json.length; i++) {
-        date = messages_json[i].timestamp.substring(0, 10);
-        time = messages_json[i].timestamp.substring(11, 19);
+    for (let i = 0; i < messages.length; i++) {
+        date = messages[i].timestamp.substring(0, 10);
+        time = messages[i].timestamp.substring(11, 19);
         timestamp = date + " " + time;
-        formattedData.push([messages_json[i].content, timestamp]);
+        let content = escapeHtml(messages[i].content);
+        if (!messages[i].read) {
+            content = '<b>' + content + '</b> <span class="badge badge-primary">New</span>';
+        }
+        formattedData.push([content, timestamp]);
     }
 
     return formattedData;
-}
\ No newline at end of file
+}
+
+// Marks the unread messages that are shown as read and updates the navbar badge
+function markRead(messages) {
+    let ids = [];
+    for (let i = 0; i < messages.length; i++) {
+        if (!messages[i].read) {
+            ids.push(messages[i].id);
+        }
+    }
+    if (ids.length === 0) {
+        return;
+    }
+    $.ajax({
+        url : '/api/messages/read',
+        data : {ids : ids},
+        traditional : true,
+        type : 'POST',
+        success: function (data) {
+            $('#unreadBadge').text(data.unread).prop('hidden', data.unread === 0);
+        }
+    });
+}
+
+// Loads the next page of older messages from '/api/messages' and adds it to the table
+function loadMoreMessages() {
+    if (next_cursor === null) {
+        return;
+    }
+    $.ajax({
+        url : '/api/messages',
+        data : {cursor : next_cursor},
+        type : 'GET',
+        success: function (data) {
+            datatable.rows.add(formatMessages(data.messages)).draw(false);
+            markRead(data.messages);
+            next_cursor = data.next_cursor;
+            if (next_cursor === null) {
+                $('#loadMoreButton').hide();
+            }
+        }
+    });
+}
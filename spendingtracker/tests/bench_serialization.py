@@ -0,0 +1,71 @@
+"""
+Microbenchmark of transaction serialization: per-row 'TransactionSchema().dump()' (what the list views used to do),
+'TransactionSchema(many=True).dump()', and 'transaction_serializer' from 'common/serializers.py'.
+It uses an in-memory database, run it from the repository root:
+    python -m spendingtracker.tests.bench_serialization --rows 10000
+"""
+import argparse, json, timeit, uuid
+from datetime import datetime, timedelta
+from spendingtracker import create_app, db
+from spendingtracker.config import Config
+from spendingtracker.models import User, Card, Transaction, TransactionSchema
+from spendingtracker.common.serializers import transaction_serializer, dumps
+
+
+class BenchmarkConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    CLASSIFICATION_CACHE_PATH = None
+
+
+def fill_database(rows):
+    user = User(firstname='Bench', lastname='Mark', email='bench@example.com', phone='07000000000', password='x')
+    db.session.add(user)
+    db.session.flush()
+    card = Card(sort_code='123456', card_name='Bench', account_number='12345678', balance=0, owner=user)
+    db.session.add(card)
+    db.session.flush()
+    start = datetime(2020, 1, 1)
+    # Core insert, the rollups aren't needed here
+    db.session.execute(Transaction.__table__.insert(), [{
+        'transactionUUID': str(uuid.uuid4()), 'amount': round(i % 97 + 0.99, 2), 'currency': 'GBP',
+        'timestamp': start + timedelta(minutes=i), 'description': f'Tesco {i % 50}, London', 'category': 'Food',
+        'card_id': card.id} for i in range(rows)])
+    db.session.commit()
+    return card.id
+
+
+def per_row_schema(card_id):
+    schema = TransactionSchema()
+    transactions = [schema.dump(transaction) for transaction in Transaction.query.filter_by(card_id=card_id)]
+    return json.dumps(transactions)
+
+
+def many_schema(card_id):
+    transactions = TransactionSchema(many=True).dump(Transaction.query.filter_by(card_id=card_id))
+    return json.dumps(transactions)
+
+
+def row_serializer(card_id):
+    transactions = transaction_serializer.dump(transaction_serializer.query().filter(Transaction.card_id == card_id))
+    return dumps(transactions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000, help='number of transactions')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each method, the best one is reported')
+    args = parser.parse_args()
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        card_id = fill_database(args.rows)
+        # All methods must give the same JSON
+        assert json.loads(per_row_schema(card_id)) == json.loads(many_schema(card_id)) == json.loads(row_serializer(card_id))
+        for method in (per_row_schema, many_schema, row_serializer):
+            # New session every run so ORM objects aren't reused from the identity map
+            seconds = min(timeit.repeat(lambda: (method(card_id), db.session.remove()), number=1, repeat=args.repeat))
+            print(f"{method.__name__:16} {seconds * 1000:9.1f} ms  {args.rows / seconds:12,.0f} rows/s")
+
+
+if __name__ == '__main__':
+    main()
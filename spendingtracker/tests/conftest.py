@@ -0,0 +1,90 @@
+import pytest
+from spendingtracker import create_app, db
+from spendingtracker.config import Config
+from spendingtracker.models import User, Card, ROLLUPS
+
+
+def make_app(tmp_path, **settings):
+    """
+    App with an empty database of its own, no background threads and no emails sent
+    :param settings: config values to change, e.g. the mail server
+    """
+    class TestConfig(Config):
+        TESTING = True
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / 'site.db'}"
+        SQLALCHEMY_TRACK_MODIFICATIONS = False
+        CLASSIFICATION_CACHE_PATH = None
+        OUTBOX_SENDER_THREAD = False
+        JOB_QUEUE_WORKERS = 0
+        WTF_CSRF_ENABLED = False
+    for name, value in settings.items():
+        setattr(TestConfig, name, value)
+    return create_app(TestConfig)
+
+
+def dispose(app):
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = make_app(tmp_path)
+    yield app
+    dispose(app)
+
+
+def add_user(app, cards=1, balance=100000, email='test@example.com'):
+    """
+    Add a user with 'cards' cards
+    :return: (user id, list of card ids)
+    """
+    with app.app_context():
+        user = User(firstname='Test', lastname='User', email=email, phone=email[:20], password='x')
+        db.session.add(user)
+        db.session.flush()
+        card_list = [Card(sort_code='12-34-56', account_number=f'{user.id:04d}{i:04d}', card_name=f'Card {i}', balance=balance, owner=user)
+                     for i in range(cards)]
+        db.session.add_all(card_list)
+        db.session.commit()
+        return user.id, [card.id for card in card_list]
+
+
+@pytest.fixture
+def user(app):
+    return add_user(app, cards=2)
+
+
+@pytest.fixture
+def client(app, user):
+    """
+    Test client logged in as 'user'
+    """
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user[0])
+        session['_fresh'] = True
+    return client
+
+
+def get_rollups():
+    # Rows with a count of 0 are left behind by changes, a rebuild doesn't have them
+    result = {}
+    for rollup in ROLLUPS:
+        rows = db.engine.execute(f'SELECT {rollup.get_key()}, ROUND(amount, 2), count FROM {rollup.__tablename__} WHERE count != 0')
+        result[rollup.__tablename__] = sorted(tuple(row) for row in rows)
+    return result
+
+
+def assert_rollups_rebuilt(app):
+    """
+    The rollups kept up to date incrementally must be the same as computed again from all transactions
+    """
+    with app.app_context():
+        incremental = get_rollups()
+        with db.engine.begin() as connection:
+            for rollup in ROLLUPS:
+                rollup.rebuild(connection)
+        assert incremental == get_rollups()
+        return incremental
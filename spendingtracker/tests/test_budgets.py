@@ -0,0 +1,82 @@
+"""
+Budget alerts have hysteresis: each level is alerted once, and only again after the spending fell 'rearm_margin'
+below its threshold. The category spending used for the alerts is a running total, it must be read again from
+'monthly_spending' after any other change of the user's data.
+"""
+from datetime import datetime
+from spendingtracker import db
+from spendingtracker.models import User, Transaction, Categorybudget
+from spendingtracker.common.budgets import get_alert_level, evaluate_budgets, SAFE, CLOSE, OVER
+
+
+def test_alert_levels():
+    assert get_alert_level(49.99, 100, SAFE, 50, 10) == SAFE
+    assert get_alert_level(50, 100, SAFE, 50, 10) == CLOSE
+    assert get_alert_level(100, 100, SAFE, 50, 10) == CLOSE
+    assert get_alert_level(100.01, 100, SAFE, 50, 10) == OVER
+    # Without a close margin there is no 'CLOSE' level
+    assert get_alert_level(99, 100, SAFE) == SAFE
+    assert get_alert_level(100.01, 100, SAFE) == OVER
+    # A lower alerted level never hides a higher one
+    assert get_alert_level(150, 100, CLOSE, 50, 10) == OVER
+
+
+def test_alerted_level_is_kept_until_rearmed():
+    # Over the budget, then back just under it: still 'OVER' until the spending falls 10 below the budget
+    assert get_alert_level(95, 100, OVER, 50, 10) == OVER
+    assert get_alert_level(90.01, 100, OVER, 50, 10) == OVER
+    assert get_alert_level(90, 100, OVER, 50, 10) == CLOSE
+    # Then 'CLOSE' is kept until 10 below its own threshold
+    assert get_alert_level(40.01, 100, OVER, 50, 10) == CLOSE
+    assert get_alert_level(40, 100, OVER, 50, 10) == SAFE
+    assert get_alert_level(45, 100, CLOSE, 50, 10) == CLOSE
+    assert get_alert_level(40, 100, CLOSE, 50, 10) == SAFE
+    # A category budget has no 'CLOSE' level to fall back to
+    assert get_alert_level(95, 100, OVER, rearm_margin=10) == OVER
+    assert get_alert_level(90, 100, OVER, rearm_margin=10) == SAFE
+    # No margin: any spending under the threshold rearms it
+    assert get_alert_level(100, 100, OVER) == SAFE
+
+
+def spend(user_id, card_id, amount, category):
+    """
+    Add a transaction of this month like '/generate_transaction' does, and evaluate the budgets
+    :return: list of new alerts (category or None, level, spending)
+    """
+    user = User.query.get(user_id)
+    transaction = Transaction(card_id)
+    transaction.amount = amount
+    transaction.category = category
+    transaction.timestamp = datetime.utcnow()
+    version = user.data_version
+    db.session.add(transaction)
+    user.spending.add_spending(amount, transaction.timestamp)
+    alerts = [(categorybudget.category if categorybudget else None, level, spending)
+              for categorybudget, level, spending in evaluate_budgets(user, transaction, version)]
+    db.session.commit()
+    return alerts
+
+
+def test_evaluate_budgets(app, user):
+    user_id, (card_id, _) = user
+    with app.app_context():
+        owner = User.query.get(user_id)
+        owner.spending.budget = 200
+        db.session.add(Categorybudget(category='Food', budget=100, owner=owner))
+        db.session.commit()
+        assert spend(user_id, card_id, 60, 'Food') == []
+        assert spend(user_id, card_id, 50, 'Food') == [('Food', OVER, 110)]
+        # Each crossing is alerted once
+        assert spend(user_id, card_id, 1, 'Food') == []
+        assert spend(user_id, card_id, 45, 'Bills') == [(None, CLOSE, 156)]
+        # Changed out of band: the category spending is read again, 62 is far enough under the budget to rearm it
+        moved = Transaction.query.filter_by(amount=50).one()
+        moved.category = 'Bills'
+        db.session.commit()
+        assert spend(user_id, card_id, 1, 'Food') == []
+        assert Categorybudget.query.one().spending == 62
+        assert Categorybudget.query.one().alert_level == SAFE
+        assert spend(user_id, card_id, 40, 'Food') == [('Food', OVER, 102)]
+        assert spend(user_id, card_id, 5, 'Food') == [(None, OVER, 202)]
+        assert spend(user_id, card_id, 1, 'Food') == []
+        assert Categorybudget.query.one().spending == 108
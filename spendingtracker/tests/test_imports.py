@@ -0,0 +1,62 @@
+"""
+A statement that can't be read to the end stops the import cleanly: the chunks before the bad line stay imported,
+and the result (and the user's report) says where it stopped instead of a 500.
+"""
+import io
+from spendingtracker.models import User, Transaction, Message
+from spendingtracker.cards.imports import import_statement
+from spendingtracker.tests.conftest import assert_rollups_rebuilt
+
+HEADER = 'amount,timestamp,description,transactionUUID\n'
+
+
+def rows(count, start=0):
+    return ''.join(f'1.50,2020-05-01 10:00:00.{i:06d},"Tesco, London",import-{i}\n' for i in range(start, start + count))
+
+
+def import_bytes(app, user_id, data, filename='statement.csv'):
+    with app.app_context():
+        file = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', newline='')
+        return import_statement(User.query.get(user_id), file, 'csv' if filename.endswith('.csv') else 'ndjson',
+                                card_id=User.query.get(user_id).cards[0].id, chunk_size=100)
+
+
+def test_field_over_csv_limit(app, user):
+    big = '1.50,2020-05-01 10:00:00,"' + 'x' * 200000 + '",big\n'
+    result = import_bytes(app, user[0], (HEADER + rows(250) + big + rows(10, 250)).encode())
+    assert result['imported'] == 250
+    assert result['stopped'].startswith("The file can't be read after line 251")
+    assert 'field larger than field limit' in result['stopped']
+    assert_rollups_rebuilt(app)
+
+
+def test_invalid_utf8(app, user):
+    # The bad byte is far after the first chunks, the decoder reads the file in blocks
+    data = (HEADER + rows(1000)).encode() + b'1.50,2020-05-01 10:00:00,Tesco \xff,bad\n' + rows(10, 1000).encode()
+    result = import_bytes(app, user[0], data)
+    assert 0 < result['imported'] < 1000
+    assert "'utf-8' codec can't decode" in result['stopped']
+    with app.app_context():
+        assert Transaction.query.count() == result['imported']
+    assert_rollups_rebuilt(app)
+
+
+def test_invalid_ndjson_utf8(app, user):
+    lines = ''.join(f'{{"amount": 2, "timestamp": "2020-05-01T10:00:00", "description": "Greggs", "transactionUUID": "json-{i}"}}\n'
+                    for i in range(1000))
+    result = import_bytes(app, user[0], lines.encode() + b'\xff\n', filename='statement.ndjson')
+    assert 0 < result['imported'] <= 1000
+    assert result['stopped'] is not None
+
+
+def test_upload_reports_partial_result(app, client, user):
+    data = (HEADER + rows(1000)).encode() + b'\xff\n'
+    response = client.post(f'/card/{user[1][0]}/import', data={'file': (io.BytesIO(data), 'statement.csv')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 302
+    with app.app_context():
+        imported = Transaction.query.count()
+        messages = [message.content for message in Message.query.order_by(Message.id)]
+    assert imported > 0
+    assert messages[0].startswith(f'{imported} transactions imported')
+    assert messages[-1].startswith('Import stopped')
@@ -0,0 +1,92 @@
+"""
+The navbar badge reads 'User.unread_messages', so it must always equal the number of unread 'message' rows: after
+flashes, fan-out posts, '/api/messages/read' and retention. Inbox pages, followed by their cursors, must give every
+message once in (timestamp desc, id desc) order.
+"""
+from datetime import datetime, timedelta
+from spendingtracker import db
+from spendingtracker.models import User, Message
+from spendingtracker.common.utils import flash_message, post_message
+from spendingtracker.common.retention import POLICIES
+from spendingtracker.main.utils import get_message_page
+from spendingtracker.tests.conftest import add_user
+
+
+def assert_unread_counts(app):
+    with app.app_context():
+        counts = dict(db.session.query(Message.user_id, db.func.count(Message.id)).filter(Message.read == False).group_by(Message.user_id))
+        for user in User.query:
+            assert user.unread_messages == counts.get(user.id, 0), user.id
+        return counts
+
+
+def test_unread_counter(app, client, user):
+    user_id, (card_id, _) = user
+    other = add_user(app, email='other@example.com')[0]
+    # Flashes in requests
+    for _ in range(3):
+        client.post('/generate_transaction', data={'card_id': card_id})
+    client.post('/api/messages/read')
+    assert assert_unread_counts(app) == {}
+    # Flashes and fan-out outside of a request
+    with app.app_context():
+        for i in range(4):
+            flash_message(f'Message {i}', 'info', user_id)
+        post_message('To everyone', 'info', [user_id, other])
+        db.session.commit()
+    assert assert_unread_counts(app) == {user_id: 5, other: 1}
+    assert client.get('/api/messages').get_json()['unread'] == 5
+    with app.app_context():
+        ids = [id for (id,) in db.session.query(Message.id).filter_by(user_id=user_id, read=False).order_by(Message.id).limit(2)]
+        other_ids = [id for (id,) in db.session.query(Message.id).filter_by(user_id=other)]
+    # Some ids, again (already read), and another user's message
+    assert client.post('/api/messages/read', data={'ids': ids}).get_json() == {'marked': 2, 'unread': 3}
+    assert client.post('/api/messages/read', data={'ids': ids + other_ids}).get_json() == {'marked': 0, 'unread': 3}
+    assert assert_unread_counts(app) == {user_id: 3, other: 1}
+    assert client.post('/api/messages/read', data={'ids': 'x'}).status_code == 400
+    # Retention deletes read and unread messages
+    with app.app_context():
+        POLICIES[0].prune(max_per_user=2)
+    counts = assert_unread_counts(app)
+    assert client.get('/api/messages').get_json()['unread'] == counts[user_id]
+    # All of them
+    assert client.post('/api/messages/read').get_json()['unread'] == 0
+    assert assert_unread_counts(app) == {other: 1}
+
+
+def full_scan(user_id):
+    return [id for (id,) in db.session.query(Message.id).filter_by(user_id=user_id).order_by(Message.timestamp.desc(), Message.id.desc())]
+
+
+def test_message_pages_equal_full_scan(app, client, user):
+    user_id = user[0]
+    other = add_user(app, email='other@example.com')[0]
+    start = datetime(2020, 5, 1)
+    with app.app_context():
+        # Few distinct timestamps, so most pages end in the middle of a tie
+        db.session.execute(Message.__table__.insert(), [
+            dict(timestamp=start + timedelta(seconds=(i * 7) % 5), type='info', content=f'Message {i}', read=False,
+                 user_id=user_id if i % 4 else other) for i in range(120)])
+        db.session.commit()
+        expected = full_scan(user_id)
+        assert len(expected) == 90
+        owner = User.query.get(user_id)
+        for limit in (1, 4, 7, 90, 200):
+            ids, cursor = [], None
+            while True:
+                messages, cursor = get_message_page(owner, cursor=cursor, limit=limit)
+                ids += [message['id'] for message in messages]
+                assert len(ids) == len(set(ids))
+                if cursor is None:
+                    break
+            assert ids == expected, limit
+    ids, cursor = [], None
+    while True:
+        page = client.get('/api/messages?limit=6' + (f'&cursor={cursor}' if cursor else '')).get_json()
+        ids += [message['id'] for message in page['messages']]
+        assert len(ids) == len(set(ids))
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert ids == expected
+    assert client.get('/api/messages?cursor=not-a-cursor').status_code == 400
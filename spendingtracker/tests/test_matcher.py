@@ -0,0 +1,83 @@
+"""
+'Matcher' must classify exactly like the full fuzzy scan it replaced: score the description against every rule of
+the matching table and keep the last rule whose similarity is above 90.
+Run from the repository root, the matching tables are read from relative paths:
+    python -m pytest spendingtracker/tests
+"""
+import random
+from spendingtracker.cards.matching import Matcher
+from spendingtracker.cards.utils import get_similarity, parse_matching_table, parse_descriptions
+
+
+def baseline_classify(table, description):
+    # The loop of the original 'classify_transaction()'
+    index = -1
+    for i in range(len(table)):
+        if get_similarity(description, table[i][0]) > 90:
+            index = i
+    return table[index][1] if index != -1 else 'General'
+
+
+def read_table():
+    with open('spendingtracker/cards/description.txt', 'r') as f:
+        return parse_matching_table(f.read())
+
+
+def read_descriptions():
+    with open('spendingtracker/cards/transactions.txt', 'r') as f:
+        return parse_descriptions(f.read())
+
+
+def mutate(rng, text):
+    # A typo: drop, swap, replace or double a character
+    if len(text) < 2:
+        return text + 'x'
+    i = rng.randrange(len(text) - 1)
+    operation = rng.randrange(4)
+    if operation == 0:
+        return text[:i] + text[i + 1:]
+    if operation == 1:
+        return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+    if operation == 2:
+        return text[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz ,') + text[i + 1:]
+    return text[:i] + text[i] + text[i:]
+
+
+def assert_same(table, descriptions):
+    matcher = Matcher(table, get_similarity)
+    mismatches = [(description, matcher.classify(description), baseline_classify(table, description))
+                  for description in descriptions if matcher.classify(description) != baseline_classify(table, description)]
+    assert mismatches == []
+
+
+def test_transaction_descriptions():
+    assert_same(read_table(), read_descriptions())
+
+
+def test_rules_and_reordered_descriptions():
+    table = read_table()
+    descriptions = [item for item, category in table]
+    descriptions += [', '.join(reversed(description.split(', '))) for description in read_descriptions()]
+    descriptions += [description.upper() for description in read_descriptions()]
+    assert_same(table, descriptions)
+
+
+def test_typos():
+    rng = random.Random(0)
+    descriptions = [mutate(rng, mutate(rng, description)) for description in read_descriptions() for _ in range(5)]
+    assert_same(read_table(), descriptions)
+
+
+def test_edge_strings():
+    descriptions = ['', ' ', 'a', 'A', '1', ',', '!!!', '12345', 'Tesco', 'tesco', 'TESCO', 'Tesc', 'T esco',
+                    'Café Nero, Nottingham', 'Müller Dairy', '東京 Sushi, London', 'Tesco' * 20,
+                    'Tesco Metro Tesco Express Tesco Extra', 'Nottingham, England', 'London']
+    assert_same(read_table(), descriptions)
+
+
+def test_last_rule_wins():
+    # Both rules score above 90 against the description, the later one decides
+    table = (('Tesco', 'Food'), ('Tesco Metro', 'Shopping'))
+    assert Matcher(table, get_similarity).classify('Tesco Metro, London') == 'Shopping'
+    assert Matcher(tuple(reversed(table)), get_similarity).classify('Tesco Metro, London') == 'Food'
+    assert_same(table, ['Tesco Metro, London', 'Tesco, London', 'Metro, London'])
@@ -0,0 +1,84 @@
+"""
+Flash messages are written behind, in the request's own commit: '/generate_transaction' commits once even when
+alerts fire, a failed commit keeps the messages for the next one, and a request that raises drops them.
+"""
+from datetime import datetime
+import pytest
+from sqlalchemy import event
+from spendingtracker import db
+from spendingtracker.models import User, Card, Message, OutboxEmail, Categorybudget, Transaction
+from spendingtracker.cards.utils import get_categories
+from spendingtracker.common.utils import flash_message
+from spendingtracker.tests.conftest import add_user
+
+
+def test_generate_transaction_commits_once(app, client, user, monkeypatch):
+    user_id, (card_id, _) = user
+    # A transaction of this month that leaves 30 on the card, over the overall budget and every category budget
+    monkeypatch.setattr('spendingtracker.models.get_amount', lambda: 120)
+    monkeypatch.setattr('spendingtracker.models.get_datetime', datetime.utcnow)
+    with app.app_context():
+        owner = User.query.get(user_id)
+        owner.spending.budget = 100
+        Card.query.get(card_id).balance = 150
+        db.session.add_all([Categorybudget(category=category, budget=1, owner=owner) for category in get_categories() + ('General',)])
+        db.session.commit()
+    commits = []
+
+    def committed(session):
+        commits.append(session)
+
+    event.listen(db.session, 'after_commit', committed)
+    try:
+        assert client.post('/generate_transaction', data={'card_id': card_id}).get_data(as_text=True) == 'Done'
+    finally:
+        event.remove(db.session, 'after_commit', committed)
+    assert len(commits) == 1
+    with app.app_context():
+        category = Transaction.query.one().category
+        # Balance, overall budget and category budget
+        assert sorted(email.subject for email in OutboxEmail.query) == \
+            ['Running out of money', 'Your Spending is Over Budget', 'Your Spending is Over Budget']
+        messages = [message.content for message in Message.query.order_by(Message.id)]
+        assert len(messages) == 3
+        assert messages[1] == 'Your total monthly spending has exceeded your budget!'
+        assert messages[2] == f'Your monthly budget on {category} has exceeded your budget!'
+        assert User.query.get(user_id).unread_messages == 3
+        assert Card.query.get(card_id).balance == 30
+
+
+def test_failed_commit_keeps_messages(app, user):
+    user_id = user[0]
+    with app.app_context():
+        flash_message('Kept', 'info', user_id)
+        # The same email again: the commit fails
+        db.session.add(User(firstname='Test', lastname='User', email='test@example.com', phone='0', password='x'))
+        with pytest.raises(Exception):
+            db.session.commit()
+        db.session.rollback()
+        assert Message.query.count() == 0
+        db.session.commit()
+        assert [message.content for message in Message.query] == ['Kept']
+        assert User.query.get(user_id).unread_messages == 1
+        # Written once
+        db.session.commit()
+        assert Message.query.count() == 1
+
+
+def test_raised_request_drops_messages(app, client, user):
+    user_id, (card_id, _) = user
+
+    def fail():
+        Card.query.get(card_id).card_name = 'Changed'
+        flash_message('Dropped', 'info', user_id)
+        raise RuntimeError('failed')
+
+    app.add_url_rule('/fail', 'fail', fail)
+    with pytest.raises(RuntimeError):
+        client.get('/fail')
+    # The next request of the same client has nothing left over
+    assert client.get('/api/messages').status_code == 200
+    with app.app_context():
+        assert Message.query.count() == 0
+        assert User.query.get(user_id).unread_messages == 0
+        assert Card.query.get(card_id).card_name == 'Card 0'
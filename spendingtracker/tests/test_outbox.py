@@ -0,0 +1,164 @@
+"""
+The outbox sender against a local SMTP sink: a batch goes over one connection, a failed email is retried later with
+a doubling delay, and emails reserved by one sender can't be claimed again by another.
+"""
+import socket, threading
+from datetime import datetime, timedelta
+import pytest
+from flask_mail import Message
+from spendingtracker import db
+from spendingtracker.models import OutboxEmail
+from spendingtracker.common.outbox import queue_email, outbox_sender, OutboxSender
+from spendingtracker.tests.conftest import make_app, dispose
+
+smtpd = pytest.importorskip('smtpd')
+asyncore = pytest.importorskip('asyncore')
+
+
+class SinkServer(smtpd.SMTPServer):
+    """
+    Keeps the emails it receives, counts connections and rejects emails whose subject is in 'reject'
+    """
+
+    def __init__(self):
+        self.map = {}
+        super().__init__(('127.0.0.1', 0), None, map=self.map, decode_data=True)
+        self.port = self.socket.getsockname()[1]
+        self.received = []
+        self.connections = 0
+        self.reject = set()
+
+    def handle_accepted(self, conn, addr):
+        self.connections += 1
+        super().handle_accepted(conn, addr)
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        subject = next(line[len('Subject: '):] for line in data.splitlines() if line.startswith('Subject: '))
+        if subject in self.reject:
+            return '554 Rejected'
+        self.received.append(subject)
+
+
+@pytest.fixture
+def sink():
+    server = SinkServer()
+    thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05, 'map': server.map}, daemon=True)
+    thread.start()
+    yield server
+    asyncore.close_all(server.map)
+    thread.join(5)
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def mail_app(tmp_path, port, **settings):
+    return make_app(tmp_path, MAIL_SERVER='127.0.0.1', MAIL_PORT=port, MAIL_USE_TLS=False, MAIL_USE_SSL=False,
+                    MAIL_USERNAME=None, MAIL_PASSWORD=None, MAIL_SUPPRESS_SEND=False, MAIL_CONNECT_TIMEOUT=5, **settings)
+
+
+def queue(*subjects):
+    for subject in subjects:
+        queue_email(Message(subject, sender='sender@example.com', recipients=['user@example.com'], body=subject))
+    db.session.commit()
+
+
+def make_due():
+    OutboxEmail.query.filter(OutboxEmail.sent == None, OutboxEmail.next_attempt != None).update({OutboxEmail.next_attempt: datetime.utcnow()})
+    db.session.commit()
+
+
+def test_batch_over_one_connection(tmp_path, sink):
+    app = mail_app(tmp_path, sink.port, OUTBOX_BATCH_SIZE=10)
+    with app.app_context():
+        queue(*[f'Email {i}' for i in range(7)])
+        assert outbox_sender.drain() == (7, 0)
+        assert sink.connections == 1
+        assert sink.received == [f'Email {i}' for i in range(7)]
+        assert OutboxEmail.query.filter(OutboxEmail.sent == None).count() == 0
+        # Nothing left to send
+        assert outbox_sender.drain() == (0, 0)
+    dispose(app)
+
+
+def test_backoff_after_failure(tmp_path, sink):
+    app = mail_app(tmp_path, sink.port, OUTBOX_RETRY_DELAY=30, OUTBOX_MAX_ATTEMPTS=3)
+    sink.reject.add('Rejected')
+    with app.app_context():
+        queue('First', 'Rejected', 'Last')
+        start = datetime.utcnow()
+        # The rest of the batch is sent over a new connection after the failure
+        assert outbox_sender.drain() == (2, 1)
+        assert sink.received == ['First', 'Last']
+        assert sink.connections == 2
+        email = OutboxEmail.query.filter_by(subject='Rejected').one()
+        assert email.attempts == 1 and email.sent is None and '554' in email.error
+        assert start + timedelta(seconds=29) <= email.next_attempt <= datetime.utcnow() + timedelta(seconds=30)
+        # Not due yet
+        assert outbox_sender.drain() == (0, 0)
+        # The delay doubles
+        make_due()
+        assert outbox_sender.drain() == (0, 1)
+        email = OutboxEmail.query.filter_by(subject='Rejected').one()
+        assert email.attempts == 2
+        assert email.next_attempt >= datetime.utcnow() + timedelta(seconds=59)
+        # The last attempt gives up
+        make_due()
+        assert outbox_sender.drain() == (0, 1)
+        assert OutboxEmail.query.filter_by(subject='Rejected').one().next_attempt is None
+        assert outbox_sender.get_stats()['pending'] == 0
+    dispose(app)
+
+
+def test_retry_after_server_is_back(tmp_path, sink):
+    app = mail_app(tmp_path, get_free_port())
+    with app.app_context():
+        queue('First', 'Second')
+        # Nothing listens on the port: the whole batch waits for its next attempt
+        assert outbox_sender.drain() == (0, 2)
+        assert OutboxEmail.query.filter(OutboxEmail.attempts == 1, OutboxEmail.next_attempt > datetime.utcnow()).count() == 2
+    dispose(app)
+    app = mail_app(tmp_path, sink.port)
+    with app.app_context():
+        make_due()
+        assert outbox_sender.drain() == (2, 0)
+        assert sink.received == ['First', 'Second']
+    dispose(app)
+
+
+def test_lease_stops_second_claim(tmp_path, sink):
+    app = mail_app(tmp_path, sink.port, OUTBOX_BATCH_SIZE=3, OUTBOX_LEASE=300)
+    with app.app_context():
+        queue(*[f'Email {i}' for i in range(5)])
+        first, second = OutboxSender(), OutboxSender()
+        first.init_app(app)
+        second.init_app(app)
+        claimed = first._claim()
+        assert [email.subject for email in claimed] == ['Email 0', 'Email 1', 'Email 2']
+        assert all(email.next_attempt > datetime.utcnow() + timedelta(seconds=290) for email in claimed)
+        # Only the rows the first sender didn't reserve are left
+        assert [email.subject for email in second._claim()] == ['Email 3', 'Email 4']
+        assert second._claim() == []
+        # A lease that ran out (e.g. the process stopped) makes the rows due again, none were sent twice
+        make_due()
+        assert second.drain() == (5, 0)
+        assert sorted(sink.received) == [f'Email {i}' for i in range(5)]
+    dispose(app)
+
+
+def test_queue_only_adds_to_session(app, monkeypatch):
+    woken = []
+    monkeypatch.setattr(outbox_sender, 'wake', lambda: woken.append(True))
+    with app.app_context():
+        queue_email(Message('Rolled back', sender='sender@example.com', recipients=['user@example.com'], body=''))
+        assert woken == []
+        db.session.rollback()
+        db.session.commit()
+        assert OutboxEmail.query.count() == 0 and woken == []
+        # The sender is woken once the email is committed
+        queue('Committed')
+        assert [email.subject for email in OutboxEmail.query] == ['Committed']
+        assert woken == [True]
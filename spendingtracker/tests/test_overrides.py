@@ -0,0 +1,43 @@
+"""
+A category the user chose for a merchant is used for their next transactions from it. A single transaction only
+looks up the override of its own merchant, not the user's whole override index.
+"""
+from sqlalchemy import event
+from spendingtracker import db
+from spendingtracker.models import Transaction, CategoryOverride
+
+
+def test_generate_uses_override(app, client, user, monkeypatch):
+    monkeypatch.setattr('spendingtracker.models.get_desctiption', lambda: 'Tesco Metro, Nottingham, England')
+    with app.app_context():
+        db.session.add_all([CategoryOverride(merchant=f'merchant {i}', category='Bills', user_id=user[0]) for i in range(1000)])
+        CategoryOverride.set_override(user[0], 'Tesco Metro, London', 'Charity')
+        db.session.commit()
+        engine = db.engine
+    statements = []
+
+    def executed(conn, cursor, statement, parameters, context, executemany):
+        if 'category_override' in statement:
+            statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', executed)
+    try:
+        assert client.post('/generate_transaction', data={'card_id': user[1][0]}).get_data(as_text=True) == 'Done'
+    finally:
+        event.remove(engine, 'before_cursor_execute', executed)
+    with app.app_context():
+        assert Transaction.query.one().category == 'Charity'
+    # One lookup by (user_id, merchant)
+    assert len(statements) == 1
+    assert 'merchant = ?' in statements[0][0] and 'tesco metro' in statements[0][1]
+
+
+def test_get_overrides(app, user):
+    with app.app_context():
+        CategoryOverride.set_override(user[0], 'Tesco Metro, London', 'Charity')
+        CategoryOverride.set_override(user[0], 'Greggs, Nottingham', 'Bills')
+        db.session.commit()
+        assert CategoryOverride.get_overrides(user[0]) == {'tesco metro': 'Charity', 'greggs': 'Bills'}
+        assert CategoryOverride.get_overrides(user[0], merchant='greggs') == {'greggs': 'Bills'}
+        assert CategoryOverride.get_overrides(user[0], merchant='tesco') == {}
+        assert CategoryOverride.get_overrides(user[0] + 1, merchant='greggs') == {}
@@ -0,0 +1,94 @@
+"""
+Pages of 'get_transaction_page()' and '/api/transactions', followed by their cursors, must give exactly the
+transactions of a full scan ordered by (timestamp desc, id desc): none missing or repeated, also when many
+transactions share a timestamp across cards.
+"""
+import random
+from datetime import datetime, timedelta
+from spendingtracker import db
+from spendingtracker.models import User, Transaction, Card
+from spendingtracker.main.utils import get_transaction_page
+from spendingtracker.tests.conftest import add_user
+
+CATEGORIES = ['Food', 'Bills', 'Shopping']
+
+
+def insert_transactions(card_ids, count, seed=0):
+    # Few distinct timestamps, so most pages end in the middle of a tie; some have no microseconds
+    rng = random.Random(seed)
+    timestamps = [datetime(2020, 5, day, 23, 59, 59, 999999) for day in (1, 2, 3)] + \
+                 [datetime(2020, 5, day, 0, 0) for day in (1, 2, 3, 4)] + \
+                 [datetime(2020, 5, 2, 12, 30, 0, 500) for _ in range(2)]
+    db.session.execute(Transaction.__table__.insert(), [
+        dict(transactionUUID=f'page-{seed}-{i}', amount=i + 1, currency='GBP', timestamp=rng.choice(timestamps),
+             description='Tesco, London', category=rng.choice(CATEGORIES), card_id=rng.choice(card_ids))
+        for i in range(count)])
+    db.session.commit()
+
+
+def full_scan(user_id, card_id=None, category=None, start_date=None, end_date=None):
+    query = db.session.query(Transaction.id).join(Card).filter(Card.user_id == user_id)
+    if card_id is not None:
+        query = query.filter(Transaction.card_id == card_id)
+    if category is not None:
+        query = query.filter(Transaction.category == category)
+    if start_date is not None:
+        query = query.filter(Transaction.timestamp >= start_date)
+    if end_date is not None:
+        query = query.filter(Transaction.timestamp < end_date)
+    return [id for (id,) in query.order_by(Transaction.timestamp.desc(), Transaction.id.desc())]
+
+
+def read_pages(user, limit, **filters):
+    ids, cursor = [], None
+    while True:
+        transactions, cursor = get_transaction_page(user, cursor=cursor, limit=limit, **filters)
+        assert len(transactions) <= limit
+        ids += [transaction['id'] for transaction in transactions]
+        if cursor is None:
+            return ids
+        assert len(transactions) == limit
+        # A cursor that doesn't move past its page would loop forever
+        assert len(ids) == len(set(ids))
+
+
+def test_pages_equal_full_scan(app):
+    user_id, card_ids = add_user(app, cards=3)
+    _, other_card_ids = add_user(app, cards=1, email='other@example.com')
+    with app.app_context():
+        insert_transactions(card_ids, 200)
+        insert_transactions(other_card_ids, 50, seed=1)
+        user = User.query.get(user_id)
+        filter_sets = [{}, {'card_id': card_ids[1]}, {'category': 'Bills'},
+                       {'start_date': datetime(2020, 5, 2), 'end_date': datetime(2020, 5, 3)},
+                       {'card_id': card_ids[0], 'category': 'Food', 'end_date': datetime(2020, 5, 3)},
+                       {'card_id': other_card_ids[0]}]
+        for filters in filter_sets:
+            expected = full_scan(user_id, **filters)
+            for limit in (1, 3, 7, 50, 500):
+                assert read_pages(user, limit, **filters) == expected, (filters, limit)
+        # The other user's card is never read
+        assert full_scan(user_id, card_id=other_card_ids[0]) == []
+        assert len(full_scan(user_id)) == 200
+
+
+def test_api_pages(app, client, user):
+    user_id, card_ids = user
+    with app.app_context():
+        insert_transactions(card_ids, 120)
+        # The last day is included up to its last microsecond, the next day is not
+        expected = full_scan(user_id, start_date=datetime(2020, 5, 2), end_date=datetime(2020, 5, 2) + timedelta(days=1))
+        assert datetime(2020, 5, 2, 23, 59, 59, 999999) in {t.timestamp for t in Transaction.query.filter(Transaction.id.in_(expected))}
+    ids, cursor = [], None
+    while True:
+        url = '/api/transactions?limit=7&start=2020-05-02&end=2020-05-02' + (f'&cursor={cursor}' if cursor else '')
+        response = client.get(url)
+        assert response.status_code == 200
+        ids += [transaction['id'] for transaction in response.get_json()['transactions']]
+        cursor = response.get_json()['next_cursor']
+        if cursor is None:
+            break
+        assert len(ids) == len(set(ids))
+    assert ids == expected
+    assert client.get('/api/transactions?cursor=not-a-cursor').status_code == 400
+    assert client.get('/api/transactions?end=2020-13-01').status_code == 400
@@ -0,0 +1,59 @@
+"""
+'flask reclassify' keeps the categories users chose: transactions of a merchant the user has an override for are
+skipped, even when the override is the category the old rule gave. The first run saves the table it starts from.
+"""
+from spendingtracker import db
+from spendingtracker.models import Transaction, Card, CategoryOverride, ROLLUPS
+from spendingtracker.tests.conftest import add_user, assert_rollups_rebuilt
+from spendingtracker.tests.test_rollups import import_csv
+
+OLD = 'spendingtracker/cards/description.txt'
+
+
+def write_new_table(tmp_path):
+    with open(OLD, 'r') as f:
+        table = f.read()
+    new = tmp_path / 'description.txt'
+    new.write_text(table.replace('Tesco;      Food', 'Tesco;      Shopping'))
+    return new
+
+
+def reclassify(app, *args):
+    result = app.test_cli_runner().invoke(args=['reclassify', *args])
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_overrides_are_kept(app, client, user, tmp_path):
+    text = 'amount,timestamp,description\n' + ''.join(f'{i + 1},2020-05-0{i % 9 + 1} 10:00:00,"Tesco, London"\n' for i in range(6))
+    import_csv(client, user[1][0], text)
+    other_user, other_cards = add_user(app, email='other@example.com')
+    with app.app_context():
+        db.session.execute(Transaction.__table__.insert(), [
+            dict(transactionUUID=f'other-{i}', amount=1, currency='GBP', timestamp=Transaction.query.first().timestamp,
+                 description='Tesco, London', category='Food', card_id=other_cards[0]) for i in range(3)])
+        # The user chose the category the old rule gives
+        CategoryOverride.set_override(user[0], 'Tesco, London', 'Food')
+        db.session.commit()
+        # A Core insert skips the ORM events that keep the rollups up to date
+        with db.engine.begin() as connection:
+            for rollup in ROLLUPS:
+                rollup.rebuild(connection)
+    reclassify(app, '--table', str(write_new_table(tmp_path)), '--old', OLD, '--snapshot', str(tmp_path / 'applied.txt'))
+    with app.app_context():
+        categories = sorted(db.session.query(Card.user_id, Transaction.category).join(Card).distinct())
+    assert categories == [(user[0], 'Food'), (other_user, 'Shopping')]
+    assert_rollups_rebuilt(app)
+
+
+def test_first_run_saves_snapshot(app, client, user, tmp_path):
+    import_csv(client, user[1][0], 'amount,timestamp,description\n1,2020-05-01 10:00:00,"Tesco, London"\n')
+    snapshot = tmp_path / 'applied.txt'
+    output = reclassify(app, '--table', OLD, '--snapshot', str(snapshot))
+    assert 'saved' in output
+    assert snapshot.read_text() == open(OLD).read()
+    # The next run diffs against the saved table
+    reclassify(app, '--table', str(write_new_table(tmp_path)), '--snapshot', str(snapshot))
+    with app.app_context():
+        assert [category for (category,) in db.session.query(Transaction.category)] == ['Shopping']
+    assert snapshot.read_text() == write_new_table(tmp_path).read_text()
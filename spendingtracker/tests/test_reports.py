@@ -0,0 +1,48 @@
+"""
+Reports cover whole days: from the start day up to the end of the last day, including its last second with
+microseconds, and nothing of the day after. Whole days come from 'daily_spending', the edge days from transactions.
+"""
+from datetime import datetime, timedelta
+from spendingtracker import db
+from spendingtracker.models import User, Transaction, ROLLUPS
+from spendingtracker.main.reports import SpendingReport
+
+
+def insert(card_id, rows):
+    db.session.execute(Transaction.__table__.insert(), [
+        dict(transactionUUID=f'report-{i}', amount=amount, currency='GBP', timestamp=timestamp, description='Tesco, London',
+             category=category, card_id=card_id) for i, (amount, timestamp, category) in enumerate(rows)])
+    db.session.commit()
+
+
+def test_report_range(app, user):
+    user_id, (card_id, _) = user
+    with app.app_context():
+        insert(card_id, [
+            (1, datetime(2020, 4, 30, 23, 59, 59, 999999), 'Food'),
+            (2, datetime(2020, 5, 1, 0, 0), 'Food'),
+            (4, datetime(2020, 5, 1, 12, 0, 0, 500), 'Bills'),
+            (8, datetime(2020, 5, 15, 9, 30), 'Food'),
+            (16, datetime(2020, 5, 31, 23, 59, 59), 'Bills'),
+            (32, datetime(2020, 5, 31, 23, 59, 59, 500000), 'Food'),
+            (64, datetime(2020, 6, 1, 0, 0), 'Food'),
+        ])
+        # A Core insert skips the ORM events that keep 'daily_spending' up to date
+        with db.engine.begin() as connection:
+            for rollup in ROLLUPS:
+                rollup.rebuild(connection)
+        user = User.query.get(user_id)
+        report = SpendingReport.load(user, datetime(2020, 5, 1), datetime(2020, 6, 1))
+        assert report.total_spending() == 62
+        assert report.spending_by_category() == {'Bills': 20, 'Food': 42}
+        # One day
+        assert SpendingReport.load(user, datetime(2020, 5, 31), datetime(2020, 6, 1)).total_spending() == 48
+        assert SpendingReport.load(user, datetime(2020, 5, 1), datetime(2020, 5, 2)).total_spending() == 6
+        assert SpendingReport.load(user, datetime(2020, 6, 1), datetime(2020, 6, 2)).total_spending() == 64
+
+
+def test_report_mail_range(app, client, user, monkeypatch):
+    jobs = []
+    monkeypatch.setattr('spendingtracker.main.routes.job_queue.enqueue', lambda function, *args: jobs.append(args))
+    client.post('/report_mail', data={'start': '2020-05-01', 'end': '2020-05-31'})
+    assert jobs == [(user[0], datetime(2020, 5, 1), datetime(2020, 5, 31) + timedelta(days=1))]
@@ -0,0 +1,126 @@
+"""
+Retention deletes 'message' and 'log' rows older than the age limit and over the per-user cap, keeping the newest.
+Deleted unread messages leave the users' unread counts, and archived rows are written before they are deleted.
+"""
+import json
+from datetime import datetime, timedelta
+from spendingtracker import db
+from spendingtracker.models import User, Message, Log
+from spendingtracker.common.retention import POLICIES, apply_retention
+from spendingtracker.tests.conftest import add_user, make_app, dispose
+
+MESSAGES, LOGS = POLICIES
+
+
+def insert_messages(user_id, rows):
+    """
+    :param rows: list of (timestamp, read)
+    """
+    db.session.execute(Message.__table__.insert(), [
+        dict(timestamp=timestamp, type='info', content=f'Message {i}', read=read, user_id=user_id) for i, (timestamp, read) in enumerate(rows)])
+    Message.add_unread(db.session.connection(), {user_id: sum(not read for timestamp, read in rows)})
+    db.session.commit()
+
+
+def insert_logs(user_id, logins):
+    db.session.execute(Log.__table__.insert(), [
+        dict(email='test@example.com', login=login.strftime("%Y-%m-%d %H:%M:%S"), ip='127.0.0.1', user_id=user_id) for login in logins])
+    db.session.commit()
+
+
+def assert_unread_counts():
+    counts = dict(db.session.query(Message.user_id, db.func.count(Message.id)).filter(Message.read == False).group_by(Message.user_id))
+    assert {user.id: user.unread_messages for user in User.query} == {user.id: counts.get(user.id, 0) for user in User.query}
+
+
+def test_message_age(app, user):
+    now = datetime.utcnow()
+    with app.app_context():
+        insert_messages(user[0], [(now - timedelta(days=400), False), (now - timedelta(days=366), True),
+                                  (now - timedelta(days=364), False), (now, False)])
+        assert MESSAGES.prune(max_age=365, chunk_size=1) == 2
+        assert [message.content for message in Message.query.order_by(Message.id)] == ['Message 2', 'Message 3']
+        assert User.query.get(user[0]).unread_messages == 2
+        assert_unread_counts()
+
+
+def test_log_age(app, user):
+    # 'Log.login' is a string, the cutoff is compared as one
+    now = datetime.utcnow().replace(microsecond=0)
+    with app.app_context():
+        insert_logs(user[0], [now - timedelta(days=400), now - timedelta(days=30, seconds=1), now - timedelta(days=29), now])
+        assert LOGS.prune(max_age=30) == 2
+        assert [log.login for log in Log.query.order_by(Log.id)] == [(now - timedelta(days=29)).strftime("%Y-%m-%d %H:%M:%S"),
+                                                                     now.strftime("%Y-%m-%d %H:%M:%S")]
+
+
+def test_cap_per_user_keeps_newest(app, user):
+    other = add_user(app, email='other@example.com')[0]
+    start = datetime(2020, 5, 1)
+    with app.app_context():
+        # Inserted out of time order, with ties on the timestamp, half of them read
+        times = [start + timedelta(hours=hour) for hour in (5, 1, 9, 3, 9, 7, 2, 8, 0, 6)]
+        insert_messages(user[0], [(time, i % 2 == 0) for i, time in enumerate(times)])
+        insert_messages(other, [(start, False)] * 3)
+        insert_logs(user[0], times)
+        newest = [id for (id,) in db.session.query(Message.id).filter_by(user_id=user[0]).order_by(Message.timestamp.desc(), Message.id.desc()).limit(4)]
+        assert MESSAGES.prune(max_per_user=4, chunk_size=2) == 6
+        assert sorted(id for (id,) in db.session.query(Message.id).filter_by(user_id=user[0])) == sorted(newest)
+        assert Message.query.filter_by(user_id=other).count() == 3
+        assert_unread_counts()
+        # Logs keep the latest logins
+        newest = [id for (id,) in db.session.query(Log.id).order_by(Log.id.desc()).limit(3)]
+        assert LOGS.prune(max_per_user=3, chunk_size=2) == 7
+        assert sorted(id for (id,) in db.session.query(Log.id)) == sorted(newest)
+
+
+class CheckedArchive:
+    """
+    File that checks the rows it's given are still in the db when they are written
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.written = []
+
+    def write(self, text):
+        rows = [json.loads(line) for line in text.splitlines()]
+        assert Message.query.filter(Message.id.in_([row['id'] for row in rows])).count() == len(rows)
+        self.written += rows
+        self.file.write(text)
+
+    def flush(self):
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+
+def test_archive_before_delete(app, user, tmp_path):
+    now = datetime.utcnow()
+    with app.app_context():
+        insert_messages(user[0], [(now - timedelta(days=400 + i), False) for i in range(5)] + [(now, False)])
+        old = [message.id for message in Message.query.order_by(Message.id)][:5]
+        with open(tmp_path / 'message.ndjson', 'a') as file:
+            archive = CheckedArchive(file)
+            assert MESSAGES.prune(max_age=365, chunk_size=2, archive=archive) == 5
+        assert sorted(row['id'] for row in archive.written) == old
+        assert [json.loads(line)['content'] for line in open(tmp_path / 'message.ndjson')] == [f'Message {i}' for i in range(5)]
+        assert Message.query.count() == 1
+        assert_unread_counts()
+
+
+def test_apply_retention(tmp_path):
+    app = make_app(tmp_path, MESSAGE_RETENTION_DAYS=30, MESSAGE_MAX_PER_USER=2, LOG_RETENTION_DAYS=30, LOG_MAX_PER_USER=None)
+    user_id = add_user(app)[0]
+    now = datetime.utcnow()
+    with app.app_context():
+        insert_messages(user_id, [(now - timedelta(days=40), False)] + [(now - timedelta(minutes=i), False) for i in range(3)])
+        insert_logs(user_id, [now - timedelta(days=40), now])
+        archive_dir = tmp_path / 'archive'
+        archive_dir.mkdir()
+        assert apply_retention(str(archive_dir)) == {'message': 2, 'log': 1}
+        assert len(open(archive_dir / 'message.ndjson').readlines()) == 2
+        assert len(open(archive_dir / 'log.ndjson').readlines()) == 1
+        assert_unread_counts()
+    dispose(app)
@@ -0,0 +1,95 @@
+"""
+The spending rollups (monthly_spending, daily_spending) are kept up to date by ORM events and by the bulk paths
+that skip them (import, reclassify, seed). After every kind of change they must equal a rebuild from the
+'transaction' table.
+"""
+import io
+from datetime import datetime
+from spendingtracker import db
+from spendingtracker.models import Transaction, Card
+from spendingtracker.tests.conftest import assert_rollups_rebuilt
+
+
+def generate(client, card_id, count):
+    for _ in range(count):
+        assert client.post('/generate_transaction', data={'card_id': card_id}).status_code == 200
+
+
+def import_csv(client, card_id, text):
+    data = {'file': (io.BytesIO(text.encode('utf-8')), 'statement.csv')}
+    return client.post(f'/card/{card_id}/import', data=data, content_type='multipart/form-data')
+
+
+def test_generate_transaction(app, client, user):
+    generate(client, user[1][0], 10)
+    generate(client, user[1][1], 5)
+    rollups = assert_rollups_rebuilt(app)
+    assert sum(row[-1] for row in rollups['monthly_spending']) == 15
+
+
+def test_change_category(app, client, user):
+    generate(client, user[1][0], 10)
+    with app.app_context():
+        ids = [id for (id,) in db.session.query(Transaction.id).order_by(Transaction.id).limit(4)]
+    for id, category in zip(ids, ['Bills', 'Charity', 'Bills', 'Technology']):
+        assert client.post('/change_category', data={'transactionID': id, 'newCategory': category}).get_data(as_text=True) == 'Succeeded'
+    assert_rollups_rebuilt(app)
+
+
+def test_orm_update_and_delete(app, client, user):
+    generate(client, user[1][0], 6)
+    with app.app_context():
+        transactions = Transaction.query.order_by(Transaction.id).all()
+        # Moves to another month, day, amount and category at once
+        transactions[0].timestamp = datetime(2020, 1, 15, 12, 0)
+        transactions[0].amount = 12.34
+        transactions[1].category = 'Bills'
+        db.session.delete(transactions[2])
+        db.session.commit()
+    assert_rollups_rebuilt(app)
+
+
+def test_delete_card(app, client, user):
+    generate(client, user[1][0], 5)
+    generate(client, user[1][1], 5)
+    client.post(f'/delete_card/{user[1][0]}')
+    with app.app_context():
+        assert Card.query.get(user[1][0]) is None
+    rollups = assert_rollups_rebuilt(app)
+    assert {row[1] for row in rollups['daily_spending']} == {user[1][1]}
+
+
+def test_import(app, client, user):
+    text = 'amount,timestamp,description,transactionUUID,card\n' + ''.join(
+        f'{i % 50 + 0.99},2020-{i % 12 + 1:02d}-{i % 28 + 1:02d} 10:{i % 60:02d}:00.{i:06d},"Tesco {i % 7}, London",import-{i},{user[1][i % 2]}\n'
+        for i in range(300))
+    import_csv(client, user[1][0], text)
+    # The second time every row is a duplicate
+    import_csv(client, user[1][0], text)
+    rollups = assert_rollups_rebuilt(app)
+    assert sum(row[-1] for row in rollups['monthly_spending']) == 300
+
+
+def test_reclassify(app, client, user, tmp_path):
+    text = 'amount,timestamp,description\n' + ''.join(
+        f'{i + 1},2020-0{i % 9 + 1}-01 10:00:00,"{description}"\n' for i, description in enumerate(['Tesco, London', 'Greggs, London'] * 5))
+    import_csv(client, user[1][0], text)
+    old = 'spendingtracker/cards/description.txt'
+    with open(old, 'r') as f:
+        table = f.read()
+    new = tmp_path / 'description.txt'
+    new.write_text(table.replace('Tesco;      Food', 'Tesco;      Shopping'))
+    result = app.test_cli_runner().invoke(args=['reclassify', '--table', str(new), '--old', old, '--snapshot', str(tmp_path / 'applied.txt')])
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        categories = dict(db.session.query(Transaction.description, Transaction.category).distinct())
+    assert categories == {'Tesco, London': 'Shopping', 'Greggs, London': 'Food'}
+    assert_rollups_rebuilt(app)
+
+
+def test_seed(app, user):
+    with app.app_context():
+        from spendingtracker.seed import seed_database
+        seed_database(5, 2, 50, seed=1, end_date=datetime(2021, 1, 1))
+    rollups = assert_rollups_rebuilt(app)
+    assert sum(row[-1] for row in rollups['monthly_spending']) == 500
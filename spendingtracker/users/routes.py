@@ -2,10 +2,11 @@ from flask import render_template, url_for, flash, redirect, request, Blueprint,
 from spendingtracker import db, bcrypt
 from spendingtracker.users.forms import RegistrationForm, LoginForm, RequestResetForm, ResetPasswordForm, SettingsForm
 from spendingtracker.common.senders import send_reset_email
-from spendingtracker.models import User, Log, LogSchema
+from spendingtracker.models import User, Log
 from flask_login import login_user, current_user, logout_user, login_required
 from datetime import timedelta, datetime
 from spendingtracker.common.utils import flash_message
+from spendingtracker.common.serializers import log_serializer
 from spendingtracker.users.utils import get_latest_login, get_ip_address
 
 
@@ -133,13 +134,8 @@ def settings():
         # flash(f'Your settings have been updated!', 'success')
         flash_message(f'Your settings have been updated!', 'success', current_user.id)
         return redirect(url_for('main.homepage'))
-    logs = current_user.logs
-    logs_schema = LogSchema()
-    listOfDict = []
-    for log in logs:
-        dict_log = logs_schema.dump(log)
-        listOfDict += [dict_log]
-    return render_template('settings.html', title='Settings', form=form, logs_json=listOfDict)
+    logs = log_serializer.dump(log_serializer.query().filter(Log.user_id == current_user.id).order_by(Log.id))
+    return render_template('settings.html', title='Settings', form=form, logs_json=logs)
 
 
 
@@ -154,6 +150,8 @@ def reset_password():
         # flash messages can be passed between pages, message tag is placed in 'layout.html'
         # flash('An email has been set with instructions to reset your password', 'info')
         flash_message('An email has been set with instructions to reset your password', 'info', user.id)
+        # The email is saved to the outbox with this commit
+        db.session.commit()
         return redirect(url_for('users.login'))
     return render_template('reset_password.html', title='Reset Password', form=form)
 
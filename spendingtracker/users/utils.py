@@ -1,9 +1,10 @@
 import requests, json
+from spendingtracker.models import Log
 
 
 # Get the user's latest login record
 def get_latest_login(user):
-    return user.logs[-1]
+    return Log.query.filter_by(user_id=user.id).order_by(Log.id.desc()).first()
 
 
 # Get login information: email address, ip address, login timestamp and region